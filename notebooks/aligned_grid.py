@@ -0,0 +1,415 @@
+import os
+import json
+import hashlib
+import xarray as xr
+import geopandas as gpd
+import rasterio
+from rasterio.warp import reproject, Resampling
+import numpy as np
+from glob import glob
+from shapely import wkt
+from era5_access import ERA5Archive
+from landmask import rasterize_land
+from ndvi_access import read_ndvi_window
+from regrid import regrid_operator, upsample_grid
+from instrumentation import stage
+
+# Bump when the content of the aligned stack changes so stale entries are ignored
+CACHE_VERSION = 2
+DEFAULT_MAX_CACHE_BYTES = 2 * 1024**3
+
+
+def resolve_ndvi_file(ndvi_folder, year, season_start, season_end):
+    """Return the NDVI GeoTIFF for the season, falling back to any file of that year"""
+    ndvi_file = os.path.join(ndvi_folder, f"ndvi_{season_start}_{season_end}.tif")
+    if os.path.exists(ndvi_file):
+        return ndvi_file
+    files = sorted(glob(os.path.join(ndvi_folder, f"*{year}*.tif")))
+    if files:
+        print(f"Using fallback NDVI: {os.path.basename(files[0])}")
+        return files[0]
+    return None
+
+
+def study_area_from_city(city_gdf, buffer_degree):
+    """Buffer the dissolved city polygon (approx 20km for 0.2 degrees)"""
+    study_area_gdf = city_gdf.copy()
+    study_area_gdf.geometry = city_gdf.geometry.buffer(buffer_degree)
+    return study_area_gdf
+
+
+def city_gdf_from_stack(stack):
+    """Rebuild the dissolved city GeoDataFrame stored in the stack attributes"""
+    return gpd.GeoDataFrame(geometry=[wkt.loads(stack.attrs['city_wkt'])], crs=stack.attrs['city_crs'])
+
+
+def read_stack_inputs(country_code, city_name, year, gadm_index, era5_folder, ndvi_file,
+                      season_start, season_end, buffer_degree=0.2, upsample_factor=10,
+                      era5_archive=None, ndvi_window=None, ndvi_overview_dir=None):
+    """
+    The reads behind build_aligned_stack: city and land polygons, the ERA5 seasonal
+    mean of the study area and the NDVI window, as a dict (None if the city is not
+    in GADM). Safe to run on a background thread to prefetch the next city.
+    """
+    # --- 1. Define Study Area ---
+    with stage('gadm_lookup') as s:
+        city_gdf, level = gadm_index.find_city(country_code, city_name)
+        if city_gdf.empty:
+            print(f"Error: City {city_name} not found in GADM data for {country_code}.")
+            return None
+        print(f"Found {city_name} at Admin Level {level}")
+
+        study_area_gdf = study_area_from_city(city_gdf, buffer_degree)
+
+        minx, miny, maxx, maxy = study_area_gdf.total_bounds
+        print(f"Study area defined: {minx:.4f}, {miny:.4f}, {maxx:.4f}, {maxy:.4f}")
+
+        # Land Mask (GADM clipped to the Study Area envelope) so sea/ocean pixels can be removed
+        land_gdf = gadm_index.land((minx, miny, maxx, maxy))
+        s.shape('land_polygons', land_gdf)
+
+    # --- 2. Temperature (ERA5) ---
+    # Only the study-area window of the season is read before averaging
+    print("Processing Temperature Data...")
+    with stage('era5_load_reduce') as s:
+        if era5_archive is None:
+            with ERA5Archive(era5_folder) as archive:
+                temp_clipped = archive.seasonal_mean(year, (minx, miny, maxx, maxy), season_start, season_end)
+        else:
+            temp_clipped = era5_archive.seasonal_mean(year, (minx, miny, maxx, maxy), season_start, season_end)
+        s.shape('temp_clipped', temp_clipped)
+
+    # --- 3. NDVI window of the study area, at the resolution of the upsampled grid ---
+    owns_window = ndvi_window is None
+    if owns_window:
+        new_lat, new_lon = upsample_grid(temp_clipped.latitude.values, temp_clipped.longitude.values, upsample_factor)
+        # Pixel width of the destination transform built in build_aligned_stack
+        target_res = (new_lon.max() - new_lon.min()) / len(new_lon)
+        with stage('ndvi_read') as s:
+            ndvi_window = read_ndvi_window(ndvi_file, (minx, miny, maxx, maxy), overview_dir=ndvi_overview_dir,
+                                           target_res=target_res)
+            s.shape('ndvi_window', ndvi_window.dataset)
+
+    return {
+        'city_gdf': city_gdf,
+        'level': level,
+        'land_gdf': land_gdf,
+        'temp_clipped': temp_clipped,
+        'ndvi_window': ndvi_window,
+        'owns_window': owns_window,
+    }
+
+
+def build_aligned_stack(country_code, city_name, year, gadm_index, era5_folder, ndvi_file,
+                        season_start, season_end, buffer_degree=0.2, upsample_factor=10,
+                        era5_archive=None, land_mask_mode='center', ndvi_window=None, ndvi_overview_dir=None,
+                        dtype='float64', inputs=None):
+    """
+    Build the aligned (temperature, ndvi, land_mask) stack for one city and season.
+
+    All variables share the upsampled ERA5 grid with ascending latitude (South-up).
+    land_mask is boolean, or a float coverage fraction when land_mask_mode='fraction'.
+    Pass a shared ERA5Archive to avoid reopening the yearly ERA5 file per city.
+    NDVI is resampled from ndvi_window when given (an NDVIWindow of the study area,
+    e.g. also used for the high-res map), otherwise only the study-area window is
+    read, from the cached overview pyramid in ndvi_overview_dir if set.
+    temperature and ndvi are stored as `dtype`; 'float32' halves the memory of
+    the stack at large upsampling factors.
+    `inputs` are the already read read_stack_inputs() of the same arguments.
+    Returns None if the city is not in GADM.
+    """
+    if inputs is None:
+        inputs = read_stack_inputs(country_code, city_name, year, gadm_index, era5_folder, ndvi_file,
+                                   season_start, season_end, buffer_degree, upsample_factor,
+                                   era5_archive, ndvi_window, ndvi_overview_dir)
+    if inputs is None:
+        return None
+    city_gdf, level, temp_clipped, window = inputs['city_gdf'], inputs['level'], inputs['temp_clipped'], inputs['ndvi_window']
+
+    # Interpolate for smoother visualization (bilinear weights built once per grid pair)
+    with stage('interp') as s:
+        new_lat, new_lon = upsample_grid(temp_clipped.latitude.values, temp_clipped.longitude.values, upsample_factor)
+        upsample = regrid_operator(temp_clipped.latitude.values, temp_clipped.longitude.values, new_lat, new_lon)
+        temp_smooth = upsample.apply(temp_clipped, dtype=dtype)
+        s.shape('temp_smooth', temp_smooth)
+
+    # Rasterize the land polygons once onto the target grid
+    with stage('land_mask') as s:
+        land_mask = xr.DataArray(
+            rasterize_land(inputs['land_gdf'], new_lat, new_lon, mode=land_mask_mode),
+            coords=temp_smooth.coords,
+            dims=temp_smooth.dims
+        )
+        s.shape('land_mask', land_mask)
+
+    # --- 3. NDVI resampled onto the temperature grid ---
+    print("Processing NDVI Data...")
+    dst_shape = temp_smooth.shape
+    # from_bounds creates a North-up transform (row 0 is North)
+    dst_transform = rasterio.transform.from_bounds(
+        new_lon.min(), new_lat.min(), new_lon.max(), new_lat.max(),
+        dst_shape[1], dst_shape[0]
+    )
+
+    try:
+        with stage('ndvi_reproject') as s:
+            src = window.dataset
+            ndvi_resampled = np.zeros(dst_shape, dtype=np.float32)
+
+            reproject(
+                source=rasterio.band(src, 1),
+                destination=ndvi_resampled,
+                src_transform=src.transform,
+                src_crs=src.crs,
+                dst_transform=dst_transform,
+                dst_crs="EPSG:4326",
+                resampling=Resampling.average
+            )
+            ndvi_overview_factor = window.factor
+            s.shape('ndvi_resampled', ndvi_resampled)
+    finally:
+        if inputs['owns_window']:
+            window.close()
+
+    # Scale to [-1, 1] in place (no float64 temporaries of the whole grid)
+    ndvi_resampled = ndvi_resampled.astype(dtype, copy=False)
+    ndvi_resampled /= 254.0
+    ndvi_resampled *= 2.0
+    ndvi_resampled -= 1.0
+
+    # ndvi_resampled is North-up but temp_smooth is South-up (new_lat is ascending),
+    # so a flipped view lines it up without a sorted copy
+    xr_ndvi = xr.DataArray(
+        ndvi_resampled[::-1],
+        coords={'latitude': new_lat, 'longitude': new_lon},
+        dims=('latitude', 'longitude')
+    )
+
+    stack = xr.Dataset({
+        'temperature': temp_smooth,
+        'ndvi': xr_ndvi,
+        'land_mask': land_mask,
+    })
+    stack.attrs.update({
+        'country_code': country_code,
+        'city_name': city_name,
+        'year': year,
+        'admin_level': level,
+        'season_start': season_start,
+        'season_end': season_end,
+        'buffer_degree': buffer_degree,
+        'upsample_factor': upsample_factor,
+        'land_mask_mode': land_mask_mode,
+        'ndvi_file': ndvi_file,
+        'ndvi_overview_factor': ndvi_overview_factor,
+        'city_wkt': city_gdf.geometry.iloc[0].wkt,
+        'city_crs': str(city_gdf.crs),
+    })
+    return stack
+
+
+# ============================================================================
+# ON-DISK CACHE
+# ============================================================================
+
+def _file_signature(path):
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+
+def cache_key(params, input_files):
+    """Hash the parameters plus the size/mtime of every input file"""
+    payload = {
+        'version': CACHE_VERSION,
+        'params': params,
+        'inputs': [_file_signature(f) for f in input_files if f],
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _cache_path(cache_dir, country_code, city_name, year, key):
+    safe_city = "".join(c if c.isalnum() else "-" for c in city_name)
+    return os.path.join(cache_dir, f"{country_code}_{safe_city}_{year}_{key[:16]}.nc")
+
+
+def _cache_entries(cache_dir):
+    if not os.path.isdir(cache_dir):
+        return []
+    return [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.nc')]
+
+
+def evict_cache(cache_dir, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+    """Delete least recently used entries until the cache fits in max_bytes"""
+    entries = []
+    for path in _cache_entries(cache_dir):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:  # removed by a concurrent worker
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            removed.append(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    return removed
+
+
+def clear_cache(cache_dir, country_code=None, city_name=None):
+    """Invalidate all cached stacks, or only those of one country/city"""
+    prefix = ""
+    if country_code:
+        prefix = f"{country_code}_"
+        if city_name:
+            prefix += "".join(c if c.isalnum() else "-" for c in city_name) + "_"
+    removed = []
+    for path in _cache_entries(cache_dir):
+        if os.path.basename(path).startswith(prefix):
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+
+def _stack_cache_path(cache_dir, country_code, city_name, year, gadm_index, era5_folder, ndvi_file,
+                      season_start, season_end, buffer_degree, upsample_factor, land_mask_mode,
+                      ndvi_overview_dir, dtype):
+    temp_file = ERA5Archive(era5_folder).path(year)
+    params = {
+        'country_code': country_code, 'city_name': city_name, 'year': year,
+        'season_start': season_start, 'season_end': season_end,
+        'buffer_degree': buffer_degree, 'upsample_factor': upsample_factor,
+        'land_mask_mode': land_mask_mode,
+        'ndvi_overviews': bool(ndvi_overview_dir),
+        'dtype': str(np.dtype(dtype)),
+    }
+    key = cache_key(params, [temp_file, ndvi_file, gadm_index.gadm_file])
+    return _cache_path(cache_dir, country_code, city_name, year, key)
+
+
+def _read_cached_stack(path):
+    print(f"Loading aligned grid from cache: {os.path.basename(path)}")
+    with stage('cache_read') as s:
+        with xr.open_dataset(path) as cached:
+            stack = cached.load()
+        if stack.attrs['land_mask_mode'] != 'fraction':
+            stack['land_mask'] = stack['land_mask'].astype(bool)
+        s.shape('temperature', stack['temperature'])
+    return stack
+
+
+def prefetch_aligned_stack(country_code, city_name, year, gadm_index, era5_folder, ndvi_folder,
+                           season_start, season_end, buffer_degree=0.2, upsample_factor=10,
+                           cache_dir=None, era5_archive=None, land_mask_mode='center', ndvi_window=None,
+                           ndvi_overview_dir=None, dtype='float64'):
+    """
+    Do the reads of load_aligned_stack with the same arguments ahead of time
+    (typically on a background thread while the previous city computes): the
+    cached stack if there is a cache entry, otherwise read_stack_inputs().
+    Hand the result to load_aligned_stack(..., prefetched=...).
+    """
+    ndvi_file = resolve_ndvi_file(ndvi_folder, year, season_start, season_end)
+    if ndvi_file is None:
+        return {'inputs': None}
+    if cache_dir is not None:
+        path = _stack_cache_path(cache_dir, country_code, city_name, year, gadm_index, era5_folder, ndvi_file,
+                                 season_start, season_end, buffer_degree, upsample_factor, land_mask_mode,
+                                 ndvi_overview_dir, dtype)
+        if os.path.exists(path):
+            return {'stack': _read_cached_stack(path), 'path': path}
+    return {'inputs': read_stack_inputs(country_code, city_name, year, gadm_index, era5_folder, ndvi_file,
+                                        season_start, season_end, buffer_degree, upsample_factor,
+                                        era5_archive, ndvi_window, ndvi_overview_dir)}
+
+
+def load_aligned_stack(country_code, city_name, year, gadm_index, era5_folder, ndvi_folder,
+                       season_start, season_end, buffer_degree=0.2, upsample_factor=10,
+                       cache_dir=None, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES,
+                       era5_archive=None, land_mask_mode='center', ndvi_window=None, ndvi_overview_dir=None,
+                       dtype='float64', prefetched=None):
+    """
+    Return the aligned stack, reading it from cache_dir when the parameters and
+    input files are unchanged. Without cache_dir the stack is always rebuilt.
+    ndvi_window is only used when the stack has to be built. `prefetched` is the
+    result of prefetch_aligned_stack() for the same arguments; its reads are then
+    not repeated.
+    """
+    ndvi_file = resolve_ndvi_file(ndvi_folder, year, season_start, season_end)
+    if ndvi_file is None:
+        print("No NDVI file found.")
+        return None
+
+    inputs = None
+    if prefetched is not None:
+        if 'stack' in prefetched:
+            os.utime(prefetched['path'])  # mark as recently used for eviction
+            return prefetched['stack']
+        inputs = prefetched['inputs']
+        if inputs is None:  # city not in GADM, already reported by the prefetch
+            return None
+
+    if cache_dir is None:
+        return build_aligned_stack(country_code, city_name, year, gadm_index, era5_folder, ndvi_file,
+                                   season_start, season_end, buffer_degree, upsample_factor,
+                                   era5_archive, land_mask_mode, ndvi_window, ndvi_overview_dir, dtype, inputs)
+
+    path = _stack_cache_path(cache_dir, country_code, city_name, year, gadm_index, era5_folder, ndvi_file,
+                             season_start, season_end, buffer_degree, upsample_factor, land_mask_mode,
+                             ndvi_overview_dir, dtype)
+
+    if inputs is None and os.path.exists(path):
+        stack = _read_cached_stack(path)
+        os.utime(path)  # mark as recently used for eviction
+        return stack
+
+    stack = build_aligned_stack(country_code, city_name, year, gadm_index, era5_folder, ndvi_file,
+                                season_start, season_end, buffer_degree, upsample_factor,
+                                era5_archive, land_mask_mode, ndvi_window, ndvi_overview_dir, dtype, inputs)
+    if stack is None:
+        return None
+
+    os.makedirs(cache_dir, exist_ok=True)
+    encoding = {name: {'zlib': True, 'complevel': 4} for name in stack.data_vars}
+    tmp_path = path + ".tmp"
+    to_write = stack
+    if land_mask_mode != 'fraction':
+        to_write = stack.assign(land_mask=stack['land_mask'].astype('uint8'))
+    with stage('cache_write'):
+        to_write.to_netcdf(tmp_path, encoding=encoding, format='NETCDF4', engine='netcdf4')
+    os.replace(tmp_path, path)
+    print(f"Cached aligned grid: {os.path.basename(path)}")
+
+    evict_cache(cache_dir, max_cache_bytes)
+    return stack
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Manage the aligned ERA5/NDVI grid cache")
+    parser.add_argument('--cache-dir', default=os.path.join("data", "cache", "aligned"))
+    parser.add_argument('--clear', action='store_true', help="Remove cached stacks")
+    parser.add_argument('--country', help="Only clear entries of this GID_0 code")
+    parser.add_argument('--city', help="Only clear entries of this city (needs --country)")
+    parser.add_argument('--max-gb', type=float, help="Evict least recently used entries down to this size")
+    args = parser.parse_args()
+
+    if args.clear:
+        removed = clear_cache(args.cache_dir, args.country, args.city)
+        print(f"Removed {len(removed)} cached stacks from {args.cache_dir}")
+    if args.max_gb is not None:
+        removed = evict_cache(args.cache_dir, int(args.max_gb * 1024**3))
+        print(f"Evicted {len(removed)} cached stacks from {args.cache_dir}")
+
+    entries = _cache_entries(args.cache_dir)
+    total = sum(os.path.getsize(f) for f in entries)
+    print(f"Cache: {len(entries)} entries, {total / 1024**2:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import os
+import json
+import platform
+import tempfile
+import argparse
+from datetime import datetime, timezone
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import pandas as pd
+import xarray as xr
+import rasterio
+
+from era5_access import ERA5Archive
+from gadm_index import GADMIndex
+from figures import FigureRenderer
+from instrumentation import Tracer, read_trace
+from synthetic_data import SIZES, make_dataset
+from week2_team19 import analyze_city
+from week3_team19 import analyze_city_week3
+
+# Bump when the stages of a report change, so reports are only compared like for like
+BENCHMARK_VERSION = 2
+UPSAMPLE_FACTOR = 10
+# The analysis functions timed, keyed by the prefix of their stage names
+ANALYSES = {'week2': analyze_city, 'week3': analyze_city_week3}
+
+
+def _stage_key(analysis, record):
+    """Report name of a traced stage, e.g. week2/aligned_stack/interp"""
+    parent = record.get('parent')
+    name = record['stage'] if parent in (None, 'total') else f"{parent}/{record['stage']}"
+    return f"{analysis}/{name}"
+
+
+def _run_stages(run):
+    """(key, record) of every stage of a traced run, plus the whole run as <analysis>/total"""
+    yield f"{run['analysis']}/total", run
+    for record in run['stages']:
+        yield _stage_key(run['analysis'], record), record
+
+
+# ============================================================================
+# RUNNER
+# ============================================================================
+
+def benchmark_size(size, root, year=2022, repeat=3, stages=None, render=True, seed=0,
+                   upsample_factor=UPSAMPLE_FACTOR, dtype='float64'):
+    """
+    Time the stages of analyze_city and analyze_city_week3 for every city of one
+    synthetic size.
+
+    The functions run as in week2/week3 (no stack cache, figures rendered inline
+    unless render=False) under a Tracer, so the stages are the ones their code
+    marks. The first pass also traces allocations (slower); the timings come from
+    the remaining repeat - 1 passes (or the traced one if repeat == 1). `stages`
+    restricts the report to these stage names. Returns {'params', 'cities',
+    'stages': {stage: {...}}}.
+    """
+    description = make_dataset(os.path.join(root, size), size, years=(year,), seed=seed)
+    gadm_index = GADMIndex(description['gadm_file'])
+    renderer = FigureRenderer('all' if render else 'none')
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        trace_file = os.path.join(work_dir, "trace.jsonl")
+        for rep in range(repeat):
+            tracer = Tracer(trace_file, trace_memory=rep == 0)
+            for country, city in description['cities']:
+                for analysis, analyze_fn in ANALYSES.items():
+                    # A fresh archive per run so ERA5 file opening is part of the load stage
+                    with ERA5Archive(description['era5_folder']) as archive, \
+                            tracer.run(city=city, analysis=analysis, rep=rep):
+                        analyze_fn(country, city, year, gadm_index, description['era5_folder'],
+                                   description['ndvi_folder'], work_dir, era5_archive=archive, raise_errors=True,
+                                   renderer=renderer, upsample_factor=upsample_factor, dtype=dtype)
+        trace = read_trace(trace_file)
+    renderer.close()
+
+    memory, runs = {}, {}
+    for run in trace:
+        for key, record in _run_stages(run):
+            if stages is None or key.rsplit('/', 1)[-1] in stages:
+                (memory if run['rep'] == 0 else runs).setdefault(key, []).append(dict(record, city=run['city']))
+    if repeat == 1:
+        runs = memory
+
+    summary = {}
+    for name, records in runs.items():
+        wall = np.array([r['wall_s'] for r in records])
+        cpu = np.array([r['cpu_s'] for r in records])
+        traced = memory.get(name, [])
+        summary[name] = {
+            'wall_s_median': float(np.median(wall)), 'wall_s_min': float(wall.min()),
+            'wall_s_total': float(wall.sum()) / max(repeat - 1, 1),
+            'cpu_s_median': float(np.median(cpu)),
+            'alloc_peak_mb_max': max((r.get('alloc_peak_mb', np.nan) for r in traced), default=np.nan),
+            'rss_peak_mb': max(r['rss_peak_mb'] for r in records + traced),
+            'bytes_read_median': float(np.median([r.get('bytes_read', np.nan) for r in records])),
+            'shapes': {r['city']: r.get('shapes', {}) for r in traced},
+            'runs': records,
+        }
+    return {'params': description['params'], 'cities': description['cities'], 'upsample_factor': upsample_factor,
+            'dtype': dtype, 'stages': summary}
+
+
+def environment():
+    import scipy
+    import geopandas
+    return {
+        'python': platform.python_version(), 'platform': platform.platform(), 'machine': platform.machine(),
+        'cpu_count': os.cpu_count(), 'numpy': np.__version__, 'pandas': pd.__version__,
+        'xarray': xr.__version__, 'rasterio': rasterio.__version__, 'scipy': scipy.__version__,
+        'geopandas': geopandas.__version__,
+    }
+
+
+def compare_reports(current, baseline):
+    """Per size and stage median wall-time ratio current / baseline (< 1 is faster)"""
+    rows = []
+    for size, result in current['sizes'].items():
+        base = baseline['sizes'].get(size, {}).get('stages', {})
+        for stage, stats in result['stages'].items():
+            if stage in base:
+                rows.append({'size': size, 'stage': stage, 'baseline_s': base[stage]['wall_s_median'],
+                             'current_s': stats['wall_s_median'],
+                             'ratio': stats['wall_s_median'] / base[stage]['wall_s_median']})
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the week2/week3 pipeline stages on synthetic data")
+    parser.add_argument('--sizes', nargs='+', choices=tuple(SIZES), default=['small'])
+    parser.add_argument('--stages', nargs='+',
+                        help="Only report these stages (e.g. interp statistics total); every stage still runs")
+    parser.add_argument('--repeat', type=int, default=3, help="Passes per size (the first one traces memory)")
+    parser.add_argument('--upsample', type=int, default=UPSAMPLE_FACTOR, help="ERA5 upsampling factor (pixels per cell)")
+    parser.add_argument('--float32', action='store_true', help="Build the aligned grid in float32, as week2/week3 --float32")
+    parser.add_argument('--no-render', action='store_true', help="Skip the figures")
+    parser.add_argument('--data-root', default=os.path.join("data", "synthetic"))
+    parser.add_argument('--out', help="Report JSON (default: reports/benchmarks/benchmark_<timestamp>.json)")
+    parser.add_argument('--compare', help="Earlier report to compare median stage times against")
+    args = parser.parse_args()
+
+    print("="*60)
+    print("PIPELINE BENCHMARK (synthetic data)")
+    print("="*60)
+
+    OUTPUT_FOLDER = os.path.join("reports", "benchmarks")
+    stamp = datetime.now(timezone.utc)
+    report = {'benchmark_version': BENCHMARK_VERSION, 'created': stamp.isoformat(), 'environment': environment(),
+              'repeat': args.repeat, 'sizes': {}}
+    for size in args.sizes:
+        print(f"\n--- {size} ---")
+        result = benchmark_size(size, args.data_root, repeat=args.repeat, stages=args.stages,
+                                render=not args.no_render, upsample_factor=args.upsample,
+                                dtype='float32' if args.float32 else 'float64')
+        report['sizes'][size] = result
+        width = max((len(stage) for stage in result['stages']), default=0)
+        for stage, stats in result['stages'].items():
+            print(f"  {stage:<{width}} {stats['wall_s_median'] * 1000:9.1f} ms  cpu {stats['cpu_s_median'] * 1000:9.1f} ms  "
+                  f"alloc peak {stats['alloc_peak_mb_max']:8.1f} MB")
+
+    out_file = args.out or os.path.join(OUTPUT_FOLDER, f"benchmark_{stamp:%Y%m%dT%H%M%S}.json")
+    os.makedirs(os.path.dirname(out_file) or ".", exist_ok=True)
+    with open(out_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nReport saved: {out_file}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            table = compare_reports(report, json.load(f))
+        print("\n--- Compared with", args.compare, "---")
+        print(table.to_string(index=False, float_format=lambda v: f"{v:.3f}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+import os
+import argparse
+import joblib
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4
+from rasterio.warp import reproject, Resampling
+from sklearn.ensemble import RandomForestRegressor
+
+from era5_access import ERA5Archive
+from gadm_index import GADMIndex
+from landmask import grid_transform
+from ndvi_access import read_ndvi_window, ndvi_from_raw
+from aligned_grid import resolve_ndvi_file
+from station_extract import load_orography
+from spatial_features import SpatialFeatureEngine, city_points
+
+SEASONS = ('Winter', 'Spring', 'Summer', 'Fall')
+SEASON_OF_MONTH = {12: 'Winter', 1: 'Winter', 2: 'Winter', 3: 'Spring', 4: 'Spring', 5: 'Spring',
+                   6: 'Summer', 7: 'Summer', 8: 'Summer', 9: 'Fall', 10: 'Fall', 11: 'Fall'}
+# Station-level features of the week4 error model, in training order (season one-hot columns follow)
+BASE_FEATURES = ['ndvi_mean', 'elevation', 'lat', 'lon', 'distance_to_city_km', 'distance_to_coast_km',
+                 'mean_station_temp']
+# Random Forest hyperparameters of week4 (Model 2)
+RF_PARAMS = {
+    'n_estimators': 200,
+    'max_depth': 15,
+    'min_samples_split': 5,
+    'min_samples_leaf': 2,
+    'random_state': 42,
+    'n_jobs': -1
+}
+
+
+# ============================================================================
+# MODEL
+# ============================================================================
+
+def dominant_season(df):
+    """Season with the most observed days per station (week4's get_dominant_season, vectorized)"""
+    days = df.reindex(columns=[f'n_days_{s}' for s in SEASONS]).fillna(0)
+    season = pd.Series(np.array(SEASONS)[days.to_numpy().argmax(axis=1)], index=df.index)
+    return season.where(days.to_numpy().max(axis=1) > 0, 'Summer')
+
+
+def train_model(master_csv, n_jobs=-1):
+    """
+    Fit the week4 Random Forest bias model (bias = ERA5 - station) on all stations of
+    master_dataset.csv. Returns a bundle {'model', 'feature_columns', ...} for save_model.
+    """
+    df = pd.read_csv(master_csv)
+    df['season'] = dominant_season(df)
+    df = pd.concat([df, pd.get_dummies(df['season'], prefix='season')], axis=1)
+    feature_columns = BASE_FEATURES + [c for c in df.columns if c.startswith('season_')]
+    df_clean = df[feature_columns + ['bias']].dropna()
+
+    model = RandomForestRegressor(**dict(RF_PARAMS, n_jobs=n_jobs))
+    model.fit(df_clean[feature_columns].to_numpy(dtype=float), df_clean['bias'].to_numpy())
+    print(f"Trained Random Forest on {len(df_clean)} stations, {len(feature_columns)} features")
+    return {'model': model, 'feature_columns': feature_columns, 'n_samples': len(df_clean),
+            'trained_on': os.path.abspath(master_csv)}
+
+
+def save_model(bundle, model_path):
+    os.makedirs(os.path.dirname(model_path) or ".", exist_ok=True)
+    tmp_path = model_path + f".{os.getpid()}.tmp"
+    joblib.dump(bundle, tmp_path, compress=3)
+    os.replace(tmp_path, model_path)
+
+
+def load_model(model_path):
+    bundle = joblib.load(model_path)
+    missing = [c for c in BASE_FEATURES if c not in bundle['feature_columns']]
+    if missing:
+        raise ValueError(f"Model {model_path} lacks the grid features {missing}")
+    return bundle
+
+
+# ============================================================================
+# GRID FEATURES
+# ============================================================================
+
+def ndvi_on_grid(ndvi_file, lat, lon, overview_dir=None):
+    """Cell-average NDVI (-1..1, NaN without data) on the (lat, lon) grid, oriented like lat"""
+    transform = grid_transform(lat, lon)
+    north, west = transform.f, transform.c
+    south, east = north + transform.e * len(lat), west + transform.a * len(lon)
+    ndvi = np.full((len(lat), len(lon)), np.nan, dtype=np.float32)
+    with read_ndvi_window(ndvi_file, (west, south, east, north), overview_dir=overview_dir,
+                          target_res=transform.a) as window:
+        src = window.dataset
+        values = ndvi_from_raw(src.read(1), src.nodata, dtype=np.float32)
+        reproject(source=values, destination=ndvi, src_transform=src.transform, src_crs=src.crs,
+                  src_nodata=np.nan, dst_transform=transform, dst_crs="EPSG:4326", dst_nodata=np.nan,
+                  resampling=Resampling.average)
+    # grid_transform is North-up
+    return ndvi[::-1] if lat[0] < lat[-1] else ndvi
+
+
+def mean_temperature(window, time_chunk=31):
+    """Mean over time (°C) of a lazy t2m window, reading time_chunk days at a time"""
+    total = np.zeros(window.shape[1:])
+    count = np.zeros(window.shape[1:])
+    for t0 in range(0, window.sizes['valid_time'], time_chunk):
+        block = window.isel(valid_time=slice(t0, t0 + time_chunk)).values
+        valid = np.isfinite(block)
+        total += np.where(valid, block, 0.0).sum(axis=0)
+        count += valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / count - 273.15
+
+
+def grid_distances(window, feature_engine):
+    """
+    Distances to the nearest city and to the coast (km) of every cell of an ERA5
+    window, as a float32 (latitude, longitude) Dataset, from feature_engine (a
+    SpatialFeatureEngine with cities and GADM). Computed once for the whole window,
+    so the coastline is extracted and the feature cache written once.
+    """
+    lat = window.latitude.values
+    lon = window.longitude.values
+    lat2d, lon2d = np.meshgrid(lat, lon, indexing='ij')
+    distances = feature_engine.compute(lat2d.ravel(), lon2d.ravel(), groups=('city', 'coast'))
+    return xr.Dataset({name: (('latitude', 'longitude'),
+                              distances[name].to_numpy(dtype=np.float32).reshape(lat2d.shape))
+                       for name in ('distance_to_city_km', 'distance_to_coast_km')},
+                      coords={'latitude': lat, 'longitude': lon})
+
+
+def grid_features(window, distances, ndvi_file, grid_elevation, ndvi_overview_dir=None, time_chunk=31):
+    """
+    The week4 station features for every cell of an ERA5 window, as a float32
+    (latitude, longitude) Dataset. predict_bias calls it one latitude band at a time.
+
+    distances is the grid_distances Dataset of a window containing this one (the
+    band's cells are selected from it). mean_station_temp has no station on the
+    grid; the cell's mean ERA5 Tmax of the window is used instead.
+    """
+    lat = window.latitude.values
+    lon = window.longitude.values
+    lat2d, lon2d = np.meshgrid(lat, lon, indexing='ij')
+    template = window.isel(valid_time=0, drop=True)
+    elevation = grid_elevation.reindex_like(template, method='nearest', tolerance=1e-3)
+    distances = distances.sel(latitude=lat, longitude=lon)
+
+    features = {
+        'ndvi_mean': ndvi_on_grid(ndvi_file, lat, lon, ndvi_overview_dir),
+        'elevation': elevation.values,
+        'lat': lat2d,
+        'lon': lon2d,
+        'distance_to_city_km': distances['distance_to_city_km'].values,
+        'distance_to_coast_km': distances['distance_to_coast_km'].values,
+        'mean_station_temp': mean_temperature(window, time_chunk),
+    }
+    return xr.Dataset({name: (('latitude', 'longitude'), np.asarray(values, dtype=np.float32))
+                       for name, values in features.items()},
+                      coords={'latitude': lat, 'longitude': lon})
+
+
+# ============================================================================
+# INFERENCE
+# ============================================================================
+
+def predict_bias(bundle, window, features_of, chunk_rows=64, n_jobs=-1):
+    """
+    Predicted ERA5 - station bias per season and cell of window, (season, latitude, longitude).
+
+    Latitude bands of chunk_rows rows are handled at a time: features_of(band)
+    returns the features of a band of the window (grid_features), so only one
+    band's features and NDVI read are held in memory. Each band is predicted with
+    four season rows per cell; the forest's trees are evaluated in parallel with
+    n_jobs. Cells with a missing feature (sea, no NDVI) are NaN.
+    """
+    model = bundle['model']
+    columns = bundle['feature_columns']
+    model.set_params(n_jobs=n_jobs)
+    n_lat, n_lon = window.sizes['latitude'], window.sizes['longitude']
+    bias = np.full((len(SEASONS), n_lat, n_lon), np.nan, dtype=np.float32)
+
+    for r0 in range(0, n_lat, chunk_rows):
+        band = features_of(window.isel(latitude=slice(r0, r0 + chunk_rows)))
+        base = np.column_stack([band[name].values.ravel() for name in BASE_FEATURES]).astype(float)
+        valid = np.isfinite(base).all(axis=1)
+        if not valid.any():
+            continue
+        base = base[valid]
+        rows = []
+        for season in SEASONS:
+            x = np.zeros((len(base), len(columns)))
+            x[:, :len(BASE_FEATURES)] = base
+            if f'season_{season}' in columns:
+                x[:, columns.index(f'season_{season}')] = 1.0
+            rows.append(x)
+        predicted = model.predict(np.concatenate(rows)).reshape(len(SEASONS), -1)
+        n_rows = band.sizes['latitude']
+        out = np.full((len(SEASONS), n_rows * n_lon), np.nan, dtype=np.float32)
+        out[:, valid] = predicted
+        bias[:, r0:r0 + n_rows] = out.reshape(len(SEASONS), n_rows, n_lon)
+    return bias
+
+
+def _copy_coordinate(nc, da, name):
+    """Copy one coordinate of da to nc, keeping the source time encoding"""
+    coord = da[name]
+    is_time = np.issubdtype(coord.dtype, np.datetime64)
+    if is_time:
+        units = coord.encoding.get('units', 'seconds since 1970-01-01')
+        calendar = coord.encoding.get('calendar', 'proleptic_gregorian')
+        var = nc.createVariable(name, 'f8', (name,))
+        var.units, var.calendar = units, calendar
+        var[:] = netCDF4.date2num(pd.DatetimeIndex(coord.values).to_pydatetime(), units, calendar)
+    else:
+        var = nc.createVariable(name, coord.dtype, (name,))
+        var[:] = coord.values
+    for key, value in coord.attrs.items():
+        if not (is_time and key in ('units', 'calendar')):
+            var.setncattr(key, value)
+
+
+def write_corrected(window, bias, out_file, time_chunk=31):
+    """
+    Write window - bias[season of day] to out_file, time_chunk days at a time, with
+    the window's coordinates, plus the seasonal bias field (predicted_bias).
+    """
+    os.makedirs(os.path.dirname(out_file) or ".", exist_ok=True)
+    dates = pd.DatetimeIndex(window.valid_time.values)
+    season_index = np.array([SEASONS.index(SEASON_OF_MONTH[m]) for m in dates.month])
+
+    tmp_path = out_file + f".{os.getpid()}.tmp"
+    with netCDF4.Dataset(tmp_path, 'w', format='NETCDF4') as nc:
+        nc.createDimension('valid_time', len(dates))
+        nc.createDimension('latitude', window.sizes['latitude'])
+        nc.createDimension('longitude', window.sizes['longitude'])
+        nc.createDimension('season', len(SEASONS))
+        for name in ('valid_time', 'latitude', 'longitude'):
+            _copy_coordinate(nc, window, name)
+        season = nc.createVariable('season', str, ('season',))
+        for i, name in enumerate(SEASONS):
+            season[i] = name
+
+        n_lat, n_lon = window.sizes['latitude'], window.sizes['longitude']
+        t2m = nc.createVariable('t2m_corrected', 'f4', ('valid_time', 'latitude', 'longitude'),
+                                zlib=True, complevel=4, chunksizes=(1, n_lat, n_lon), fill_value=np.float32(np.nan))
+        t2m.units = window.attrs.get('units', 'K')
+        t2m.long_name = f"{window.attrs.get('long_name', '2 metre temperature')} (ML bias-corrected)"
+        b = nc.createVariable('predicted_bias', 'f4', ('season', 'latitude', 'longitude'),
+                              zlib=True, complevel=4, fill_value=np.float32(np.nan))
+        b.units = 'K'
+        b.long_name = "Predicted ERA5 - station bias"
+        b[:] = bias
+
+        for t0 in range(0, len(dates), time_chunk):
+            block = window.isel(valid_time=slice(t0, t0 + time_chunk)).values
+            t2m[t0:t0 + len(block)] = (block - bias[season_index[t0:t0 + len(block)]]).astype(np.float32)
+    os.replace(tmp_path, out_file)
+    return out_file
+
+
+def correct_year(era5_archive, year, bundle, feature_engine, ndvi_file, grid_elevation, out_file,
+                 bounds=None, ndvi_overview_dir=None, chunk_rows=64, time_chunk=31, n_jobs=-1):
+    """Bias-correct one ERA5 year (optionally cut to bounds) and write it to out_file"""
+    if bounds is None:
+        window = era5_archive.dataset(year)[era5_archive.variable]
+    else:
+        window = era5_archive.window(year, bounds)
+    print(f"ERA5 {year}: {window.sizes['valid_time']} days x {window.sizes['latitude']} x {window.sizes['longitude']} cells")
+
+    print("Measuring distances to cities and coast...")
+    distances = grid_distances(window, feature_engine)
+    print("Building grid features and predicting bias...")
+    bias = predict_bias(bundle, window,
+                        lambda band: grid_features(band, distances, ndvi_file, grid_elevation,
+                                                   ndvi_overview_dir, time_chunk),
+                        chunk_rows, n_jobs)
+    print(f"  {int(np.isfinite(bias[0]).sum())} cells, mean bias {np.nanmean(bias):+.2f}°C")
+    print("Writing corrected temperature...")
+    return write_corrected(window, bias, out_file, time_chunk)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply the week4 Random Forest bias correction to ERA5 grids")
+    parser.add_argument('--year', type=int, default=2022)
+    parser.add_argument('--model', default=os.path.join("data", "models", "bias_rf.joblib"))
+    parser.add_argument('--train', action='store_true', help="Fit the model on the master dataset first")
+    parser.add_argument('--master', default=os.path.join("notebooks", "week3", "master_dataset.csv"),
+                        help="week3 master_dataset.csv used by --train")
+    parser.add_argument('--orography', required=True, help="ERA5-Land geopotential NetCDF")
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('MINX', 'MINY', 'MAXX', 'MAXY'),
+                        help="Correct only this box (default: the whole ERA5 grid)")
+    parser.add_argument('--city', action='append', metavar='GID_0:NAME',
+                        help="City for distance_to_city_km (repeatable, default: the week4 cities)")
+    parser.add_argument('--out', help="Output NetCDF")
+    parser.add_argument('--n-jobs', type=int, default=-1)
+    parser.add_argument('--chunk-rows', type=int, default=64, help="Latitude rows featurized and predicted at a time")
+    parser.add_argument('--time-chunk', type=int, default=31, help="Days held in memory at a time")
+    parser.add_argument('--ndvi-overviews', action=argparse.BooleanOptionalAction, default=True,
+                        help="Resample NDVI from the cached pyramid (default) rather than the full-resolution mosaic")
+    args = parser.parse_args()
+
+    print("="*60)
+    print("ERA5 ML BIAS CORRECTION")
+    print("="*60)
+
+    DATA_FOLDER = "data"
+    GADM_FILE = os.path.join(DATA_FOLDER, "gadm_410_europe.gpkg")
+    ERA5_FOLDER = os.path.join(DATA_FOLDER, "derived-era5-land-daily-statistics")
+    NDVI_FOLDER = os.path.join(DATA_FOLDER, "sentinel2_ndvi")
+    GADM_INDEX_FILE = os.path.join(DATA_FOLDER, "cache", "gadm_index.pkl")
+    NDVI_OVERVIEW_FOLDER = os.path.join(DATA_FOLDER, "cache", "ndvi_overviews")
+    FEATURE_CACHE_FOLDER = os.path.join(DATA_FOLDER, "cache", "spatial_features")
+    OUTPUT_FOLDER = os.path.join(DATA_FOLDER, "derived")
+
+    # Cities of the week4 training stations
+    cities = [
+        ("DEU", "Berlin"),
+        ("FRA", "Paris"),
+        ("ITA", "Milano"),
+        ("POL", "Warszawa"),
+        ("ESP", "Madrid")
+    ]
+    if args.city:
+        cities = [tuple(c.split(':', 1)) for c in args.city]
+
+    if args.train:
+        save_model(train_model(args.master, args.n_jobs), args.model)
+        print(f"Model saved: {args.model}")
+    bundle = load_model(args.model)
+
+    gadm_index = GADMIndex(GADM_FILE, index_file=GADM_INDEX_FILE)
+    cities = city_points(gadm_index, cities)
+    if cities.empty:
+        raise ValueError("None of the cities were found in GADM; distance_to_city_km cannot be computed")
+    feature_engine = SpatialFeatureEngine(gadm_index=gadm_index, cities=cities, cache_dir=FEATURE_CACHE_FOLDER)
+
+    ndvi_file = resolve_ndvi_file(NDVI_FOLDER, args.year, f"{args.year}-06-01", f"{args.year}-09-01")
+    if ndvi_file is None:
+        raise FileNotFoundError(f"No NDVI file for {args.year} in {NDVI_FOLDER}")
+
+    out_file = args.out or os.path.join(OUTPUT_FOLDER, f"{args.year}_2m_temperature_daily_maximum_bias_corrected.nc")
+    with ERA5Archive(ERA5_FOLDER) as archive:
+        correct_year(archive, args.year, bundle, feature_engine, ndvi_file, load_orography(args.orography),
+                     out_file, bounds=args.bbox,
+                     ndvi_overview_dir=NDVI_OVERVIEW_FOLDER if args.ndvi_overviews else None,
+                     chunk_rows=args.chunk_rows, time_chunk=args.time_chunk, n_jobs=args.n_jobs)
+    print(f"\nBias-corrected ERA5 saved: {out_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+import os
+import time
+import inspect
+import traceback
+from glob import glob
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from era5_access import ERA5Archive
+from gadm_index import GADMIndex
+from figures import FigureRenderer
+from run_manifest import unit_key
+from instrumentation import Tracer
+
+# analyze_fn arguments that do not change a unit's results
+_NON_RESULT_PARAMS = ('cache_dir', 'era5_archive', 'raise_errors', 'prefetched')
+
+# Read-only inputs shared by every task of a process (built once per worker)
+_CONTEXT = {}
+
+
+def _init_context(gadm_file, gadm_index_file, era5_folder):
+    import matplotlib
+    matplotlib.use('Agg')
+    _CONTEXT['gadm_index'] = GADMIndex(gadm_file, index_file=gadm_index_file)
+    _CONTEXT['era5_archive'] = ERA5Archive(era5_folder)
+
+
+def _run_task(analyze_fn, country_code, city_name, year, era5_folder, ndvi_folder, output_folder, kwargs,
+              tracer=None, prefetch_stages=None):
+    """Run one (city, year) unit and return a structured record instead of raising"""
+    record = {'country': country_code, 'city': city_name, 'year': year, 'pid': os.getpid()}
+    renderer = kwargs.get('renderer')
+    n_outputs = len(renderer.outputs) if isinstance(renderer, FigureRenderer) else 0
+    start = time.perf_counter()
+    run = tracer.run(script=analyze_fn.__name__, country=country_code, city=city_name, year=year) \
+        if tracer is not None else nullcontext()
+    try:
+        with run:
+            if prefetch_stages and tracer.enabled:
+                tracer.extend(prefetch_stages, prefetched=True)
+            stats = analyze_fn(country_code, city_name, year, _CONTEXT['gadm_index'], era5_folder, ndvi_folder,
+                               output_folder, era5_archive=_CONTEXT['era5_archive'], raise_errors=True, **kwargs)
+            if stats is None and hasattr(run, 'fields'):
+                run.fields['status'] = 'skipped'
+        record['status'] = 'ok' if stats is not None else 'skipped'
+        record['stats'] = stats
+        record['error'] = None
+    except Exception as e:
+        record['status'] = 'failed'
+        record['stats'] = None
+        record['error'] = f"{type(e).__name__}: {e}"
+        record['traceback'] = traceback.format_exc()
+    record['seconds'] = time.perf_counter() - start
+    record['outputs'] = renderer.outputs[n_outputs:] if isinstance(renderer, FigureRenderer) else []
+    return record
+
+
+def _close_windows(obj, closed=None):
+    """Close the NDVI windows ('ndvi_window' entries, at any depth) of prefetched data, once each"""
+    closed = set() if closed is None else closed
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if key == 'ndvi_window' and value is not None and id(value) not in closed:
+                closed.add(id(value))
+                value.close()
+            else:
+                _close_windows(value, closed)
+
+
+def _nbytes(obj):
+    """Rough in-memory size of prefetched data (arrays, xarray objects, NDVI windows, dicts of them)"""
+    if isinstance(obj, dict):
+        return sum(_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(v) for v in obj)
+    return getattr(obj, 'nbytes', 0) or 0
+
+
+class Prefetcher:
+    """
+    Reads ahead for the next tasks on background threads while the current task
+    computes (netCDF4 and GDAL release the GIL while reading).
+
+    prefetch_fn(country_code, city_name, year, gadm_index, era5_folder, ndvi_folder,
+    era5_archive=..., **kwargs) does the reads of one task; take(k) returns its
+    result for task k. At most `depth` tasks are read ahead of the current one,
+    and no new read starts while finished but not yet used reads hold more than
+    max_bytes (backpressure). A failed read returns None, so the task repeats the
+    read itself and reports the error. With a tracer, the stages of each read are
+    collected on its thread and returned by take() for the task's trace record.
+    """
+
+    def __init__(self, prefetch_fn, tasks, era5_folder, ndvi_folder, kwargs, depth=1, max_bytes=1024**3,
+                 tracer=None):
+        self.prefetch_fn = prefetch_fn
+        self.tasks = tasks
+        self.args = (era5_folder, ndvi_folder)
+        self.kwargs = kwargs
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.tracer = tracer
+        self._pool = ThreadPoolExecutor(max_workers=max(depth, 1), thread_name_prefix='prefetch')
+        self._futures = {}
+
+    def _fetch(self, k):
+        country, city, year = self.tasks[k]
+        collector = self.tracer.collector() if self.tracer is not None else Tracer(enabled=False)
+        with collector.collect():
+            data = self.prefetch_fn(country, city, year, _CONTEXT['gadm_index'], *self.args,
+                                    era5_archive=_CONTEXT['era5_archive'], **self.kwargs)
+        return data, collector.stages
+
+    def _top_up(self, current):
+        held = sum(_nbytes(f.result()[0]) for k, f in self._futures.items()
+                   if k > current and f.done() and f.exception() is None)
+        for k in range(current, min(current + self.depth + 1, len(self.tasks))):
+            if k in self._futures:
+                continue
+            if k > current and held >= self.max_bytes:
+                break
+            self._futures[k] = self._pool.submit(self._fetch, k)
+
+    def take(self, k):
+        """(prefetched data of task k or None, seconds spent waiting for it, traced stages of the read)"""
+        self._top_up(k)
+        start = time.perf_counter()
+        try:
+            data, stages = self._futures.pop(k).result()
+        except Exception:
+            data, stages = None, []
+        return data, time.perf_counter() - start, stages
+
+    def close(self):
+        """Stop reading ahead; reads never taken (the run stopped early) have their NDVI windows closed"""
+        for future in self._futures.values():
+            future.cancel()
+        self._pool.shutdown(wait=True)
+        for future in self._futures.values():
+            if not future.cancelled() and future.exception() is None:
+                _close_windows(future.result()[0])
+        self._futures = {}
+
+
+def unit_params(analyze_fn, kwargs):
+    """The analyze_fn options (given or default) that define a unit's results, as plain values"""
+    params = {}
+    for name, p in inspect.signature(analyze_fn).parameters.items():
+        if p.default is inspect.Parameter.empty or name in _NON_RESULT_PARAMS:
+            continue
+        value = kwargs.get(name, p.default)
+        if isinstance(value, FigureRenderer):
+            value = value.mode
+        if value is None or isinstance(value, (str, int, float, bool, tuple, list)):
+            params[name] = value
+    return params
+
+
+def unit_inputs(gadm_file, era5_folder, ndvi_folder, year):
+    """Input files a (city, year) unit can read: the GADM file, the ERA5 year and that year's NDVI"""
+    files = [gadm_file, ERA5Archive(era5_folder).path(year)] + sorted(glob(os.path.join(ndvi_folder, f"*{year}*.tif")))
+    return [f for f in files if os.path.exists(f)]
+
+
+def run_cities(analyze_fn, tasks, gadm_file, era5_folder, ndvi_folder, output_folder,
+               workers=1, gadm_index_file=None, tracer=None, manifest=None, retry_failed=False, rerun=False,
+               prefetch_fn=None, prefetch_depth=1, prefetch_max_bytes=1024**3, **kwargs):
+    """
+    Run analyze_fn for every (country_code, city_name, year) task.
+
+    With workers > 1 the tasks are spread over a process pool; the GADM index and
+    the ERA5 handles are loaded once per worker by the pool initializer rather than
+    pickled with each task. Returns one record per task, in task order, with
+    status 'ok', 'skipped' (city or NDVI not found) or 'failed' (error + traceback).
+    With an instrumentation.Tracer, each task also appends its per-stage timings
+    to the tracer's trace file.
+
+    With a run_manifest.RunManifest, every finished task is logged right away,
+    and tasks whose parameters and input files (size, mtime) are unchanged since
+    their last logged run are not run again: their logged record is returned
+    instead (with resumed=True). retry_failed reruns the tasks whose last run failed, rerun
+    runs (and logs) every task.
+
+    With prefetch_fn (and workers <= 1), the reads of the next prefetch_depth
+    tasks run on background threads while the current task computes (see
+    Prefetcher); the task receives them as analyze_fn(..., prefetched=...).
+    Worker processes already overlap one city's reads with another's compute.
+    """
+    tasks = list(tasks)
+    init_args = (gadm_file, gadm_index_file, era5_folder)
+    records = [None] * len(tasks)
+    units = [None] * len(tasks)
+    todo = list(range(len(tasks)))
+
+    if manifest is not None:
+        params = unit_params(analyze_fn, kwargs)
+        todo = []
+        for i, (country, city, year) in enumerate(tasks):
+            key = unit_key(analyze_fn.__name__, country, city, year)
+            fingerprint, inputs = manifest.fingerprint(params, unit_inputs(gadm_file, era5_folder, ndvi_folder, year))
+            units[i] = (key, fingerprint, params, inputs)
+            if not rerun and manifest.is_current(key, fingerprint, retry_failed):
+                records[i] = dict(manifest.previous(key), resumed=True)
+                print(f"[{records[i]['status']}] {city} {year}: unchanged since the last run, not rerun")
+            else:
+                todo.append(i)
+
+    def finish(i, record):
+        records[i] = record
+        if manifest is not None:
+            manifest.record(*units[i], record)
+
+    if not todo:
+        return records
+
+    if workers is None or workers <= 1:
+        _init_context(*init_args)
+        prefetcher = None
+        if prefetch_fn is not None and prefetch_depth > 0:
+            prefetcher = Prefetcher(prefetch_fn, [tasks[i] for i in todo], era5_folder, ndvi_folder, kwargs,
+                                    prefetch_depth, prefetch_max_bytes, tracer)
+        try:
+            for k, i in enumerate(todo):
+                country, city, year = tasks[i]
+                task_kwargs, waited, stages = kwargs, None, None
+                if prefetcher is not None:
+                    prefetched, waited, stages = prefetcher.take(k)
+                    task_kwargs = dict(kwargs, prefetched=prefetched)
+                record = _run_task(analyze_fn, country, city, year, era5_folder, ndvi_folder, output_folder,
+                                   task_kwargs, tracer, stages)
+                if waited is not None:
+                    record['prefetch_wait_s'] = waited
+                finish(i, record)
+            return records
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+            _CONTEXT['era5_archive'].close()
+
+    # Build the persisted GADM index once so workers only unpickle it
+    GADMIndex(gadm_file, index_file=gadm_index_file)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_context, initargs=init_args) as pool:
+        futures = {
+            pool.submit(_run_task, analyze_fn, *tasks[i], era5_folder, ndvi_folder, output_folder, kwargs,
+                        tracer): i
+            for i in todo
+        }
+        for future in as_completed(futures):
+            record = future.result()
+            finish(futures[future], record)
+            print(f"[{record['status']}] {record['city']} {record['year']} ({record['seconds']:.1f}s)")
+    return records
+
+
+def print_failures(records):
+    failed = [r for r in records if r['status'] == 'failed']
+    if not failed:
+        return
+    print(f"\n{len(failed)} task(s) failed:")
+    for r in failed:
+        print(f"  - {r['city']} ({r['country']}, {r['year']}): {r['error']}")
@@ -0,0 +1,164 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+from era5_access import ERA5Archive
+from gadm_index import GADMIndex
+from landmask import mask_multiplier
+from regrid import regrid_operator
+from aligned_grid import load_aligned_stack, city_gdf_from_stack, study_area_from_city
+from ndvi_stats import valid_pixels, NDVI_CLASS_EDGES, WEEK2_CLASS_LABELS, URBAN_MAX_NDVI, RURAL_MIN_NDVI
+
+# Days above this quantile of the city's daily mean Tmax count as hot days in the summary
+HOT_DAY_QUANTILE = 0.9
+
+
+def iter_daily_fields(era5_archive, stack, buffer_degree=0.2, chunk_days=7):
+    """
+    Yield (dates, temps) for chunks of days of the stack's season and city.
+
+    temps is (days, lat, lon) in °C on the stack grid (upsampled, South-up) and
+    land-masked. Only chunk_days slices of the ERA5 window are held at a time.
+    """
+    year = stack.attrs['year']
+    city_gdf = city_gdf_from_stack(stack)
+    bounds = tuple(study_area_from_city(city_gdf, buffer_degree).total_bounds)
+    window = era5_archive.window(year, bounds, stack.attrs['season_start'], stack.attrs['season_end'])
+
+    upsample = regrid_operator(window.latitude.values, window.longitude.values,
+                               stack.latitude.values, stack.longitude.values)
+    land = mask_multiplier(stack['land_mask'].values)
+    dates = pd.DatetimeIndex(window.valid_time.values)
+    for t0 in range(0, len(dates), chunk_days):
+        raw = window.isel(valid_time=slice(t0, t0 + chunk_days)).values
+        temps = (upsample(raw - 273.15) * land).astype(np.float32)
+        yield dates[t0:t0 + chunk_days], temps
+
+
+def daily_stats(ndvi, temps, edges=NDVI_CLASS_EDGES, labels=WEEK2_CLASS_LABELS,
+                urban_max=URBAN_MAX_NDVI, rural_min=RURAL_MIN_NDVI):
+    """
+    Per-day NDVI/temperature statistics of a (days, lat, lon) chunk, vectorized over days.
+
+    Returns a dict of arrays (one value per day): n_pixels, mean_temp, correlation,
+    avg_temp_urban, avg_temp_rural, uhi_intensity and mean_<class label>.
+    """
+    ndvi = np.asarray(ndvi).ravel()
+    temps = temps.reshape(temps.shape[0], -1).astype(np.float64)
+    valid = np.isfinite(temps) & valid_pixels(ndvi)[None, :]
+    t = np.where(valid, temps, 0.0)
+    x = np.where(valid, ndvi[None, :], 0.0)
+    n = valid.sum(axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_t = t.sum(axis=1) / n
+        mean_x = x.sum(axis=1) / n
+        dt = np.where(valid, temps - mean_t[:, None], 0.0)
+        dx = np.where(valid, ndvi[None, :] - mean_x[:, None], 0.0)
+        corr = (dt * dx).sum(axis=1) / np.sqrt((dt ** 2).sum(axis=1) * (dx ** 2).sum(axis=1))
+
+        # Class membership is fixed over days, so class sums are one matrix product
+        classes = np.digitize(np.where(np.isfinite(ndvi), ndvi, 0.0), edges)
+        onehot = np.zeros((len(ndvi), len(edges) + 1))
+        onehot[np.arange(len(ndvi)), classes] = 1.0
+        class_sum = t @ onehot
+        class_n = valid.astype(np.float64) @ onehot
+        class_mean = class_sum / class_n
+
+        urban = (ndvi < urban_max).astype(np.float64)
+        rural = (ndvi > rural_min).astype(np.float64)
+        avg_urban = (t @ urban) / (valid @ urban)
+        avg_rural = (t @ rural) / (valid @ rural)
+
+    stats = {
+        'n_pixels': n,
+        'mean_temp': mean_t,
+        'correlation': corr,
+        'avg_temp_urban': avg_urban,
+        'avg_temp_rural': avg_rural,
+        'uhi_intensity': avg_urban - avg_rural,
+    }
+    for i, label in enumerate(labels):
+        stats[f'mean_{label}'] = class_mean[:, i]
+    return stats
+
+
+def daily_uhi_series(country_code, city_name, year, gadm_index, era5_folder, ndvi_folder,
+                     season_start, season_end, era5_archive, cache_dir=None, chunk_days=7,
+                     buffer_degree=0.2, upsample_factor=10):
+    """Daily UHI time series of one city over [season_start, season_end], streamed chunk by chunk"""
+    stack = load_aligned_stack(country_code, city_name, year, gadm_index, era5_folder, ndvi_folder,
+                               season_start, season_end, buffer_degree=buffer_degree,
+                               upsample_factor=upsample_factor, cache_dir=cache_dir,
+                               era5_archive=era5_archive)
+    if stack is None:
+        return None
+
+    ndvi = stack['ndvi'].values
+    frames = []
+    for dates, temps in iter_daily_fields(era5_archive, stack, buffer_degree, chunk_days):
+        frames.append(pd.DataFrame(daily_stats(ndvi, temps), index=pd.Index(dates, name='date')))
+    df = pd.concat(frames)
+    df.insert(0, 'city', city_name)
+    df.insert(0, 'country', country_code)
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Daily NDVI-temperature coupling and UHI intensity per city")
+    parser.add_argument('--year', type=int, default=2022)
+    parser.add_argument('--season-start', help="First day (default: June 1st)")
+    parser.add_argument('--season-end', help="Last day (default: September 1st)")
+    parser.add_argument('--chunk-days', type=int, default=7, help="Days held in memory at a time")
+    args = parser.parse_args()
+
+    print("="*60)
+    print("DAILY URBAN HEAT ISLAND SERIES")
+    print("="*60)
+
+    DATA_FOLDER = "data"
+    OUTPUT_FOLDER = "reports/figures"
+    GADM_FILE = os.path.join(DATA_FOLDER, "gadm_410_europe.gpkg")
+    ERA5_FOLDER = os.path.join(DATA_FOLDER, "derived-era5-land-daily-statistics")
+    NDVI_FOLDER = os.path.join(DATA_FOLDER, "sentinel2_ndvi")
+    CACHE_FOLDER = os.path.join(DATA_FOLDER, "cache", "aligned")
+    GADM_INDEX_FILE = os.path.join(DATA_FOLDER, "cache", "gadm_index.pkl")
+
+    season_start = args.season_start or f"{args.year}-06-01"
+    season_end = args.season_end or f"{args.year}-09-01"
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+
+    cities = [
+        ("FRA", "Paris"),
+        ("ITA", "Roma"),
+        ("FRA", "Nantes"),
+        ("ITA", "Perugia")
+    ]
+
+    gadm_index = GADMIndex(GADM_FILE, index_file=GADM_INDEX_FILE)
+    series = []
+    with ERA5Archive(ERA5_FOLDER) as archive:
+        for country, city in cities:
+            df = daily_uhi_series(country, city, args.year, gadm_index, ERA5_FOLDER, NDVI_FOLDER,
+                                  season_start, season_end, archive, cache_dir=CACHE_FOLDER,
+                                  chunk_days=args.chunk_days)
+            if df is None:
+                continue
+            series.append(df)
+
+            # Heatwave vs normal days: NDVI-temperature coupling and UHI intensity
+            hot = df['mean_temp'] >= df['mean_temp'].quantile(HOT_DAY_QUANTILE)
+            print(f"{city}: {len(df)} days, UHI {df['uhi_intensity'].mean():.2f}°C "
+                  f"(hot days {df.loc[hot, 'uhi_intensity'].mean():.2f}°C, "
+                  f"other days {df.loc[~hot, 'uhi_intensity'].mean():.2f}°C), "
+                  f"corr hot {df.loc[hot, 'correlation'].mean():.2f} / other {df.loc[~hot, 'correlation'].mean():.2f}")
+
+    if series:
+        out_file = os.path.join(OUTPUT_FOLDER, f"daily_uhi_series_{args.year}.csv")
+        pd.concat(series).to_csv(out_file)
+        print(f"\nDaily series saved: {out_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import numpy as np
+from matplotlib.colors import LogNorm
+
+from online_stats import UPDATE_CHUNK
+
+# Bins per axis of the density figures
+DENSITY_BINS = 200
+
+
+def _padded(lo, hi):
+    """Histogram range of [lo, hi], widened when empty or flat so the edges increase"""
+    if not (np.isfinite(lo) and np.isfinite(hi)):
+        return 0.0, 1.0
+    if hi <= lo:
+        return lo - 0.5, hi + 0.5
+    return float(lo), float(hi)
+
+
+class DensityGrid:
+    """
+    Pixel counts of (x, y) pairs on a fixed bins x bins grid.
+
+    Filled chunk by chunk with update() (np.histogram2d per chunk) and combined
+    with merge(), so every pixel is counted without sampling. Only the grid goes
+    to the figure, so drawing time does not depend on the number of pixels.
+    Pairs with a NaN, or outside the ranges, are not counted; use from_moments()
+    to take the ranges from the exact min/max of the data.
+    """
+
+    def __init__(self, x_range, y_range, bins=DENSITY_BINS):
+        self.x_edges = np.linspace(*_padded(*x_range), bins + 1)
+        self.y_edges = np.linspace(*_padded(*y_range), bins + 1)
+        self.counts = np.zeros((bins, bins), dtype=np.int64)
+
+    @classmethod
+    def from_moments(cls, moments, x, y, bins=DENSITY_BINS):
+        """Grid spanning the min/max of variables x and y of a MomentAccumulator"""
+        return cls((moments.min_of(x), moments.max_of(x)), (moments.min_of(y), moments.max_of(y)), bins)
+
+    @property
+    def total(self):
+        return int(self.counts.sum())
+
+    def update(self, x, y, chunk_size=UPDATE_CHUNK):
+        """Add the pairs of two arrays of the same size (any shape, flattened)"""
+        x, y = np.ravel(x), np.ravel(y)
+        for start in range(0, len(x), chunk_size):
+            xs, ys = x[start:start + chunk_size], y[start:start + chunk_size]
+            finite = np.isfinite(xs) & np.isfinite(ys)
+            counts, _, _ = np.histogram2d(xs[finite], ys[finite], bins=(self.x_edges, self.y_edges))
+            self.counts += counts.astype(np.int64)
+        return self
+
+    def merge(self, other):
+        if not (np.array_equal(self.x_edges, other.x_edges) and np.array_equal(self.y_edges, other.y_edges)):
+            raise ValueError("Cannot merge density grids with different bin edges")
+        self.counts += other.counts
+        return self
+
+
+def plot_density(ax, grid, regression=None, identity=False, cmap='viridis', label='Pixel Count'):
+    """
+    Draw a DensityGrid as an image (log colour scale, empty bins left blank) with
+    its colorbar, the regression line (slope, intercept) over the x range and,
+    with identity=True, the 1:1 line. Returns the image.
+    """
+    counts = np.ma.masked_equal(grid.counts.T, 0)
+    image = ax.pcolormesh(grid.x_edges, grid.y_edges, counts, cmap=cmap,
+                          norm=LogNorm(vmin=1, vmax=max(int(grid.counts.max()), 1)))
+    ax.figure.colorbar(image, ax=ax, label=label)
+
+    x = grid.x_edges[[0, -1]]
+    if identity:
+        lo = max(grid.x_edges[0], grid.y_edges[0])
+        hi = min(grid.x_edges[-1], grid.y_edges[-1])
+        if hi > lo:
+            ax.plot([lo, hi], [lo, hi], 'k--', lw=2, label='Perfect Agreement')
+    if regression is not None and np.all(np.isfinite(regression)):
+        slope, intercept = regression
+        ax.plot(x, slope * x + intercept, color='red', lw=2,
+                label=f'Fit: y = {slope:.2f}x {"+" if intercept >= 0 else "-"} {abs(intercept):.2f}')
+    ax.set_xlim(x)
+    ax.set_ylim(grid.y_edges[[0, -1]])
+    return image
+
+
+def density_plot_data(moments, x, y, x_values, y_values, bins=DENSITY_BINS):
+    """
+    Plot inputs of a density figure: {'density', 'regression'} for variables x and y
+    of a MomentAccumulator, binning the pixel arrays x_values / y_values. Shared by
+    week2 and week3 so they build the figures the same way.
+    """
+    density = DensityGrid.from_moments(moments, x, y, bins).update(x_values, y_values)
+    return {'density': density, 'regression': moments.regression(x, y)}
@@ -0,0 +1,195 @@
+import io
+import os
+import re
+import json
+import shutil
+import zipfile
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+ECA_MISSING = -9999
+TX_MEMBER_PATTERN = re.compile(r"(?:^|/)TX_STAID(\d+)\.txt$")
+# Column header line of the ECA files ("STAID, SOUID, DATE, TX, Q_TX" / "STAID,STANAME,...")
+HEADER_PATTERN = re.compile(rb"^\s*STAID\s*,", re.MULTILINE)
+# Upper bound on the rows of a Parquet row group (a batch-year is usually far below)
+ROW_GROUP_ROWS = 1_000_000
+
+TX_SCHEMA = pa.schema([
+    ('STAID', pa.int32()),
+    ('SOUID', pa.int32()),
+    ('DATE', pa.timestamp('ns')),
+    ('TX_C', pa.float32()),
+    ('Q_TX', pa.int8()),
+])
+
+# One ZipFile handle per worker process
+_ZIP = {}
+
+
+def dms_to_decimal(values):
+    """Vectorized DMS ('+56:52:00', '-003:30:00') or plain decimal strings -> decimal degrees (NaN if invalid)"""
+    s = pd.Series(values, dtype='string').str.strip()
+    parts = s.str.extract(r'^([+-]?)(\d+):(\d+):(\d+(?:\.\d*)?)$')
+    degrees = parts[1].astype(float) + parts[2].astype(float) / 60 + parts[3].astype(float) / 3600
+    decimal = degrees.where(parts[0] != '-', -degrees)
+    numeric = pd.to_numeric(s, errors='coerce')
+    return numeric.where(numeric.notna(), decimal).to_numpy(dtype=float)
+
+
+def _table_start(raw):
+    """Byte offset of the column header line, after the free-text preamble"""
+    match = HEADER_PATTERN.search(raw)
+    if match is None:
+        raise ValueError("ECA column header line (STAID, ...) not found")
+    return match.start()
+
+
+def read_stations(zip_path):
+    """Station table of the archive with decimal LAT/LON and HGHT in metres"""
+    with zipfile.ZipFile(zip_path) as zf:
+        member = next(n for n in zf.namelist() if os.path.basename(n) == 'stations.txt')
+        raw = zf.read(member)
+    stations = pd.read_csv(io.BytesIO(raw[_table_start(raw):]), skipinitialspace=True, dtype=str,
+                           encoding='latin-1')
+    stations.columns = stations.columns.str.strip()
+    stations = stations.apply(lambda col: col.str.strip())
+    stations['STAID'] = pd.to_numeric(stations['STAID'], errors='coerce')
+    stations['LAT'] = dms_to_decimal(stations['LAT'])
+    stations['LON'] = dms_to_decimal(stations['LON'])
+    stations['HGHT'] = pd.to_numeric(stations['HGHT'], errors='coerce')
+    stations = stations.dropna(subset=['STAID', 'LAT', 'LON'])
+    stations['STAID'] = stations['STAID'].astype(np.int32)
+    return stations[['STAID', 'STANAME', 'CN', 'LAT', 'LON', 'HGHT']].reset_index(drop=True)
+
+
+def parse_tx(raw, start_date=None):
+    """Parse one TX_STAID file (bytes) into the TX_SCHEMA columns; -9999 becomes NaN, Q_TX is kept"""
+    df = pd.read_csv(io.BytesIO(raw[_table_start(raw):]), skipinitialspace=True, engine='c',
+                     dtype={'STAID': np.int32, 'SOUID': np.int32, 'DATE': str, 'TX': np.int32, 'Q_TX': np.int8})
+    df.columns = df.columns.str.strip()
+    df['DATE'] = pd.to_datetime(df['DATE'], format='%Y%m%d')
+    if start_date is not None:
+        df = df[df['DATE'] >= start_date]
+    tx = df['TX'].to_numpy()
+    df['TX_C'] = np.where(tx == ECA_MISSING, np.nan, tx / 10.0).astype(np.float32)
+    return df[['STAID', 'SOUID', 'DATE', 'TX_C', 'Q_TX']]
+
+
+def _init_worker(zip_path):
+    _ZIP['zf'] = zipfile.ZipFile(zip_path)
+
+
+def _ingest_batch(members, out_path, start_date):
+    """
+    Parse a batch of TX members and write them as one Parquet file with one row
+    group per calendar year, each sorted by (STAID, DATE)
+    """
+    zf = _ZIP['zf']
+    frames = [parse_tx(zf.read(member), start_date) for member in members]
+    df = pd.concat(frames, ignore_index=True)
+    year = df['DATE'].dt.year.to_numpy()
+    order = np.lexsort((df['DATE'].to_numpy(), df['STAID'].to_numpy(), year))
+    df, year = df.iloc[order], year[order]
+    table = pa.Table.from_pandas(df, schema=TX_SCHEMA, preserve_index=False)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp_path = out_path + ".tmp"
+    # Row groups cut at year boundaries, so the DATE min/max statistics let date
+    # filters skip whole years (a (STAID, DATE) sort gives every group the full span)
+    bounds = np.flatnonzero(np.diff(year)) + 1
+    with pq.ParquetWriter(tmp_path, TX_SCHEMA, compression='zstd') as writer:
+        for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(year)]):
+            writer.write_table(table.slice(start, stop - start), row_group_size=ROW_GROUP_ROWS)
+    os.replace(tmp_path, out_path)
+    return out_path, len(members), table.num_rows
+
+
+def _source_signature(zip_path, start_date):
+    st = os.stat(zip_path)
+    return {'source': os.path.abspath(zip_path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+            'start_date': start_date, 'row_groups': 'year'}
+
+
+def ingest_eca(zip_path, store_dir, workers=4, batch_size=200, start_date=None, force=False):
+    """
+    Convert ECA_blend_tx.zip into a Parquet store without extracting it to disk.
+
+    store_dir/stations.parquet holds the station table and store_dir/tx/CN=<country>/
+    the daily series, one file per batch of stations with a row group per year
+    (sorted by STAID, DATE within it), so date filters can skip row groups.
+    Members are streamed from the zip and parsed in a process pool. The store is left untouched when it was already
+    built from the same zip (size/mtime) unless force=True.
+    """
+    signature = _source_signature(zip_path, start_date)
+    signature_file = os.path.join(store_dir, "_source.json")
+    if not force and os.path.exists(signature_file):
+        with open(signature_file) as f:
+            if json.load(f) == signature:
+                print(f"ECA store is up to date: {store_dir}")
+                return store_dir
+
+    print(f"Ingesting {zip_path} -> {store_dir}")
+    stations = read_stations(zip_path)
+    with zipfile.ZipFile(zip_path) as zf:
+        members = {}
+        for name in zf.namelist():
+            match = TX_MEMBER_PATTERN.search(name)
+            if match:
+                members[int(match.group(1))] = name
+    print(f"  {len(stations)} stations, {len(members)} TX series")
+
+    # Batches never mix countries so the hive partition CN=<country> stays exact
+    country = dict(zip(stations['STAID'], stations['CN']))
+    by_country = {}
+    for staid in sorted(members):
+        by_country.setdefault(country.get(staid, 'XX'), []).append(members[staid])
+
+    tx_dir = os.path.join(store_dir, "tx")
+    if os.path.exists(tx_dir):
+        shutil.rmtree(tx_dir)
+    jobs = []
+    for cn, names in sorted(by_country.items()):
+        for i in range(0, len(names), batch_size):
+            out_path = os.path.join(tx_dir, f"CN={cn}", f"part-{i // batch_size:05d}.parquet")
+            jobs.append((names[i:i + batch_size], out_path, start_date))
+
+    n_rows = 0
+    if workers is None or workers <= 1:
+        _init_worker(zip_path)
+        for job in jobs:
+            n_rows += _ingest_batch(*job)[2]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(zip_path,)) as pool:
+            futures = [pool.submit(_ingest_batch, *job) for job in jobs]
+            for done, future in enumerate(as_completed(futures), 1):
+                out_path, n_members, rows = future.result()
+                n_rows += rows
+                print(f"  [{done}/{len(jobs)}] {os.path.relpath(out_path, store_dir)}: {n_members} stations, {rows} days")
+
+    os.makedirs(store_dir, exist_ok=True)
+    stations.to_parquet(os.path.join(store_dir, "stations.parquet"), index=False)
+    with open(signature_file, 'w') as f:
+        json.dump(signature, f)
+    print(f"ECA store written: {len(members)} series, {n_rows} station-days")
+    return store_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest ECA_blend_tx.zip into a Parquet station store")
+    parser.add_argument('--zip', default=os.path.join("data", "ECA_blend_tx.zip"))
+    parser.add_argument('--store', default=os.path.join("data", "eca_store"))
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch-size', type=int, default=200, help="Stations per Parquet file")
+    parser.add_argument('--start-date', help="Drop observations before this date (default: keep 1851-)")
+    parser.add_argument('--force', action='store_true', help="Rebuild even if the store is up to date")
+    args = parser.parse_args()
+
+    ingest_eca(args.zip, args.store, workers=args.workers, batch_size=args.batch_size,
+               start_date=args.start_date, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
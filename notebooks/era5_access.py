@@ -0,0 +1,63 @@
+import os
+import threading
+
+import xarray as xr
+
+
+class ERA5Archive:
+    """
+    Shared access to the yearly ERA5-Land daily maximum temperature files.
+
+    Each yearly file is opened once, lazily, and reused by every city. Windows are
+    cut by bounding box and time before any reduction, so only the cells of the
+    study area are read from disk (netCDF4 hyperslabs, or dask chunks if `chunks`
+    is given). Safe to share between threads (e.g. prefetching): the lazy open is
+    locked, so a year is opened only once.
+    """
+
+    def __init__(self, era5_folder, chunks=None, variable='t2m'):
+        self.era5_folder = era5_folder
+        self.chunks = chunks
+        self.variable = variable
+        self._datasets = {}
+        self._lock = threading.Lock()
+
+    def path(self, year):
+        return os.path.join(self.era5_folder, f"{year}_2m_temperature_daily_maximum.nc")
+
+    def dataset(self, year):
+        """Return the (lazily opened) dataset of one year, opening it on first use"""
+        with self._lock:
+            if year not in self._datasets:
+                self._datasets[year] = xr.open_dataset(self.path(year), chunks=self.chunks)
+            return self._datasets[year]
+
+    def window(self, year, bounds, start=None, end=None):
+        """Lazy t2m (Kelvin) cut to bounds=(minx, miny, maxx, maxy) and [start, end]"""
+        minx, miny, maxx, maxy = bounds
+        da = self.dataset(year)[self.variable]
+
+        # ERA5 latitude is stored North to South, but do not rely on it
+        lat = da.latitude.values
+        lat_slice = slice(maxy, miny) if lat[0] > lat[-1] else slice(miny, maxy)
+        da = da.sel(longitude=slice(minx, maxx), latitude=lat_slice)
+        if start is not None or end is not None:
+            da = da.sel(valid_time=slice(start, end))
+        return da
+
+    def seasonal_mean(self, year, bounds, start, end):
+        """Mean daily maximum over [start, end] in °C, reading only the window"""
+        da = self.window(year, bounds, start, end)
+        return (da.mean(dim='valid_time') - 273.15).load()
+
+    def close(self):
+        with self._lock:
+            for ds in self._datasets.values():
+                ds.close()
+            self._datasets = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
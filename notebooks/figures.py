@@ -0,0 +1,77 @@
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+FIGURE_MODES = ('all', 'summary', 'none')
+
+
+def _init_render_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _render(plot_fn, out_path, data):
+    import matplotlib.pyplot as plt
+    try:
+        plot_fn(out_path, **data)
+    finally:
+        plt.close('all')
+    return out_path
+
+
+class FigureRenderer:
+    """
+    Draws figures from plot-ready data emitted by the compute stage.
+
+    mode='all' renders every figure, 'summary' only the figures submitted with
+    summary=True, 'none' skips rendering. With workers > 0 figures are drawn in a
+    background process pool (Agg backend) while the numeric pipeline continues.
+    Call wants() before preparing expensive plot data, and close() at the end.
+    """
+
+    def __init__(self, mode='all', workers=0):
+        if mode not in FIGURE_MODES:
+            raise ValueError(f"Unknown figure mode '{mode}', expected one of {FIGURE_MODES}")
+        self.mode = mode
+        self.workers = workers
+        self._pool = None
+        self._futures = []
+        # Every figure accepted by submit(), in order (used as a run's outputs)
+        self.outputs = []
+
+    def wants(self, summary=False):
+        return self.mode == 'all' or (self.mode == 'summary' and summary)
+
+    def submit(self, plot_fn, out_path, summary=False, **data):
+        """Render plot_fn(out_path, **data) now or in the background; returns False if skipped"""
+        if not self.wants(summary):
+            return False
+        self.outputs.append(out_path)
+        if self.workers and self.workers > 0:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_render_worker)
+            self._futures.append((out_path, self._pool.submit(_render, plot_fn, out_path, data)))
+        else:
+            _render(plot_fn, out_path, data)
+        return True
+
+    def close(self):
+        """Wait for background figures and report the ones that failed"""
+        failed = []
+        for out_path, future in self._futures:
+            try:
+                future.result()
+            except Exception:
+                failed.append(out_path)
+                print(f"Error rendering {out_path}:")
+                traceback.print_exc()
+        self._futures = []
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        return failed
+
+    def __getstate__(self):
+        # Sent to city worker processes: render inline there, with the same mode
+        state = self.__dict__.copy()
+        state.update(workers=0, _pool=None, _futures=[], outputs=[])
+        return state
@@ -0,0 +1,79 @@
+import os
+import pandas as pd
+import geopandas as gpd
+from shapely.errors import GEOSException
+from shapely.geometry import box
+
+NAME_LEVELS = [5, 4, 3, 2, 1]
+
+
+class GADMIndex:
+    """
+    Name lookup over the GADM GeoPackage without loading every European polygon.
+
+    The attribute table (fid, GID_0, NAME_1..NAME_5) is read once without geometry
+    and persisted to `index_file`. City lookups then map (GID_0, level, name) to
+    the matching feature ids and read only those polygons; land polygons are read
+    with a bbox filter that uses the GeoPackage spatial index.
+    """
+
+    def __init__(self, gadm_file, index_file=None, layer=None):
+        self.gadm_file = gadm_file
+        self.layer = layer
+        self.table = self._load_table(index_file)
+        self._lookup = self._build_lookup(self.table)
+        self._cities = {}
+
+    def _source_signature(self):
+        st = os.stat(self.gadm_file)
+        return (os.path.abspath(self.gadm_file), self.layer, st.st_size, st.st_mtime_ns)
+
+    def _load_table(self, index_file):
+        signature = self._source_signature()
+        if index_file and os.path.exists(index_file):
+            cached = pd.read_pickle(index_file)
+            if cached.get('source') == signature:
+                return cached['table']
+
+        print("Building GADM name index (one-time)...")
+        table = gpd.read_file(self.gadm_file, layer=self.layer, ignore_geometry=True, fid_as_index=True)
+        columns = ['GID_0'] + [f'NAME_{level}' for level in NAME_LEVELS if f'NAME_{level}' in table.columns]
+        table = table[columns]
+
+        if index_file:
+            os.makedirs(os.path.dirname(index_file) or ".", exist_ok=True)
+            pd.to_pickle({'source': signature, 'table': table}, index_file)
+        return table
+
+    @staticmethod
+    def _build_lookup(table):
+        lookup = {}
+        for level in NAME_LEVELS:
+            col = f'NAME_{level}'
+            if col not in table.columns:
+                continue
+            for (country_code, name), fids in table.groupby(['GID_0', col]).groups.items():
+                lookup[(country_code, level, name)] = fids.to_numpy()
+        return lookup
+
+    def find_city(self, country_code, city_name):
+        """Return (dissolved city_gdf, level), searching levels 5 down to 1"""
+        for level in NAME_LEVELS:
+            key = (country_code, level, city_name)
+            if key not in self._lookup:
+                continue
+            if key not in self._cities:
+                features = gpd.read_file(self.gadm_file, layer=self.layer, fids=self._lookup[key])
+                self._cities[key] = features[['geometry']].dissolve()
+            return self._cities[key].copy(), level
+        return gpd.GeoDataFrame(), None
+
+    def land(self, bounds):
+        """GADM polygons clipped to bounds=(minx, miny, maxx, maxy), read via the spatial index"""
+        features = gpd.read_file(self.gadm_file, layer=self.layer, bbox=tuple(bounds))
+        try:
+            return gpd.clip(features, tuple(bounds))
+        except GEOSException:
+            # clip_by_rect can fail on rings that end up degenerate along the box
+            # edge (seen with tile boundaries); the general intersection does not
+            return gpd.clip(features, box(*bounds))
@@ -0,0 +1,304 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import functools
+import tracemalloc
+
+import pandas as pd
+
+# Tracer active on each thread (unset: stages are no-ops); a run activates its
+# tracer on its own thread, a collector on a helper thread (e.g. prefetching)
+_LOCAL = threading.local()
+
+
+def _proc_io():
+    """(rchar, read_bytes) of this process from /proc/self/io, or (None, None) where unavailable"""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(':') for line in f)
+        return int(fields['rchar']), int(fields['read_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _reset_rss_peak():
+    """Reset the kernel's RSS high-water mark (Linux clear_refs); False if not supported"""
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _rss_peak_mb():
+    """Peak RSS since the last reset (VmHWM), falling back to the process lifetime peak"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+class _NullStage:
+    """What stage() returns when tracing is off: enter/exit and shape() do nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def shape(self, name, array):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.record = {'stage': name, 'shapes': {}}
+
+    def shape(self, name, array):
+        """Record the shape (and dtype) of an array produced by this stage"""
+        shape = getattr(array, 'shape', None)
+        if shape is not None:
+            entry = {'shape': list(shape)}
+            if hasattr(array, 'dtype'):
+                entry['dtype'] = str(array.dtype)
+            self.record['shapes'][name] = entry
+
+    def __enter__(self):
+        if self.tracer._stack:
+            # Our resets hide the parent's peak so far, so hand it over first
+            parent = self.tracer._stack[-1]
+            parent._child_rss = max(parent._child_rss, _rss_peak_mb())
+            if self.tracer.trace_memory:
+                peak = (tracemalloc.get_traced_memory()[1] - parent._traced0) / 1024**2
+                parent._child_alloc = max(parent._child_alloc, peak)
+        self.tracer._stack.append(self)
+        self._child_rss = 0.0
+        self._child_alloc = 0.0
+        self._rss_reset = _reset_rss_peak() if self.tracer.reset_peaks else False
+        if self.tracer.trace_memory:
+            tracemalloc.reset_peak()
+            self._traced0 = tracemalloc.get_traced_memory()[0]
+        self._io0 = _proc_io()
+        self._wall0 = time.perf_counter()
+        self._cpu0 = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record = self.record
+        record['wall_s'] = time.perf_counter() - self._wall0
+        record['cpu_s'] = time.process_time() - self._cpu0
+        io1 = _proc_io()
+        if io1[0] is not None and self._io0[0] is not None:
+            record['bytes_read'] = io1[0] - self._io0[0]
+            record['disk_bytes_read'] = io1[1] - self._io0[1]
+        # Nested stages reset the peaks too, so their peaks are folded into ours
+        record['rss_peak_mb'] = max(_rss_peak_mb(), self._child_rss)
+        if self.tracer.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            record['alloc_peak_mb'] = max((peak - self._traced0) / 1024**2, self._child_alloc)
+        if exc_type is not None:
+            record['error'] = f"{exc_type.__name__}: {exc}"
+
+        self.tracer._stack.pop()
+        if self.tracer._stack:
+            parent = self.tracer._stack[-1]
+            parent._child_rss = max(parent._child_rss, record['rss_peak_mb'])
+            if self.tracer.trace_memory:
+                parent._child_alloc = max(parent._child_alloc, record['alloc_peak_mb'] + (self._traced0 - parent._traced0) / 1024**2)
+            record['parent'] = parent.record['stage']
+        self.tracer._stages.append(record)
+        return False
+
+
+class Tracer:
+    """
+    Per-stage wall/CPU time, peak memory, bytes read and array shapes, written as
+    JSON lines (one line per city run) to trace_file.
+
+    Wrap a city run in `with tracer.run(city=..., ...)`; inside it, code marks its
+    steps with the module-level `with stage('name') as s:` (or the @traced
+    decorator), so tracers do not have to be passed down. Outside a run, or with a
+    disabled tracer, stage() returns a shared no-op object. trace_memory adds
+    tracemalloc allocation peaks (numpy included) at some runtime cost. Peak RSS is
+    per stage on Linux (clear_refs), otherwise the process peak so far.
+    Tracers are picklable, so they can be sent to city worker processes.
+    """
+
+    def __init__(self, trace_file=None, enabled=True, trace_memory=False, reset_peaks=True):
+        self.trace_file = trace_file
+        self.enabled = enabled and trace_file is not None
+        self.trace_memory = trace_memory
+        # False for collectors: the RSS peak reset is process-wide and would clobber the run's peaks
+        self.reset_peaks = reset_peaks
+        self._stack = []
+        self._stages = []
+
+    def run(self, **fields):
+        """Context manager around one unit of work (e.g. one city and year)"""
+        return _Run(self, fields) if self.enabled else _NULL_STAGE
+
+    def stage(self, name):
+        return _Stage(self, name) if self.enabled else _NULL_STAGE
+
+    def collector(self):
+        """
+        Tracer for the part of a run done on another thread (e.g. prefetching):
+        use `with collector.collect():` there, then hand collector.stages to
+        extend() inside the run. Its memory figures are process-wide peaks (no
+        peak resets, no tracemalloc), so it does not disturb the run's own.
+        """
+        return Tracer(self.trace_file, self.enabled, trace_memory=False, reset_peaks=False)
+
+    def collect(self):
+        """Context manager recording this thread's stages into self.stages instead of a run"""
+        return _Collect(self) if self.enabled else _NULL_STAGE
+
+    @property
+    def stages(self):
+        return list(self._stages)
+
+    def extend(self, stages, **fields):
+        """Add stages recorded by a collector to the run in progress, tagged with fields"""
+        self._stages.extend(dict(record, **fields) for record in stages)
+
+    def write(self, record):
+        os.makedirs(os.path.dirname(self.trace_file) or ".", exist_ok=True)
+        # One write per line in append mode, so worker processes can share the file
+        with open(self.trace_file, 'a') as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_stack=[], _stages=[])
+        return state
+
+
+class _Run:
+    def __init__(self, tracer, fields):
+        self.tracer = tracer
+        self.fields = fields
+
+    def __enter__(self):
+        self._previous = getattr(_LOCAL, 'tracer', None)
+        _LOCAL.tracer = self.tracer
+        self.tracer._stages = []
+        self._started = time.time()
+        if self.tracer.trace_memory:
+            self._started_tracing = not tracemalloc.is_tracing()
+            if self._started_tracing:
+                tracemalloc.start()
+        self._stage = _Stage(self.tracer, 'total').__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stage.__exit__(exc_type, exc, tb)
+        stages = self.tracer._stages
+        total = stages.pop()
+        status = 'failed' if exc_type is not None else self.fields.pop('status', 'ok')
+        record = dict(self.fields, pid=os.getpid(), started=self._started, status=status,
+                      **{k: v for k, v in total.items() if k not in ('stage', 'shapes')})
+        record['stages'] = stages
+        self.tracer.write(record)
+        self.tracer._stages = []
+        if self.tracer.trace_memory and self._started_tracing:
+            tracemalloc.stop()
+        _LOCAL.tracer = self._previous
+        return False
+
+
+class _Collect:
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def __enter__(self):
+        self._previous = getattr(_LOCAL, 'tracer', None)
+        _LOCAL.tracer = self.tracer
+        self.tracer._stack = []
+        self.tracer._stages = []
+        return self
+
+    def __exit__(self, *exc):
+        _LOCAL.tracer = self._previous
+        return False
+
+
+def _active():
+    return getattr(_LOCAL, 'tracer', None)
+
+
+def stage(name):
+    """Measure a block as a stage of the active run (a no-op when nothing is being traced)"""
+    tracer = _active()
+    return tracer.stage(name) if tracer is not None else _NULL_STAGE
+
+
+def traced(name=None):
+    """Decorator form of stage(), named after the function by default"""
+    def decorate(fn):
+        stage_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            tracer = _active()
+            if tracer is None:
+                return fn(*args, **kwargs)
+            with tracer.stage(stage_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def read_trace(trace_file):
+    """The run records of a trace file as a list of dicts"""
+    with open(trace_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize_trace(trace_file, since=None):
+    """
+    Per-stage aggregate over the runs of a trace file (runs started at or after
+    `since`, a time.time() value): count, total/mean/max wall time, CPU time,
+    max peak RSS / allocations and bytes read. Nested stages are listed as
+    parent/child.
+    """
+    rows = []
+    for run in read_trace(trace_file):
+        if since is not None and run['started'] < since:
+            continue
+        for record in run['stages']:
+            name = f"{record['parent']}/{record['stage']}" if record.get('parent') not in (None, 'total') else record['stage']
+            rows.append({'stage': name, 'city': run.get('city'), **{k: record.get(k) for k in (
+                'wall_s', 'cpu_s', 'rss_peak_mb', 'alloc_peak_mb', 'bytes_read')}})
+    if not rows:
+        return pd.DataFrame()
+    df = pd.DataFrame(rows)
+    summary = df.groupby('stage', sort=False).agg(
+        runs=('wall_s', 'size'), wall_s_total=('wall_s', 'sum'), wall_s_mean=('wall_s', 'mean'),
+        wall_s_max=('wall_s', 'max'), cpu_s_total=('cpu_s', 'sum'), rss_peak_mb=('rss_peak_mb', 'max'),
+        alloc_peak_mb=('alloc_peak_mb', 'max'), bytes_read=('bytes_read', 'sum'))
+    return summary.sort_values('wall_s_total', ascending=False)
+
+
+def print_trace_summary(trace_file, since=None):
+    summary = summarize_trace(trace_file, since)
+    if summary.empty:
+        return summary
+    print("\n" + "="*60)
+    print(f"STAGE TIMINGS ({trace_file})")
+    print("="*60)
+    print(summary.to_string(float_format=lambda v: f"{v:.3f}"))
+    return summary
@@ -0,0 +1,62 @@
+import numpy as np
+from affine import Affine
+from rasterio.features import rasterize
+
+# 'center': pixel is land if its centre falls in a polygon (same rule as rio.clip)
+# 'all_touched': any pixel touched by a polygon is land
+# 'fraction': land coverage fraction estimated on a supersampled grid
+LAND_MASK_MODES = ('center', 'all_touched', 'fraction')
+
+
+def grid_transform(lat, lon):
+    """North-up affine transform of a regular grid given its cell-centre coordinates"""
+    lat = np.asarray(lat)
+    lon = np.asarray(lon)
+    dx = (lon[-1] - lon[0]) / (len(lon) - 1) if len(lon) > 1 else 0.1
+    dy = abs(lat[-1] - lat[0]) / (len(lat) - 1) if len(lat) > 1 else 0.1
+    west = lon.min() - dx / 2
+    north = lat.max() + dy / 2
+    return Affine(dx, 0.0, west, 0.0, -dy, north)
+
+
+def rasterize_land(land_gdf, lat, lon, mode='center', supersample=5):
+    """
+    Rasterize land polygons once onto the (lat, lon) grid.
+
+    Returns a boolean array ('center', 'all_touched') or a float32 coverage
+    fraction ('fraction'), oriented like `lat` (South-up when lat is ascending).
+    """
+    if mode not in LAND_MASK_MODES:
+        raise ValueError(f"Unknown land mask mode '{mode}', expected one of {LAND_MASK_MODES}")
+
+    shape = (len(lat), len(lon))
+    transform = grid_transform(lat, lon)
+    if land_gdf.crs is not None and land_gdf.crs.to_epsg() != 4326:
+        land_gdf = land_gdf.to_crs("EPSG:4326")
+    shapes = [geom for geom in land_gdf.geometry if geom is not None and not geom.is_empty]
+
+    if mode == 'fraction':
+        if shapes:
+            fine = rasterize(shapes, out_shape=(shape[0] * supersample, shape[1] * supersample),
+                             transform=transform * Affine.scale(1 / supersample), fill=0, dtype='uint8')
+            land = fine.reshape(shape[0], supersample, shape[1], supersample).mean(axis=(1, 3), dtype=np.float32)
+        else:
+            land = np.zeros(shape, dtype=np.float32)
+    else:
+        if shapes:
+            land = rasterize(shapes, out_shape=shape, transform=transform, fill=0, dtype='uint8',
+                             all_touched=(mode == 'all_touched')).astype(bool)
+        else:
+            land = np.zeros(shape, dtype=bool)
+
+    # rasterize is North-up (row 0 is North)
+    if lat[0] < lat[-1]:
+        land = land[::-1]
+    return np.ascontiguousarray(land)
+
+
+def mask_multiplier(land, min_fraction=0.5):
+    """1.0 over land and NaN over sea, so masking is a single multiplication"""
+    land = np.asarray(land)
+    is_land = land if land.dtype == bool else land >= min_fraction
+    return np.where(is_land, np.float32(1.0), np.float32(np.nan))
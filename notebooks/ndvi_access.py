@@ -0,0 +1,177 @@
+import os
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.io import MemoryFile
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+
+NDVI_NODATA = 255
+# Decimation factors of the cached overview pyramid (each divides the next)
+OVERVIEW_FACTORS = (2, 4, 8, 16, 32)
+
+
+def ndvi_from_raw(raw, nodata=NDVI_NODATA, dtype=float):
+    """uint8 NDVI (0-254) to float NDVI in [-1, 1], NaN where nodata"""
+    ndvi = raw.astype(dtype)
+    ndvi[raw == nodata] = np.nan
+    ndvi /= 254.0 / 2.0
+    ndvi -= 1.0
+    return ndvi
+
+
+def _source_tags(ndvi_file):
+    st = os.stat(ndvi_file)
+    return {'SOURCE_SIZE': str(st.st_size), 'SOURCE_MTIME_NS': str(st.st_mtime_ns)}
+
+
+def overview_path(ndvi_file, overview_dir, factor):
+    stem = os.path.splitext(os.path.basename(ndvi_file))[0]
+    return os.path.join(overview_dir, f"{stem}_x{factor}.tif")
+
+
+def _overview_is_fresh(path, tags):
+    if not os.path.exists(path):
+        return False
+    with rasterio.open(path) as ovr:
+        stored = ovr.tags()
+    return all(stored.get(k) == v for k, v in tags.items())
+
+
+def build_overviews(ndvi_file, overview_dir, factors=OVERVIEW_FACTORS, strip_blocks=8):
+    """
+    Write the decimated pyramid of an NDVI GeoTIFF in one streaming pass.
+
+    Every level is the nodata-aware block average of the full-resolution pixels
+    (not an average of averages). The source is read in strips of whole rows, so
+    memory stays bounded for the Europe-wide mosaics. Levels are tagged with the
+    source size/mtime and rebuilt when the source changes.
+    """
+    factors = sorted(factors)
+    os.makedirs(overview_dir, exist_ok=True)
+    tags = _source_tags(ndvi_file)
+    max_factor = factors[-1]
+    print(f"Building NDVI overviews {factors} for {os.path.basename(ndvi_file)}...")
+
+    with rasterio.open(ndvi_file) as src:
+        nodata = src.nodata if src.nodata is not None else NDVI_NODATA
+        profile = {
+            'driver': 'GTiff', 'dtype': 'uint8', 'count': 1, 'crs': src.crs, 'nodata': nodata,
+            'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'deflate',
+        }
+        outputs = {}
+        for f in factors:
+            tmp_path = overview_path(ndvi_file, overview_dir, f) + f".{os.getpid()}.tmp"
+            outputs[f] = (tmp_path, rasterio.open(
+                tmp_path, 'w', height=-(-src.height // f), width=-(-src.width // f),
+                transform=src.transform * Affine.scale(f), **profile))
+
+        strip = max_factor * strip_blocks
+        padded_width = -(-src.width // max_factor) * max_factor
+        try:
+            for row in range(0, src.height, strip):
+                n_rows = min(strip, src.height - row)
+                raw = src.read(1, window=Window(0, row, src.width, n_rows))
+                buf = np.full((-(-n_rows // max_factor) * max_factor, padded_width), nodata, dtype=np.uint8)
+                buf[:n_rows, :src.width] = raw
+                valid = buf != nodata
+                total = np.where(valid, buf, 0).astype(np.uint32)
+                count = valid.astype(np.uint32)
+
+                level = 1
+                for f in factors:
+                    # Sums and counts are aggregated level to level, so every level stays exact
+                    k = f // level
+                    h, w = total.shape
+                    total = total.reshape(h // k, k, w // k, k).sum(axis=(1, 3))
+                    count = count.reshape(h // k, k, w // k, k).sum(axis=(1, 3))
+                    level = f
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        mean = np.where(count > 0, np.rint(total / count), nodata).astype(np.uint8)
+                    out_rows, out_cols = -(-n_rows // f), -(-src.width // f)
+                    outputs[f][1].write(mean[:out_rows, :out_cols], 1,
+                                        window=Window(0, row // f, out_cols, out_rows))
+        except BaseException:
+            for tmp_path, dst in outputs.values():
+                dst.close()
+                os.remove(tmp_path)
+            raise
+        for _, dst in outputs.values():
+            dst.update_tags(**tags)
+            dst.close()
+
+    for f, (tmp_path, _) in outputs.items():
+        os.replace(tmp_path, overview_path(ndvi_file, overview_dir, f))
+
+
+def overview_file(ndvi_file, overview_dir, factor):
+    """Path of one pyramid level, (re)building the pyramid if missing or stale"""
+    path = overview_path(ndvi_file, overview_dir, factor)
+    if not _overview_is_fresh(path, _source_tags(ndvi_file)):
+        build_overviews(ndvi_file, overview_dir)
+    return path
+
+
+def overview_factor(source_res, target_res, factors=OVERVIEW_FACTORS):
+    """Coarsest level that still has at least 2x2 pixels per target cell (1 = full resolution)"""
+    usable = [f for f in factors if source_res * f <= target_res / 2]
+    return max(usable) if usable else 1
+
+
+class NDVIWindow:
+    """
+    The study-area window of an NDVI GeoTIFF, held as an in-memory dataset.
+
+    `dataset` behaves like the opened GeoTIFF (rasterio.band, mask, ...) but only
+    contains the pixels read for this window, so the coarse resampling and the
+    high-res crop can both be served from a single read.
+    """
+
+    def __init__(self, raw, transform, crs, nodata, factor=1, ndvi_file=None):
+        self.factor = factor
+        self.ndvi_file = ndvi_file
+        self.nbytes = raw.nbytes
+        self._memfile = MemoryFile()
+        self.dataset = self._memfile.open(
+            driver='GTiff', height=raw.shape[0], width=raw.shape[1], count=1,
+            dtype=raw.dtype, crs=crs, transform=transform, nodata=nodata)
+        self.dataset.write(raw, 1)
+
+    def close(self):
+        self.dataset.close()
+        self._memfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_ndvi_window(ndvi_file, bounds, bounds_crs="EPSG:4326", overview_dir=None, target_res=None, pad=4):
+    """
+    Read only the pixels of ndvi_file covering bounds (plus `pad` pixels).
+
+    With overview_dir and target_res (in bounds_crs units) the window is read from
+    the coarsest cached pyramid level fine enough for that resolution instead of
+    the full-resolution mosaic.
+    """
+    path, factor = ndvi_file, 1
+    with rasterio.open(ndvi_file) as src:
+        src_bounds = transform_bounds(bounds_crs, src.crs, *bounds)
+        if overview_dir and target_res:
+            # Target resolution in source CRS units, from the projected bbox width
+            scale = (src_bounds[2] - src_bounds[0]) / (bounds[2] - bounds[0])
+            factor = overview_factor(abs(src.res[0]), target_res * scale)
+    if factor > 1:
+        path = overview_file(ndvi_file, overview_dir, factor)
+
+    with rasterio.open(path) as src:
+        window = from_bounds(*src_bounds, transform=src.transform)
+        col_off, row_off = int(np.floor(window.col_off)) - pad, int(np.floor(window.row_off)) - pad
+        width = int(np.ceil(window.col_off + window.width)) + pad - col_off
+        height = int(np.ceil(window.row_off + window.height)) + pad - row_off
+        window = Window(col_off, row_off, width, height)
+        nodata = src.nodata if src.nodata is not None else NDVI_NODATA
+        raw = src.read(1, window=window, boundless=True, fill_value=nodata)
+        return NDVIWindow(raw, src.window_transform(window), src.crs, nodata, factor, ndvi_file)
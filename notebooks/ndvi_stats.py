@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+
+# Class edges shared by week2 (classify_ndvi) and week3 (classify_urbanization)
+NDVI_CLASS_EDGES = (0.2, 0.4, 0.6)
+WEEK2_CLASS_LABELS = ['Urban/Water (<0.2)', 'Sparse Veg (0.2-0.4)', 'Moderate Veg (0.4-0.6)', 'Dense Veg (>0.6)']
+WEEK3_CLASS_LABELS = ['Urban/Concrete', 'Sparse Vegetation', 'Moderate Vegetation', 'Dense Vegetation']
+
+# Urban / rural split used for the UHI intensity
+URBAN_MAX_NDVI = 0.3
+RURAL_MIN_NDVI = 0.6
+
+
+def valid_pixels(ndvi, *arrays):
+    """Single validity mask: finite everywhere and NDVI within [-1, 1]"""
+    valid = np.isfinite(ndvi) & (ndvi >= -1) & (ndvi <= 1)
+    for arr in arrays:
+        valid &= np.isfinite(arr)
+    return valid
+
+
+def _class_quantile(sorted_values, starts, counts, q):
+    """Linear-interpolated quantile (numpy default) of each non-empty sorted class slice"""
+    out = np.full(len(counts), np.nan)
+    nonempty = counts > 0
+    pos = q * (counts[nonempty] - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, counts[nonempty] - 1)
+    frac = pos - lo
+    base = starts[nonempty]
+    out[nonempty] = sorted_values[base + lo] * (1 - frac) + sorted_values[base + hi] * frac
+    return out
+
+
+def binned_stats(ndvi, values, edges=NDVI_CLASS_EDGES, labels=None, quantiles=(0.25, 0.5, 0.75)):
+    """
+    Per NDVI class statistics of `values` in one vectorized pass.
+
+    Pixels are binned with np.digitize (class i holds edges[i-1] <= NDVI < edges[i],
+    as in the original classify_* functions). Returns a DataFrame indexed by
+    class label with count, mean, std (ddof=1), abs_mean, ndvi_mean, min, max,
+    the requested quantiles (q25, q50, ...) and 1.5 IQR whisker ends for boxplots.
+    Invalid pixels (NaN, NDVI outside [-1, 1]) are ignored.
+    """
+    ndvi = np.asarray(ndvi).ravel()
+    values = np.asarray(values).ravel()
+    valid = valid_pixels(ndvi, values)
+    ndvi = ndvi[valid]
+    values = values[valid].astype(np.float64, copy=False)
+
+    n_classes = len(edges) + 1
+    if labels is None:
+        labels = [f"class_{i}" for i in range(n_classes)]
+    classes = np.digitize(ndvi, edges)
+
+    count = np.bincount(classes, minlength=n_classes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(classes, weights=values, minlength=n_classes) / count
+        ndvi_mean = np.bincount(classes, weights=ndvi, minlength=n_classes) / count
+        abs_mean = np.bincount(classes, weights=np.abs(values), minlength=n_classes) / count
+        sq_dev = np.bincount(classes, weights=(values - mean[classes]) ** 2, minlength=n_classes)
+        std = np.sqrt(sq_dev / (count - 1))
+    std[count < 2] = np.nan
+
+    table = pd.DataFrame({
+        'count': count,
+        'mean': mean,
+        'std': std,
+        'abs_mean': abs_mean,
+        'ndvi_mean': ndvi_mean,
+    }, index=pd.Index(labels, name='class'))
+
+    # One sort by (class, value) gives every class as a contiguous sorted slice
+    order = np.lexsort((values, classes))
+    sorted_values = values[order]
+    starts = np.concatenate([[0], np.cumsum(count)[:-1]])
+    nonempty = count > 0
+    table['min'] = np.nan
+    table['max'] = np.nan
+    table.loc[nonempty, 'min'] = sorted_values[starts[nonempty]]
+    table.loc[nonempty, 'max'] = sorted_values[starts[nonempty] + count[nonempty] - 1]
+    for q in quantiles:
+        table[f'q{int(round(q * 100))}'] = _class_quantile(sorted_values, starts, count, q)
+
+    if 0.25 in quantiles and 0.75 in quantiles:
+        iqr = table['q75'].values - table['q25'].values
+        whislo = np.full(n_classes, np.nan)
+        whishi = np.full(n_classes, np.nan)
+        for i in np.flatnonzero(nonempty):
+            cls = sorted_values[starts[i]:starts[i] + count[i]]
+            # Whiskers reach the most extreme data point within 1.5 IQR of the box
+            lo = np.searchsorted(cls, table['q25'].values[i] - 1.5 * iqr[i], side='left')
+            hi = np.searchsorted(cls, table['q75'].values[i] + 1.5 * iqr[i], side='right') - 1
+            whislo[i] = cls[lo]
+            whishi[i] = cls[hi]
+        table['whislo'] = whislo
+        table['whishi'] = whishi
+    return table
+
+
+def uhi_intensity(ndvi, temperature, urban_max=URBAN_MAX_NDVI, rural_min=RURAL_MIN_NDVI):
+    """Mean temperature of urban (NDVI < urban_max) and rural (NDVI > rural_min) pixels and their difference"""
+    ndvi = np.asarray(ndvi).ravel()
+    temperature = np.asarray(temperature).ravel()
+    valid = valid_pixels(ndvi, temperature)
+    urban = valid & (ndvi < urban_max)
+    rural = valid & (ndvi > rural_min)
+    avg_urban = temperature[urban].mean(dtype=np.float64) if urban.any() else np.nan
+    avg_rural = temperature[rural].mean(dtype=np.float64) if rural.any() else np.nan
+    return avg_urban, avg_rural, avg_urban - avg_rural
+
+
+def boxplot_stats(table):
+    """Convert a binned_stats table into the list of dicts expected by Axes.bxp"""
+    return [
+        {'label': label, 'med': row['q50'], 'q1': row['q25'], 'q3': row['q75'],
+         'whislo': row['whislo'], 'whishi': row['whishi'], 'mean': row['mean'], 'fliers': []}
+        for label, row in table.iterrows() if row['count'] > 0
+    ]
+
+
+def plot_class_boxplot(ax, table, colors, width=0.8):
+    """Draw the per-class boxplot straight from a binned_stats table (fliers omitted)"""
+    positions = [i for i, n in enumerate(table['count']) if n > 0]
+    present = table.iloc[positions]
+    artists = ax.bxp(boxplot_stats(present), positions=positions, widths=width,
+                     showfliers=False, patch_artist=True)
+    for patch, label in zip(artists['boxes'], present.index):
+        patch.set_facecolor(colors[label])
+    ax.set_xticks(range(len(table)), table.index)
+    return artists
@@ -0,0 +1,140 @@
+import numpy as np
+from scipy import stats as sps
+
+# Rows promoted to float64 at a time by MomentAccumulator.update
+UPDATE_CHUNK = 1 << 20
+
+
+class MomentAccumulator:
+    """
+    Streaming count / mean / variance / covariance / min / max of a few variables.
+
+    Chunks are folded in with update() and partial results (other chunks, cities,
+    worker processes) combined with merge(), using the pairwise Welford/Chan
+    update of the mean vector and co-moment matrix, so the pixel arrays never have
+    to be held together. Only rows where every variable is finite are counted
+    (like DataFrame.dropna()). Instances are small and picklable.
+    """
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        k = len(self.names)
+        self.count = 0
+        self.mean = np.zeros(k)
+        self.comoment = np.zeros((k, k))
+        self.min = np.full(k, np.inf)
+        self.max = np.full(k, -np.inf)
+
+    def _index(self, name):
+        return self.names.index(name)
+
+    def update(self, *columns, where=None, chunk_size=UPDATE_CHUNK):
+        """
+        Add one chunk: one array per variable (any shape, flattened), optional
+        boolean `where` mask. Columns may be float32; they are promoted to float64
+        chunk_size rows at a time, so no full float64 copy of the input is made.
+        """
+        if len(columns) != len(self.names):
+            raise ValueError(f"Expected {len(self.names)} columns ({', '.join(self.names)}), got {len(columns)}")
+        columns = [np.ravel(c) for c in columns]
+        where = np.ravel(where) if where is not None else None
+        n = len(columns[0])
+        if n > chunk_size:
+            for start in range(0, n, chunk_size):
+                part = slice(start, start + chunk_size)
+                self.update(*[c[part] for c in columns], where=where[part] if where is not None else None,
+                            chunk_size=chunk_size)
+            return self
+
+        x = np.column_stack(columns).astype(np.float64, copy=False)
+        valid = np.isfinite(x).all(axis=1)
+        if where is not None:
+            valid &= where
+        x = x[valid]
+        if len(x) == 0:
+            return self
+
+        chunk = MomentAccumulator(self.names)
+        chunk.count = len(x)
+        chunk.mean = x.mean(axis=0)
+        centred = x - chunk.mean
+        chunk.comoment = centred.T @ centred
+        chunk.min = x.min(axis=0)
+        chunk.max = x.max(axis=0)
+        return self.merge(chunk)
+
+    def merge(self, other):
+        """Fold another accumulator of the same variables into this one (Chan et al.)"""
+        if other.names != self.names:
+            raise ValueError(f"Cannot merge accumulators of {other.names} into {self.names}")
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count = other.count
+            self.mean = other.mean.copy()
+            self.comoment = other.comoment.copy()
+            self.min = other.min.copy()
+            self.max = other.max.copy()
+            return self
+        n = self.count + other.count
+        delta = other.mean - self.mean
+        self.comoment = self.comoment + other.comoment + np.outer(delta, delta) * self.count * other.count / n
+        self.mean = self.mean + delta * other.count / n
+        self.count = n
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def mean_of(self, name):
+        return self.mean[self._index(name)] if self.count else np.nan
+
+    def min_of(self, name):
+        return self.min[self._index(name)] if self.count else np.nan
+
+    def max_of(self, name):
+        return self.max[self._index(name)] if self.count else np.nan
+
+    def var(self, name, ddof=1):
+        i = self._index(name)
+        return self.comoment[i, i] / (self.count - ddof) if self.count > ddof else np.nan
+
+    def std(self, name, ddof=1):
+        return np.sqrt(self.var(name, ddof))
+
+    def cov(self, a, b, ddof=1):
+        return self.comoment[self._index(a), self._index(b)] / (self.count - ddof) if self.count > ddof else np.nan
+
+    def rms(self, name):
+        """Root mean square of a variable, e.g. RMSE of a difference"""
+        if not self.count:
+            return np.nan
+        i = self._index(name)
+        return np.sqrt(self.comoment[i, i] / self.count + self.mean[i] ** 2)
+
+    def corr(self, a, b):
+        i, j = self._index(a), self._index(b)
+        denom = np.sqrt(self.comoment[i, i] * self.comoment[j, j])
+        return self.comoment[i, j] / denom if self.count > 1 and denom > 0 else np.nan
+
+    def regression(self, x, y):
+        """Least-squares line y = slope * x + intercept, as (slope, intercept)"""
+        i, j = self._index(x), self._index(y)
+        if self.count < 2 or self.comoment[i, i] <= 0:
+            return np.nan, np.nan
+        slope = self.comoment[i, j] / self.comoment[i, i]
+        return slope, self.mean[j] - slope * self.mean[i]
+
+    def pearsonr(self, a, b):
+        """Pearson r and two-sided p-value (t-test with n - 2 degrees of freedom, as scipy.stats.pearsonr)"""
+        r = self.corr(a, b)
+        dof = self.count - 2
+        if not np.isfinite(r) or dof < 1:
+            return r, np.nan
+        r = float(np.clip(r, -1.0, 1.0))
+        if abs(r) == 1.0:
+            return r, 0.0
+        t = r * np.sqrt(dof / (1 - r * r))
+        return r, 2 * sps.t.sf(abs(t), dof)
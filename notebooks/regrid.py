@@ -0,0 +1,171 @@
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import xarray as xr
+import scipy.sparse as sp
+
+REGRID_METHODS = ('linear', 'nearest', 'conservative')
+
+# Operators already built in this process, keyed by grids + method, least
+# recently used first; at most MAX_OPERATORS are kept
+MAX_OPERATORS = 8
+_OPERATORS = OrderedDict()
+
+
+def _cell_edges(centres):
+    """Cell edges of an ascending 1D grid of cell centres"""
+    mid = (centres[1:] + centres[:-1]) / 2
+    first = centres[0] - (mid[0] - centres[0]) if len(centres) > 1 else centres[0] - 0.5
+    last = centres[-1] + (centres[-1] - mid[-1]) if len(centres) > 1 else centres[-1] + 0.5
+    return np.concatenate([[first], mid, [last]])
+
+
+def axis_weights(src, dst, method='linear'):
+    """
+    Sparse (len(dst), len(src)) interpolation weights along one axis.
+
+    Axes may be ascending or descending. Targets outside the source range get an
+    empty row ('linear', 'nearest') or are weighted by the covered part only
+    ('conservative', empty when there is no overlap).
+    """
+    if method not in REGRID_METHODS:
+        raise ValueError(f"Unknown regrid method '{method}', expected one of {REGRID_METHODS}")
+    src = np.asarray(src, dtype=float)
+    dst = np.asarray(dst, dtype=float)
+    order = np.argsort(src)
+    s = src[order]
+    rows, cols, vals = [], [], []
+
+    if method == 'conservative':
+        s_edges = _cell_edges(s)
+        d_order = np.argsort(dst)
+        d_edges_sorted = _cell_edges(dst[d_order])
+        d_lo = np.empty(len(dst))
+        d_hi = np.empty(len(dst))
+        d_lo[d_order] = d_edges_sorted[:-1]
+        d_hi[d_order] = d_edges_sorted[1:]
+        for j in range(len(dst)):
+            first = max(np.searchsorted(s_edges, d_lo[j], side='right') - 1, 0)
+            last = min(np.searchsorted(s_edges, d_hi[j], side='left'), len(s))
+            overlap = np.minimum(s_edges[first + 1:last + 1], d_hi[j]) - np.maximum(s_edges[first:last], d_lo[j])
+            keep = overlap > 0
+            if keep.any():
+                rows.append(np.full(keep.sum(), j))
+                cols.append(order[first:last][keep])
+                vals.append(overlap[keep] / overlap[keep].sum())
+    else:
+        inside = (dst >= s[0]) & (dst <= s[-1])
+        j = np.flatnonzero(inside)
+        if method == 'nearest':
+            pos = np.searchsorted(s, dst[j])
+            lo = np.clip(pos - 1, 0, len(s) - 1)
+            hi = np.clip(pos, 0, len(s) - 1)
+            pick = np.where(np.abs(dst[j] - s[lo]) <= np.abs(s[hi] - dst[j]), lo, hi)
+            rows, cols, vals = [j], [order[pick]], [np.ones(len(j))]
+        else:
+            hi = np.clip(np.searchsorted(s, dst[j], side='right'), 1, len(s) - 1) if len(s) > 1 else np.zeros(len(j), int)
+            lo = np.maximum(hi - 1, 0)
+            span = s[hi] - s[lo]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                frac = np.where(span > 0, (dst[j] - s[lo]) / span, 0.0)
+            rows, cols, vals = [j, j], [order[lo], order[hi]], [1 - frac, frac]
+
+    if rows:
+        rows, cols, vals = np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+    m = sp.csr_matrix((vals, (rows, cols)), shape=(len(dst), len(src)))
+    # Exact-node hits leave zero weights, which must not propagate NaN neighbours
+    m.eliminate_zeros()
+    return m
+
+
+class RegridOperator:
+    """
+    Precomputed (source grid -> target grid) weights as one sparse matrix.
+
+    Built once per grid pair and method, then applied to any (..., lat, lon)
+    stack with a single sparse-dense product. NaN sources propagate to the target
+    cells that use them (like DataArray.interp); target cells without source
+    coverage are NaN.
+    """
+
+    def __init__(self, src_lat, src_lon, dst_lat, dst_lon, method='linear', matrix=None):
+        self.src_shape = (len(src_lat), len(src_lon))
+        self.dst_shape = (len(dst_lat), len(dst_lon))
+        self.dst_lat = np.asarray(dst_lat)
+        self.dst_lon = np.asarray(dst_lon)
+        self.method = method
+        if matrix is None:
+            # Separable 2D weights: kron of the per-axis weights (row-major lat, lon)
+            matrix = sp.kron(axis_weights(src_lat, dst_lat, method),
+                             axis_weights(src_lon, dst_lon, method), format='csr')
+        self.matrix = matrix.tocsr()
+        self.uncovered = np.diff(self.matrix.indptr) == 0
+
+    def __call__(self, values, dtype=None):
+        """Regrid a (..., lat, lon) numpy array (in float64, or in `dtype` such as float32)"""
+        values = np.asarray(values)
+        matrix = self.matrix
+        if dtype is not None:
+            values = values.astype(dtype, copy=False)
+            matrix = matrix.astype(dtype, copy=False)
+        lead = values.shape[:-2]
+        flat = values.reshape(-1, self.src_shape[0] * self.src_shape[1]).T
+        out = np.asarray(matrix @ flat).T
+        out[:, self.uncovered] = np.nan
+        return out.reshape(lead + self.dst_shape)
+
+    def apply(self, da, lat_dim='latitude', lon_dim='longitude', dtype=None):
+        """Regrid a DataArray whose last two dims are (lat_dim, lon_dim), keeping the leading dims"""
+        da = da.transpose(..., lat_dim, lon_dim)
+        coords = {name: c for name, c in da.coords.items() if lat_dim not in c.dims and lon_dim not in c.dims}
+        coords[lat_dim] = self.dst_lat
+        coords[lon_dim] = self.dst_lon
+        return xr.DataArray(self(da.values, dtype), dims=da.dims, coords=coords, name=da.name, attrs=da.attrs)
+
+
+def _grid_key(src_lat, src_lon, dst_lat, dst_lon, method):
+    h = hashlib.sha256(method.encode())
+    for arr in (src_lat, src_lon, dst_lat, dst_lon):
+        h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def regrid_operator(src_lat, src_lon, dst_lat, dst_lon, method='linear', cache_dir=None):
+    """
+    Return the operator for this grid pair, reusing the last MAX_OPERATORS built
+    in this process (and building it once overall when cache_dir is given, as a
+    .npz sparse matrix).
+    """
+    key = _grid_key(src_lat, src_lon, dst_lat, dst_lon, method)
+    if key in _OPERATORS:
+        _OPERATORS.move_to_end(key)
+        return _OPERATORS[key]
+
+    matrix = None
+    path = os.path.join(cache_dir, f"regrid_{method}_{key[:20]}.npz") if cache_dir else None
+    if path and os.path.exists(path):
+        matrix = sp.load_npz(path)
+    op = RegridOperator(src_lat, src_lon, dst_lat, dst_lon, method, matrix)
+    if path and matrix is None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = path + f".{os.getpid()}.tmp.npz"
+        sp.save_npz(tmp_path, op.matrix)
+        os.replace(tmp_path, path)
+    _OPERATORS[key] = op
+    while len(_OPERATORS) > MAX_OPERATORS:
+        _OPERATORS.popitem(last=False)
+    return op
+
+
+def clear_operators():
+    """Drop the operators kept in this process"""
+    _OPERATORS.clear()
+
+
+def upsample_grid(lat, lon, factor):
+    """The 'factor x' finer grid spanning the same cell centres, as used by the aligned stacks"""
+    new_lat = np.linspace(float(np.min(lat)), float(np.max(lat)), len(lat) * factor)
+    new_lon = np.linspace(float(np.min(lon)), float(np.max(lon)), len(lon) * factor)
+    return new_lat, new_lon
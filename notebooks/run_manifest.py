@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import hashlib
+
+import numpy as np
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+def file_signature(path):
+    """Size and mtime of a file: inputs count as changed when either changes (as the aligned-stack cache)"""
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def unit_key(name, country_code, city_name, year):
+    return f"{name}/{country_code}/{city_name}/{year}"
+
+
+class RunManifest:
+    """
+    Append-only JSON-lines log of the units (analysis, city, year) of batch runs.
+
+    Each finished unit appends one line with its parameters, input file
+    signatures (path, size, mtime), fingerprint, status, stats, outputs and
+    timing, so results survive a failure or a killed job. On the next run, units
+    whose fingerprint (parameters + input signatures) is unchanged and whose
+    outputs still exist are skipped; the last line of a unit wins. Inputs are not
+    read: the multi-GB ERA5 and NDVI files are only stat'ed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._units = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # line cut short by a killed run
+                        continue
+                    if entry.get('kind') == 'unit':
+                        self._units[entry['unit']] = entry
+
+    def _append(self, entry):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry, default=_json_default) + "\n")
+
+    def fingerprint(self, params, input_files):
+        """Hash of the parameters and the path, size and mtime of every input file"""
+        inputs = {os.path.abspath(f): file_signature(f) for f in input_files}
+        payload = json.dumps({'params': params, 'inputs': inputs}, sort_keys=True, default=_json_default)
+        return hashlib.sha256(payload.encode()).hexdigest(), inputs
+
+    def previous(self, key):
+        """Last logged entry of a unit, or None"""
+        return self._units.get(key)
+
+    def is_current(self, key, fingerprint, retry_failed=False):
+        """True if the unit already ran with this fingerprint and its outputs are still there"""
+        entry = self._units.get(key)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return False
+        if retry_failed and entry['status'] == 'failed':
+            return False
+        return all(os.path.exists(p) for p in entry.get('outputs', []))
+
+    def record(self, key, fingerprint, params, inputs, record):
+        """Log a finished unit (a city_runner record) right away"""
+        entry = {'kind': 'unit', 'unit': key, 'finished': time.time(), 'fingerprint': fingerprint,
+                 'params': params, 'inputs': inputs}
+        entry.update({k: v for k, v in record.items() if k != 'traceback'})
+        self._append(entry)
+        self._units[key] = json.loads(json.dumps(entry, default=_json_default))
+        return entry
@@ -0,0 +1,167 @@
+import os
+import re
+import argparse
+import numpy as np
+import pandas as pd
+from glob import glob
+
+from era5_access import ERA5Archive
+from gadm_index import GADMIndex
+from aligned_grid import study_area_from_city
+from landmask import rasterize_land, mask_multiplier
+from ndvi_access import read_ndvi_window, ndvi_from_raw
+
+# DJF of year Y is Dec (Y-1) + Jan/Feb Y, carried over from the previous year's pass
+SEASON_MONTHS = {'DJF': (12, 1, 2), 'MAM': (3, 4, 5), 'JJA': (6, 7, 8), 'SON': (9, 10, 11)}
+EXCEEDANCE_THRESHOLDS = (25, 30, 35)
+NDVI_FILE_PATTERN = re.compile(r"ndvi_(\d{4}-\d{2}-\d{2})_(\d{4}-\d{2}-\d{2})\.tif$")
+
+
+def period_stats(temps_c, thresholds=EXCEEDANCE_THRESHOLDS):
+    """Spatial summary of a (time, lat, lon) block of daily maxima in °C"""
+    stats = {'n_days': temps_c.shape[0]}
+    if temps_c.shape[0] == 0 or not np.isfinite(temps_c).any():
+        stats.update({'mean_tmax': np.nan, 'max_tmax': np.nan, 'p95_tmax': np.nan})
+        stats.update({f'days_above_{t}': np.nan for t in thresholds})
+        return stats
+
+    cells = np.isfinite(temps_c).any(axis=0)
+    stats['mean_tmax'] = float(np.nanmean(temps_c))
+    stats['max_tmax'] = float(np.nanmax(temps_c))
+    stats['p95_tmax'] = float(np.nanpercentile(temps_c, 95))
+    for t in thresholds:
+        # Exceedance days per cell, averaged over the valid cells of the window
+        stats[f'days_above_{t}'] = float((temps_c > t).sum(axis=0)[cells].mean())
+    return stats
+
+
+def list_ndvi_periods(ndvi_folder):
+    periods = []
+    for path in sorted(glob(os.path.join(ndvi_folder, "ndvi_*.tif"))):
+        match = NDVI_FILE_PATTERN.search(os.path.basename(path))
+        if match:
+            periods.append((pd.Timestamp(match.group(1)), pd.Timestamp(match.group(2)), path))
+    return periods
+
+
+def match_ndvi_file(ndvi_periods, start, end):
+    """NDVI file whose [start, end) period overlaps the season the most, or None"""
+    best, best_overlap = None, pd.Timedelta(0)
+    for p_start, p_end, path in ndvi_periods:
+        overlap = min(end, p_end) - max(start, p_start)
+        if overlap > best_overlap:
+            best, best_overlap = path, overlap
+    return best
+
+
+def ndvi_window_mean(ndvi_file, bounds, overview_dir=None, max_pixels=512):
+    """Mean NDVI over bounds (EPSG:4326), from the coarsest overview level giving ~max_pixels across"""
+    target_res = max(bounds[2] - bounds[0], bounds[3] - bounds[1]) / max_pixels
+    with read_ndvi_window(ndvi_file, bounds, overview_dir=overview_dir, target_res=target_res, pad=0) as window:
+        ndvi = ndvi_from_raw(window.dataset.read(1), window.dataset.nodata)
+    if not np.isfinite(ndvi).any():
+        return np.nan
+    return float(np.nanmean(ndvi))
+
+
+def aggregate_city(archive, gadm_index, country_code, city_name, years, ndvi_periods,
+                   buffer_degree=0.2, thresholds=EXCEEDANCE_THRESHOLDS, ndvi_overview_dir=None):
+    """One read of each yearly ERA5 window -> rows for every season and the full year"""
+    city_gdf, level = gadm_index.find_city(country_code, city_name)
+    if city_gdf.empty:
+        print(f"Error: City {city_name} not found in GADM data for {country_code}.")
+        return []
+    bounds = tuple(study_area_from_city(city_gdf, buffer_degree).total_bounds)
+    land_gdf = gadm_index.land(bounds)
+    # Several season rows (and years) can match the same NDVI file: read each window once
+    ndvi_means = {}
+
+    rows = []
+    prev_december, prev_year = None, None
+    for year in sorted(years):
+        if not os.path.exists(archive.path(year)):
+            print(f"  {city_name}: no ERA5 file for {year}")
+            continue
+
+        # Single windowed read of the whole year for this city
+        window = archive.window(year, bounds).load()
+        temps = window.values - 273.15
+        land = mask_multiplier(rasterize_land(land_gdf, window.latitude.values, window.longitude.values))
+        temps *= land
+        months = pd.DatetimeIndex(window.valid_time.values).month
+
+        periods = {}
+        for season, season_months in SEASON_MONTHS.items():
+            if season == 'DJF':
+                block = temps[np.isin(months, (1, 2))]
+                if prev_december is not None and prev_year == year - 1:
+                    block = np.concatenate([prev_december, block])
+            else:
+                block = temps[np.isin(months, season_months)]
+            periods[season] = block
+        periods['ANN'] = temps
+        prev_december, prev_year = temps[months == 12], year
+
+        season_start = {
+            'DJF': pd.Timestamp(f"{year - 1}-12-01"), 'MAM': pd.Timestamp(f"{year}-03-01"),
+            'JJA': pd.Timestamp(f"{year}-06-01"), 'SON': pd.Timestamp(f"{year}-09-01"),
+            'ANN': pd.Timestamp(f"{year}-01-01"),
+        }
+        for season, block in periods.items():
+            start = season_start[season]
+            end = start + pd.DateOffset(years=1) if season == 'ANN' else start + pd.DateOffset(months=3)
+            ndvi_file = match_ndvi_file(ndvi_periods, start, end)
+            row = {'country': country_code, 'city': city_name, 'year': year, 'season': season}
+            row.update(period_stats(block, thresholds))
+            row['ndvi_file'] = os.path.basename(ndvi_file) if ndvi_file else None
+            if ndvi_file and (ndvi_file, bounds) not in ndvi_means:
+                ndvi_means[(ndvi_file, bounds)] = ndvi_window_mean(ndvi_file, bounds, ndvi_overview_dir)
+            row['ndvi_mean'] = ndvi_means[(ndvi_file, bounds)] if ndvi_file else np.nan
+            rows.append(row)
+        print(f"  {city_name} {year}: {temps.shape[0]} days, {temps.shape[1]}x{temps.shape[2]} cells")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="City x year x season ERA5 temperature matrix in one I/O pass")
+    parser.add_argument('--years', type=int, nargs='+', default=list(range(2020, 2026)))
+    args = parser.parse_args()
+
+    print("="*60)
+    print("MULTI-YEAR SEASONAL AGGREGATION")
+    print("="*60)
+
+    DATA_FOLDER = "data"
+    OUTPUT_FOLDER = "reports/figures"
+    GADM_FILE = os.path.join(DATA_FOLDER, "gadm_410_europe.gpkg")
+    ERA5_FOLDER = os.path.join(DATA_FOLDER, "derived-era5-land-daily-statistics")
+    NDVI_FOLDER = os.path.join(DATA_FOLDER, "sentinel2_ndvi")
+    GADM_INDEX_FILE = os.path.join(DATA_FOLDER, "cache", "gadm_index.pkl")
+    NDVI_OVERVIEW_FOLDER = os.path.join(DATA_FOLDER, "cache", "ndvi_overviews")
+
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+
+    cities = [
+        ("FRA", "Paris"),
+        ("ITA", "Roma"),
+        ("FRA", "Nantes"),
+        ("ITA", "Perugia")
+    ]
+
+    gadm_index = GADMIndex(GADM_FILE, index_file=GADM_INDEX_FILE)
+    ndvi_periods = list_ndvi_periods(NDVI_FOLDER)
+
+    rows = []
+    with ERA5Archive(ERA5_FOLDER) as archive:
+        for country, city in cities:
+            rows.extend(aggregate_city(archive, gadm_index, country, city, args.years, ndvi_periods,
+                                       ndvi_overview_dir=NDVI_OVERVIEW_FOLDER))
+
+    df = pd.DataFrame(rows)
+    out_file = os.path.join(OUTPUT_FOLDER, "seasonal_summary_table.csv")
+    df.to_csv(out_file, index=False)
+    print(f"\nSeasonal table saved: {out_file} ({len(df)} rows)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+import os
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+from figures import FigureRenderer, FIGURE_MODES
+from city_runner import run_cities, print_failures
+from landmask import mask_multiplier
+from ndvi_stats import valid_pixels, URBAN_MAX_NDVI, RURAL_MIN_NDVI
+from online_stats import UPDATE_CHUNK
+from aligned_grid import load_aligned_stack
+from instrumentation import Tracer, stage, print_trace_summary
+from week3_team19 import BUFFER_DEGREE, SEASON, prefetch_city_week3
+
+# Default grids: week3's correction factor (0.5 in the analysis) and week2's
+# urban / rural NDVI thresholds (0.3 / 0.6)
+CORRECTION_FACTORS = tuple(np.round(np.arange(0.0, 1.01, 0.1), 2))
+URBAN_MAX_GRID = tuple(np.round(np.arange(0.1, 0.41, 0.05), 2))
+RURAL_MIN_GRID = tuple(np.round(np.arange(0.5, 0.81, 0.05), 2))
+CORRECTION_METRICS = ('rmse', 'mean_discrepancy', 'correlation_discrepancy_ndvi', 'correlation_sat_ground')
+
+
+def correction_sweep(ndvi, temp_sat, factors=CORRECTION_FACTORS, chunk_size=UPDATE_CHUNK):
+    """
+    Week3 metrics for every correction factor at once.
+
+    Ground truth is modelled as in analyze_city_week3 (satellite - (1 - NDVI) *
+    factor). The discrepancies of all factors are built as one factors x pixels
+    broadcast, a block of pixels at a time (at most chunk_size values), and
+    reduced to sums, so the pixels are read once whatever the number of factors.
+    Returns one row per factor with CORRECTION_METRICS.
+    """
+    factors = np.asarray(factors, dtype=np.float64)
+    valid = valid_pixels(ndvi, temp_sat)
+    ndvi = np.asarray(ndvi)[valid]
+    temp_sat = np.asarray(temp_sat)[valid]
+    n = len(ndvi)
+    if n == 0:
+        return pd.DataFrame({'correction_factor': factors, **{m: np.nan for m in CORRECTION_METRICS}})
+
+    # Centred NDVI and satellite temperature keep the sums well conditioned
+    ndvi_mean = ndvi.mean(dtype=np.float64)
+    sat_mean = temp_sat.mean(dtype=np.float64)
+    sum_d = np.zeros(len(factors))
+    sum_d2 = np.zeros(len(factors))
+    sum_a = np.zeros(len(factors))
+    sum_a_ndvi = np.zeros(len(factors))
+    sum_d_sat = np.zeros(len(factors))
+    ndvi_var = sat_var = 0.0
+    rows = max(1, chunk_size // len(factors))
+    for start in range(0, n, rows):
+        ndvi_c = ndvi[start:start + rows].astype(np.float64) - ndvi_mean
+        sat_c = temp_sat[start:start + rows].astype(np.float64) - sat_mean
+        diff = factors[:, None] * ((1 - ndvi_mean) - ndvi_c)[None, :]
+        abs_diff = np.abs(diff)
+        sum_d += diff.sum(axis=1)
+        sum_d2 += np.einsum('ij,ij->i', diff, diff)
+        sum_a += abs_diff.sum(axis=1)
+        sum_a_ndvi += abs_diff @ ndvi_c
+        sum_d_sat += diff @ sat_c
+        ndvi_var += ndvi_c @ ndvi_c
+        sat_var += sat_c @ sat_c
+
+    mean_d = sum_d / n
+    mean_a = sum_a / n
+    ndvi_var /= n
+    sat_var /= n
+    var_d = sum_d2 / n - mean_d ** 2
+    var_a = sum_d2 / n - mean_a ** 2
+    cov_d_sat = sum_d_sat / n
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr_a_ndvi = (sum_a_ndvi / n) / np.sqrt(var_a * ndvi_var)
+        # ground = satellite - discrepancy
+        corr_sat_ground = (sat_var - cov_d_sat) / np.sqrt(sat_var * (sat_var - 2 * cov_d_sat + var_d))
+    return pd.DataFrame({
+        'correction_factor': factors,
+        'rmse': np.sqrt(sum_d2 / n),
+        'mean_discrepancy': mean_d,
+        'correlation_discrepancy_ndvi': np.where(var_a > 0, corr_a_ndvi, np.nan),
+        'correlation_sat_ground': corr_sat_ground,
+    })
+
+
+def uhi_sweep(ndvi, temperature, urban_max=URBAN_MAX_GRID, rural_min=RURAL_MIN_GRID):
+    """
+    Week2 UHI intensity for every (urban_max, rural_min) threshold pair at once.
+
+    Pixels are sorted by NDVI once; the urban (NDVI < urban_max) and rural
+    (NDVI > rural_min) means of all pairs then come from one cumulative sum of
+    the temperatures and a searchsorted of the thresholds, as in uhi_intensity.
+    Pairs with urban_max > rural_min are left NaN. Returns one row per pair.
+    """
+    valid = valid_pixels(ndvi, temperature)
+    ndvi = np.asarray(ndvi)[valid]
+    order = np.argsort(ndvi, kind='stable')
+    ndvi = ndvi[order]
+    cumsum = np.concatenate([[0.0], np.cumsum(np.asarray(temperature)[valid][order], dtype=np.float64)])
+
+    # Thresholds compared in the pixels' dtype, like `ndvi < urban_max`
+    urban, rural = np.meshgrid(np.asarray(urban_max, dtype=np.float64), np.asarray(rural_min, dtype=np.float64),
+                               indexing='ij')
+    n_urban = np.searchsorted(ndvi, urban.astype(ndvi.dtype), side='left')
+    first_rural = np.searchsorted(ndvi, rural.astype(ndvi.dtype), side='right')
+    n_rural = len(ndvi) - first_rural
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg_urban = np.where(n_urban > 0, cumsum[n_urban] / n_urban, np.nan)
+        avg_rural = np.where(n_rural > 0, (cumsum[-1] - cumsum[first_rural]) / n_rural, np.nan)
+    uhi = np.where(urban <= rural, avg_urban - avg_rural, np.nan)
+    return pd.DataFrame({
+        'urban_max_ndvi': urban.ravel(),
+        'rural_min_ndvi': rural.ravel(),
+        'avg_temp_urban': avg_urban.ravel(),
+        'avg_temp_rural': avg_rural.ravel(),
+        'uhi_intensity': uhi.ravel(),
+        'n_urban': n_urban.ravel(),
+        'n_rural': n_rural.ravel(),
+    })
+
+
+def tidy_sweeps(correction, uhi):
+    """Both sweeps as one long table: parameters, metric, value"""
+    correction = correction.melt(id_vars=['correction_factor'], var_name='metric')
+    correction.insert(0, 'sweep', 'correction_factor')
+    uhi = uhi.melt(id_vars=['urban_max_ndvi', 'rural_min_ndvi'], var_name='metric')
+    uhi.insert(0, 'sweep', 'uhi_thresholds')
+    return pd.concat([correction, uhi], ignore_index=True)[
+        ['sweep', 'correction_factor', 'urban_max_ndvi', 'rural_min_ndvi', 'metric', 'value']]
+
+
+def plot_sensitivity(out_path, correction, uhi, city_name, year):
+    fig, (ax_uhi, ax_corr) = plt.subplots(1, 2, figsize=(16, 6), gridspec_kw={'width_ratios': [1, 1.4]})
+
+    # UHI intensity over the threshold grid, default split outlined
+    grid = uhi.pivot(index='rural_min_ndvi', columns='urban_max_ndvi', values='uhi_intensity')
+    im = ax_uhi.imshow(grid.to_numpy(), origin='lower', cmap='OrRd', aspect='auto')
+    for (i, j), value in np.ndenumerate(grid.to_numpy()):
+        if np.isfinite(value):
+            ax_uhi.text(j, i, f"{value:.2f}", ha='center', va='center', fontsize=8)
+    if URBAN_MAX_NDVI in grid.columns and RURAL_MIN_NDVI in grid.index:
+        j, i = grid.columns.get_loc(URBAN_MAX_NDVI), grid.index.get_loc(RURAL_MIN_NDVI)
+        ax_uhi.add_patch(plt.Rectangle((j - 0.5, i - 0.5), 1, 1, fill=False, lw=2, edgecolor='black'))
+    ax_uhi.set_xticks(range(len(grid.columns)), [f"{v:.2f}" for v in grid.columns])
+    ax_uhi.set_yticks(range(len(grid.index)), [f"{v:.2f}" for v in grid.index])
+    ax_uhi.set_xlabel("Urban: NDVI below")
+    ax_uhi.set_ylabel("Rural: NDVI above")
+    ax_uhi.set_title("UHI Intensity (°C)")
+    fig.colorbar(im, ax=ax_uhi, label="Urban - Rural (°C)")
+
+    # Week3 metrics per correction factor, coloured within each metric's own range
+    values = correction.set_index('correction_factor')[list(CORRECTION_METRICS)].T
+    lo = values.min(axis=1).to_numpy()[:, None]
+    span = (values.max(axis=1).to_numpy()[:, None] - lo)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Rows constant up to rounding (e.g. a correlation of -1 at every factor) stay flat
+        scaled = np.where(span > 1e-9, (values.to_numpy() - lo) / span, 0.5)
+    ax_corr.imshow(scaled, cmap='YlOrRd', aspect='auto', vmin=0, vmax=1)
+    for (i, j), value in np.ndenumerate(values.to_numpy()):
+        ax_corr.text(j, i, f"{value:.2f}", ha='center', va='center', fontsize=8)
+    ax_corr.set_xticks(range(values.shape[1]), [f"{v:.2f}" for v in values.columns])
+    ax_corr.set_yticks(range(values.shape[0]), [m.replace('_', ' ') for m in values.index])
+    ax_corr.set_xlabel("Correction Factor")
+    ax_corr.set_title("Satellite vs Modelled Ground Truth")
+
+    fig.suptitle(f"Sensitivity - {city_name} ({year})", fontsize=14, fontweight='bold')
+    plt.tight_layout()
+    plt.savefig(out_path, dpi=150)
+    plt.close()
+    print(f"Saved sensitivity heatmap: {out_path}")
+
+
+def analyze_city_sensitivity(country_code, city_name, year, gadm_index, era5_folder, ndvi_folder, output_folder,
+                             factors=CORRECTION_FACTORS, urban_max=URBAN_MAX_GRID, rural_min=RURAL_MIN_GRID,
+                             cache_dir=None, era5_archive=None, raise_errors=False, renderer=None,
+                             ndvi_overview_dir=None, upsample_factor=10, dtype='float64', prefetched=None):
+    """
+    Correction factor and UHI threshold sweeps of one city, on the aligned grid
+    of week2/week3 (land pixels only). Returns {'n_pixels', 'table'} with the
+    tidy table of tidy_sweeps.
+    """
+    print(f"\nSensitivity sweep: {city_name}, {country_code} ({year})")
+    if renderer is None:
+        renderer = FigureRenderer()
+
+    try:
+        with stage('aligned_stack'):
+            stack = load_aligned_stack(country_code, city_name, year, gadm_index, era5_folder, ndvi_folder,
+                                       f"{year}-{SEASON[0]}", f"{year}-{SEASON[1]}", buffer_degree=BUFFER_DEGREE,
+                                       upsample_factor=upsample_factor, cache_dir=cache_dir,
+                                       era5_archive=era5_archive, ndvi_overview_dir=ndvi_overview_dir,
+                                       dtype=dtype, prefetched=prefetched)
+        if stack is None:
+            return None
+
+        with stage('masking'):
+            temp = stack['temperature'].values * mask_multiplier(stack['land_mask'].values)
+            ndvi = stack['ndvi'].values
+
+        with stage('sweep'):
+            started = time.perf_counter()
+            correction = correction_sweep(ndvi, temp, factors)
+            uhi = uhi_sweep(ndvi, temp, urban_max, rural_min)
+            elapsed = time.perf_counter() - started
+
+        n_pixels = int(valid_pixels(ndvi, temp).sum())
+        print(f"{len(correction)} correction factors and {len(uhi)} threshold pairs over {n_pixels:,} pixels "
+              f"in {elapsed:.2f}s")
+        print(f"RMSE: {correction['rmse'].min():.2f} to {correction['rmse'].max():.2f}°C; "
+              f"UHI intensity: {uhi['uhi_intensity'].min():.2f} to {uhi['uhi_intensity'].max():.2f}°C")
+
+        renderer.submit(plot_sensitivity, os.path.join(output_folder, f"sensitivity_{city_name}_{year}.png"),
+                        summary=True, correction=correction, uhi=uhi, city_name=city_name, year=year)
+        return {'n_pixels': n_pixels, 'table': tidy_sweeps(correction, uhi)}
+
+    except Exception as e:
+        if raise_errors:
+            raise
+        print(f"Error in sensitivity sweep for {city_name}: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sensitivity of week3 RMSE/correlations and week2 UHI intensity "
+                                                 "to the correction factor and the urban/rural NDVI thresholds")
+    parser.add_argument('--year', type=int, default=2022)
+    parser.add_argument('--factors', type=float, nargs='+', default=list(CORRECTION_FACTORS),
+                        help="Week3 correction factors")
+    parser.add_argument('--urban-max', type=float, nargs='+', default=list(URBAN_MAX_GRID),
+                        help="Urban thresholds (NDVI below)")
+    parser.add_argument('--rural-min', type=float, nargs='+', default=list(RURAL_MIN_GRID),
+                        help="Rural thresholds (NDVI above)")
+    parser.add_argument('--workers', type=int, default=1, help="Number of cities swept in parallel")
+    parser.add_argument('--figures', choices=FIGURE_MODES, default='all',
+                        help="Render the per-city heatmaps ('all' or 'summary') or none (CSV only)")
+    parser.add_argument('--ndvi-overviews', action='store_true',
+                        help="Resample NDVI from cached decimated overviews instead of full-resolution pixels")
+    parser.add_argument('--upsample', type=int, default=10, help="ERA5 upsampling factor of the aligned grid")
+    parser.add_argument('--float32', action='store_true',
+                        help="Memory-lean mode: keep the aligned grid in float32")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="Append per-stage timings and memory of each city run to FILE (JSON lines)")
+    args = parser.parse_args()
+
+    DATA_FOLDER = "data"
+    OUTPUT_FOLDER = os.path.join("reports", "sensitivity")
+    GADM_FILE = os.path.join(DATA_FOLDER, "gadm_410_europe.gpkg")
+    ERA5_FOLDER = os.path.join(DATA_FOLDER, "derived-era5-land-daily-statistics")
+    NDVI_FOLDER = os.path.join(DATA_FOLDER, "sentinel2_ndvi")
+    CACHE_FOLDER = os.path.join(DATA_FOLDER, "cache", "aligned")
+    GADM_INDEX_FILE = os.path.join(DATA_FOLDER, "cache", "gadm_index.pkl")
+    NDVI_OVERVIEW_FOLDER = os.path.join(DATA_FOLDER, "cache", "ndvi_overviews")
+
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+
+    cities = [
+        ("FRA", "Paris"),
+        ("ITA", "Roma"),
+        ("FRA", "Nantes"),
+        ("ITA", "Perugia")
+    ]
+
+    tasks = [(country, city, args.year) for country, city in cities]
+    renderer = FigureRenderer(args.figures)
+    started = time.time()
+    records = run_cities(analyze_city_sensitivity, tasks, GADM_FILE, ERA5_FOLDER, NDVI_FOLDER, OUTPUT_FOLDER,
+                         workers=args.workers, gadm_index_file=GADM_INDEX_FILE, cache_dir=CACHE_FOLDER,
+                         renderer=renderer, ndvi_overview_dir=NDVI_OVERVIEW_FOLDER if args.ndvi_overviews else None,
+                         upsample_factor=args.upsample, dtype='float32' if args.float32 else 'float64',
+                         factors=args.factors, urban_max=args.urban_max, rural_min=args.rural_min,
+                         tracer=Tracer(args.trace), prefetch_fn=prefetch_city_week3)
+    renderer.close()
+    print_failures(records)
+    if args.trace:
+        print_trace_summary(args.trace, since=started)
+
+    tables = [record['stats']['table'].assign(country=record['country'], city=record['city'], year=record['year'])
+              for record in records if record['status'] == 'ok']
+    if not tables:
+        print("No city could be swept")
+        return
+    table = pd.concat(tables, ignore_index=True)
+    table = table[['country', 'city', 'year'] + [c for c in table.columns if c not in ('country', 'city', 'year')]]
+    out_csv = os.path.join(OUTPUT_FOLDER, f"sensitivity_{args.year}.csv")
+    table.to_csv(out_csv, index=False)
+    print(f"\nSensitivity table saved: {out_csv} ({len(table):,} rows, {time.time() - started:.1f}s)")
+
+
+if __name__ == "__main__":
+    main()
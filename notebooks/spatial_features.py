@@ -0,0 +1,355 @@
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from shapely.geometry import box
+from pyproj import Transformer
+from sklearn.neighbors import BallTree
+
+from gadm_index import GADMIndex
+from ndvi_access import ndvi_from_raw, overview_file
+
+# Bump when a feature definition changes so cached rows are recomputed
+FEATURE_VERSION = 1
+# Columns produced by each feature group (rows are cached and invalidated per group)
+FEATURE_GROUPS = {
+    'city': ['distance_to_city_km', 'nearest_city'],
+    'coast': ['distance_to_coast_km'],
+    'grid': ['grid_iy', 'grid_ix', 'grid_distance_km', 'elevation'],
+    'ndvi': ['ndvi_mean'],
+}
+EARTH_RADIUS_KM = 6371.0
+# Equal-area Europe projection for the STRtree distances (metres)
+METRIC_CRS = "EPSG:3035"
+# Coastline is extracted this far around the queried points; farther coasts are not seen
+COAST_SEARCH_DEGREES = 10.0
+# Vertices per coastline piece indexed by the STRtree
+COAST_PIECE_VERTICES = 32
+# Decimation of the NDVI pyramid sampled for ndvi_mean (block mean around the point)
+NDVI_FEATURE_FACTOR = 8
+
+
+def _file_signature(path):
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+
+def _array_hash(*arrays):
+    h = hashlib.sha256()
+    for arr in arrays:
+        h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def city_points(gadm_index, cities):
+    """Centroids (name, country, lat, lon) of the GADM polygons of [(GID_0, name), ...]; missing cities are skipped"""
+    rows = []
+    for country, city in cities:
+        city_gdf, _ = gadm_index.find_city(country, city)
+        if city_gdf.empty:
+            print(f"  {city} ({country}) not found in GADM, skipped")
+            continue
+        centre = city_gdf.to_crs(METRIC_CRS).centroid.to_crs("EPSG:4326").iloc[0]
+        rows.append({'name': city, 'country': country, 'lat': centre.y, 'lon': centre.x})
+    return pd.DataFrame(rows, columns=['name', 'country', 'lat', 'lon'])
+
+
+def coastline_pieces(land_gdf, bounds, to_metric, piece_vertices=COAST_PIECE_VERTICES):
+    """
+    Coastline of the land polygons inside bounds, as short projected linestrings.
+
+    The coast is the boundary of the dissolved land minus the edges introduced by
+    clipping to bounds. Long rings are cut into pieces of piece_vertices so the
+    STRtree can prune them.
+    """
+    clip_edge = shapely.buffer(box(*bounds).exterior, 1e-7)
+    coast = shapely.difference(shapely.union_all(land_gdf.geometry.values).boundary, clip_edge)
+    coords, part = shapely.get_coordinates(shapely.get_parts(shapely.line_merge(coast)), return_index=True)
+    if len(coords) == 0:
+        return np.empty(0, dtype=object)
+    x, y = to_metric.transform(coords[:, 0], coords[:, 1])
+    coords = np.column_stack([x, y])
+
+    step = piece_vertices - 1
+    pieces = []
+    starts = np.flatnonzero(np.r_[True, part[1:] != part[:-1]])
+    for start, end in zip(starts, np.r_[starts[1:], len(part)]):
+        line = coords[start:end]
+        if len(line) < 2:
+            continue
+        n_pieces = int(np.ceil((len(line) - 1) / step))
+        # Pad with the last vertex so every window has piece_vertices points
+        padded = np.vstack([line, np.repeat(line[-1:], n_pieces * step + 1 - len(line), axis=0)])
+        windows = np.lib.stride_tricks.sliding_window_view(padded, piece_vertices, axis=0)[::step]
+        pieces.append(shapely.linestrings(windows.transpose(0, 2, 1)))
+    return np.concatenate(pieces) if pieces else np.empty(0, dtype=object)
+
+
+class SpatialFeatureEngine:
+    """
+    Station / grid-cell features computed in vectorized batches from tree indexes.
+
+    - 'city': distance to the nearest city centre (STRtree over the centroids)
+    - 'coast': distance to the GADM coastline (STRtree over coastline pieces)
+    - 'grid': nearest valid ERA5 cell and its elevation (haversine BallTree over
+      the finite cells of grid_elevation)
+    - 'ndvi': block-mean NDVI around the point, sampled from the overview pyramid
+
+    With cache_dir, results are kept per point (lat/lon rounded to 1e-6) and per
+    feature group, keyed by FEATURE_VERSION and the group's inputs: only new points
+    are computed, and adding cities only measures the cached points against the
+    new ones.
+    """
+
+    def __init__(self, gadm_index=None, cities=None, grid_elevation=None, ndvi_file=None, ndvi_overview_dir=None,
+                 cache_dir=None, coast_pad_degrees=COAST_SEARCH_DEGREES):
+        self.gadm_index = gadm_index
+        self.cities = cities.reset_index(drop=True) if cities is not None else None
+        self.grid_elevation = grid_elevation
+        self.ndvi_file = ndvi_file
+        self.ndvi_overview_dir = ndvi_overview_dir
+        self.cache_dir = cache_dir
+        self.coast_pad_degrees = coast_pad_degrees
+        self._to_metric = Transformer.from_crs("EPSG:4326", METRIC_CRS, always_xy=True)
+        self._coast_tree = None
+        self._coast_bounds = None
+        self._grid_tree = None
+
+    # ------------------------------------------------------------------
+    # Feature groups
+    # ------------------------------------------------------------------
+
+    def available_groups(self):
+        inputs = {'city': self.cities, 'coast': self.gadm_index, 'grid': self.grid_elevation, 'ndvi': self.ndvi_file}
+        return [group for group, value in inputs.items() if value is not None]
+
+    def _signature(self, group):
+        if group == 'city':
+            return {'cities': [[r.name, round(r.lat, 6), round(r.lon, 6)] for r in self.cities.itertuples()]}
+        if group == 'coast':
+            return {'gadm': _file_signature(self.gadm_index.gadm_file), 'layer': self.gadm_index.layer,
+                    'pad': self.coast_pad_degrees}
+        if group == 'grid':
+            da = self.grid_elevation
+            return {'grid': _array_hash(da.latitude.values, da.longitude.values, np.nan_to_num(da.values, nan=-1e30))}
+        return {'ndvi': _file_signature(self.ndvi_file), 'overviews': bool(self.ndvi_overview_dir)}
+
+    def _metric_points(self, lat, lon):
+        x, y = self._to_metric.transform(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+        return shapely.points(x, y)
+
+    def city_distance(self, lat, lon, cities=None):
+        """(km, name) of the nearest city centre"""
+        cities = self.cities if cities is None else cities
+        tree = shapely.STRtree(self._metric_points(cities['lat'].values, cities['lon'].values))
+        (_, nearest), dist = tree.query_nearest(self._metric_points(lat, lon), return_distance=True, all_matches=False)
+        return dist / 1000.0, cities['name'].to_numpy()[nearest]
+
+    def _coastline(self, lat, lon):
+        """STRtree over the coastline around the points, rebuilt only when they leave its extent"""
+        pad = self.coast_pad_degrees
+        bounds = (np.min(lon) - pad, np.min(lat) - pad, np.max(lon) + pad, np.max(lat) + pad)
+        if self._coast_bounds is not None:
+            b = self._coast_bounds
+            if bounds[0] >= b[0] and bounds[1] >= b[1] and bounds[2] <= b[2] and bounds[3] <= b[3]:
+                return self._coast_tree
+            bounds = (min(bounds[0], b[0]), min(bounds[1], b[1]), max(bounds[2], b[2]), max(bounds[3], b[3]))
+        land = self.gadm_index.land(bounds)
+        pieces = coastline_pieces(land, bounds, self._to_metric)
+        print(f"  Coastline: {len(pieces)} pieces over {', '.join(f'{v:.1f}' for v in bounds)}")
+        self._coast_tree = shapely.STRtree(pieces) if len(pieces) else None
+        self._coast_bounds = bounds
+        return self._coast_tree
+
+    def coast_distance(self, lat, lon):
+        """km to the nearest coastline piece (NaN when there is no coast within the search extent)"""
+        tree = self._coastline(lat, lon)
+        if tree is None:
+            return np.full(len(lat), np.nan)
+        (_, _), dist = tree.query_nearest(self._metric_points(lat, lon), return_distance=True, all_matches=False)
+        return dist / 1000.0
+
+    def nearest_cell(self, lat, lon):
+        """Row/column, distance (km) and elevation of the nearest cell with a finite grid_elevation"""
+        da = self.grid_elevation.transpose('latitude', 'longitude')
+        if self._grid_tree is None:
+            iy, ix = np.nonzero(np.isfinite(da.values))
+            cells = np.radians(np.column_stack([da.latitude.values[iy], da.longitude.values[ix]]))
+            self._grid_tree = (BallTree(cells, metric='haversine'), iy, ix)
+        tree, iy, ix = self._grid_tree
+        dist, idx = tree.query(np.radians(np.column_stack([lat, lon])), k=1)
+        idx = idx[:, 0]
+        return iy[idx], ix[idx], dist[:, 0] * EARTH_RADIUS_KM, da.values[iy[idx], ix[idx]]
+
+    def ndvi_mean(self, lat, lon):
+        """NDVI of the pyramid block containing each point (full-resolution pixel without overviews)"""
+        path = self.ndvi_file
+        if self.ndvi_overview_dir:
+            path = overview_file(self.ndvi_file, self.ndvi_overview_dir, NDVI_FEATURE_FACTOR)
+        with rasterio.open(path) as src:
+            x, y = Transformer.from_crs("EPSG:4326", src.crs, always_xy=True).transform(
+                np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+            nodata = src.nodata if src.nodata is not None else 255
+            raw = np.array([v[0] for v in src.sample(zip(x, y), indexes=1, masked=False)], dtype=np.uint8)
+            inside = (x >= src.bounds.left) & (x < src.bounds.right) & (y > src.bounds.bottom) & (y <= src.bounds.top)
+        return np.where(inside, ndvi_from_raw(raw, nodata), np.nan)
+
+    def _compute_group(self, group, lat, lon):
+        if group == 'city':
+            dist, name = self.city_distance(lat, lon)
+            return {'distance_to_city_km': dist, 'nearest_city': name}
+        if group == 'coast':
+            return {'distance_to_coast_km': self.coast_distance(lat, lon)}
+        if group == 'grid':
+            iy, ix, dist, elevation = self.nearest_cell(lat, lon)
+            return {'grid_iy': iy, 'grid_ix': ix, 'grid_distance_km': dist, 'elevation': elevation}
+        return {'ndvi_mean': self.ndvi_mean(lat, lon)}
+
+    # ------------------------------------------------------------------
+    # Cache
+    # ------------------------------------------------------------------
+
+    def _cache_paths(self):
+        stem = os.path.join(self.cache_dir, f"spatial_features_v{FEATURE_VERSION}")
+        return stem + ".parquet", stem + ".json"
+
+    def _load_cache(self):
+        if not self.cache_dir:
+            return pd.DataFrame(index=pd.MultiIndex.from_arrays([[], []], names=['lat', 'lon'])), {}
+        table_file, meta_file = self._cache_paths()
+        if os.path.exists(table_file) and os.path.exists(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            return pd.read_parquet(table_file).set_index(['lat', 'lon']), meta
+        return pd.DataFrame(index=pd.MultiIndex.from_arrays([[], []], names=['lat', 'lon'])), {}
+
+    def _save_cache(self, table, meta):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        table_file, meta_file = self._cache_paths()
+        tmp_table = table_file + f".{os.getpid()}.tmp"
+        tmp_meta = meta_file + f".{os.getpid()}.tmp"
+        table.reset_index().to_parquet(tmp_table, index=False)
+        with open(tmp_meta, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_table, table_file)
+        os.replace(tmp_meta, meta_file)
+
+    def _extend_cities(self, table, done, old_signature):
+        """Cached rows were measured against a subset of the cities: only measure the new ones"""
+        old = {tuple(c) for c in old_signature['cities']}
+        new = self.cities[[(r.name, round(r.lat, 6), round(r.lon, 6)) not in old for r in self.cities.itertuples()]]
+        rows = table.index[done]
+        lat, lon = rows.get_level_values('lat').values, rows.get_level_values('lon').values
+        dist, name = self.city_distance(lat, lon, new)
+        closer = dist < table.loc[rows, 'distance_to_city_km'].to_numpy(dtype=float)
+        table.loc[rows[closer], 'distance_to_city_km'] = dist[closer]
+        table.loc[rows[closer], 'nearest_city'] = name[closer]
+        print(f"  city: {len(rows)} cached rows measured against {len(new)} new cities")
+
+    def compute(self, lat, lon, groups=None, batch_size=100_000):
+        """
+        Features of the points (lat, lon arrays), as a DataFrame in input order.
+
+        groups defaults to every group whose inputs were given. Points and groups
+        already in the cache with the same inputs are not recomputed.
+        """
+        groups = self.available_groups() if groups is None else list(groups)
+        keys = pd.MultiIndex.from_arrays([np.round(np.asarray(lat, dtype=float), 6),
+                                          np.round(np.asarray(lon, dtype=float), 6)], names=['lat', 'lon'])
+        table, meta = self._load_cache()
+        if meta.get('version') != FEATURE_VERSION:
+            meta = {'version': FEATURE_VERSION, 'groups': {}}
+        table = table.reindex(table.index.append(keys.unique().difference(table.index)))
+
+        for group in groups:
+            flag = f'_{group}'
+            if flag not in table.columns:
+                table[flag] = False
+            done = table[flag].eq(True).to_numpy().copy()
+            signature = self._signature(group)
+            old_signature = meta['groups'].get(group)
+            if old_signature != signature:
+                if (group == 'city' and old_signature is not None and done.any()
+                        and set(map(tuple, old_signature['cities'])) < set(map(tuple, signature['cities']))):
+                    self._extend_cities(table, done, old_signature)
+                else:
+                    table[flag] = False
+                    done[:] = False
+            meta['groups'][group] = signature
+
+            requested = table.index.isin(keys)
+            todo = table.index[requested & ~done]
+            if len(todo):
+                print(f"  {group}: computing {len(todo)} points ({int((requested & done).sum())} cached)")
+            for b0 in range(0, len(todo), batch_size):
+                batch = todo[b0:b0 + batch_size]
+                values = self._compute_group(group, batch.get_level_values('lat').values,
+                                             batch.get_level_values('lon').values)
+                for column, column_values in values.items():
+                    if column not in table.columns:
+                        table[column] = pd.Series(dtype=object if column == 'nearest_city' else float)
+                    table.loc[batch, column] = column_values
+                table.loc[batch, flag] = True
+
+        if self.cache_dir:
+            self._save_cache(table, meta)
+        columns = [c for group in groups for c in FEATURE_GROUPS[group]]
+        out = table.loc[keys, columns].reset_index(drop=True)
+        for column in ('grid_iy', 'grid_ix'):
+            if column in out.columns:
+                out[column] = out[column].astype(int)
+        return out
+
+
+def main():
+    from station_extract import load_orography
+
+    parser = argparse.ArgumentParser(description="Spatial features (distance to city/coast, nearest ERA5 cell, NDVI) per point")
+    parser.add_argument('points', help="CSV with lat/lon columns (e.g. a station list)")
+    parser.add_argument('--lat-col', default='lat')
+    parser.add_argument('--lon-col', default='lon')
+    parser.add_argument('--orography', help="ERA5-Land geopotential NetCDF (enables the 'grid' features)")
+    parser.add_argument('--ndvi', help="NDVI GeoTIFF (enables ndvi_mean)")
+    parser.add_argument('--ndvi-overviews', action='store_true', help="Sample ndvi_mean from the cached pyramid")
+    parser.add_argument('--city', action='append', metavar='GID_0:NAME', help="City (repeatable, default: the week4 cities)")
+    parser.add_argument('--out', help="Output CSV (default: <points>_features.csv)")
+    args = parser.parse_args()
+
+    DATA_FOLDER = "data"
+    GADM_FILE = os.path.join(DATA_FOLDER, "gadm_410_europe.gpkg")
+    GADM_INDEX_FILE = os.path.join(DATA_FOLDER, "cache", "gadm_index.pkl")
+    NDVI_OVERVIEW_FOLDER = os.path.join(DATA_FOLDER, "cache", "ndvi_overviews")
+    CACHE_FOLDER = os.path.join(DATA_FOLDER, "cache", "spatial_features")
+
+    # Cities of the week4 training stations
+    cities = [
+        ("DEU", "Berlin"),
+        ("FRA", "Paris"),
+        ("ITA", "Milano"),
+        ("POL", "Warszawa"),
+        ("ESP", "Madrid")
+    ]
+    if args.city:
+        cities = [tuple(c.split(':', 1)) for c in args.city]
+
+    points = pd.read_csv(args.points)
+    gadm_index = GADMIndex(GADM_FILE, index_file=GADM_INDEX_FILE)
+    engine = SpatialFeatureEngine(
+        gadm_index=gadm_index, cities=city_points(gadm_index, cities),
+        grid_elevation=load_orography(args.orography) if args.orography else None,
+        ndvi_file=args.ndvi, ndvi_overview_dir=NDVI_OVERVIEW_FOLDER if args.ndvi_overviews else None,
+        cache_dir=CACHE_FOLDER)
+    features = engine.compute(points[args.lat_col].values, points[args.lon_col].values)
+    out = pd.concat([points.reset_index(drop=True), features.drop(columns=points.columns, errors='ignore')], axis=1)
+
+    out_file = args.out or os.path.splitext(args.points)[0] + "_features.csv"
+    out.to_csv(out_file, index=False)
+    print(f"{len(out)} points, features saved: {out_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from era5_access import ERA5Archive
+
+EXTRACT_METHODS = ('nearest', 'bilinear')
+# Standard environmental lapse rate (°C per metre)
+STANDARD_LAPSE_RATE = -0.0065
+GRAVITY = 9.80665
+
+
+def _axis_position(coords, values):
+    """Fractional index of values along a regular, monotonic (ascending or descending) axis"""
+    coords = np.asarray(coords, dtype=float)
+    step = (coords[-1] - coords[0]) / (len(coords) - 1)
+    return (np.asarray(values, dtype=float) - coords[0]) / step
+
+
+def grid_weights(lat_coords, lon_coords, lat, lon, method='nearest'):
+    """
+    Grid cells and weights for every point, shaped (n_points, n_corners).
+
+    'nearest' uses one cell per point, 'bilinear' the four surrounding cells.
+    Points outside the grid get zero weights (and NaN values after extraction).
+    """
+    if method not in EXTRACT_METHODS:
+        raise ValueError(f"Unknown extraction method '{method}', expected one of {EXTRACT_METHODS}")
+    pos_y = _axis_position(lat_coords, lat)
+    pos_x = _axis_position(lon_coords, lon)
+    ny, nx = len(lat_coords), len(lon_coords)
+    inside = (pos_y >= -0.5) & (pos_y <= ny - 0.5) & (pos_x >= -0.5) & (pos_x <= nx - 0.5)
+
+    if method == 'nearest':
+        iy = np.clip(np.rint(pos_y), 0, ny - 1).astype(np.int64)[:, None]
+        ix = np.clip(np.rint(pos_x), 0, nx - 1).astype(np.int64)[:, None]
+        weights = inside.astype(float)[:, None]
+        return iy, ix, weights
+
+    # Lower-left corner of the surrounding cell, clamped so edge points reuse the border cells
+    y0 = np.clip(np.floor(pos_y), 0, max(ny - 2, 0)).astype(np.int64)
+    x0 = np.clip(np.floor(pos_x), 0, max(nx - 2, 0)).astype(np.int64)
+    fy = np.clip(pos_y - y0, 0, 1)
+    fx = np.clip(pos_x - x0, 0, 1)
+    y1 = np.minimum(y0 + 1, ny - 1)
+    x1 = np.minimum(x0 + 1, nx - 1)
+    iy = np.stack([y0, y0, y1, y1], axis=1)
+    ix = np.stack([x0, x1, x0, x1], axis=1)
+    weights = np.stack([(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx], axis=1)
+    weights[~inside] = 0.0
+    return iy, ix, weights
+
+
+def _apply_weights(values, weights):
+    """Weighted sum over the corner axis, renormalised over the corners that are not NaN (sea cells)"""
+    valid = np.isfinite(values) & (weights > 0)
+    w = np.where(valid, weights, 0.0)
+    total = w.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = (np.where(valid, values, 0.0) * w).sum(axis=-1) / total
+    return np.where(total > 0, out, np.nan)
+
+
+def load_orography(orography_file, variable='z'):
+    """ERA5(-Land) surface geopotential file -> grid elevation in metres (latitude, longitude)"""
+    with xr.open_dataset(orography_file) as ds:
+        z = ds[variable].load()
+    for dim in ('valid_time', 'time'):
+        if dim in z.dims:
+            z = z.isel({dim: 0}, drop=True)
+    return z / GRAVITY
+
+
+def extract_at_stations(era5_archive, years, stations, method='nearest', lapse_rate=None,
+                        grid_elevation=None, time_chunk=92, id_col='station_id',
+                        lat_col='lat', lon_col='lon', elevation_col='elevation'):
+    """
+    Daily ERA5 maximum temperature (°C) at every station and day of `years`.
+
+    All stations are extracted together with one vectorized gather per time chunk,
+    so memory is bounded by time_chunk days of the stations' bounding box. With
+    lapse_rate (°C/m, e.g. STANDARD_LAPSE_RATE) and grid_elevation (metres on the
+    ERA5 grid, see load_orography) the values are corrected to station elevation.
+    Returns a long DataFrame with columns [id_col, 'DATE', 'ERA5_T2M'].
+    """
+    if lapse_rate is not None and grid_elevation is None:
+        raise ValueError("A lapse-rate correction needs the ERA5 grid elevation (grid_elevation)")
+
+    stations = stations.reset_index(drop=True)
+    frames = []
+    for year in years:
+        if not os.path.exists(era5_archive.path(year)):
+            print(f"  No ERA5 file for {year}, skipped")
+            continue
+        da = era5_archive.dataset(year)[era5_archive.variable]
+        iy, ix, weights = grid_weights(da.latitude.values, da.longitude.values,
+                                       stations[lat_col].values, stations[lon_col].values, method)
+
+        correction = 0.0
+        if lapse_rate is not None:
+            elev = grid_elevation.reindex_like(da.isel(valid_time=0, drop=True), method='nearest', tolerance=1e-3)
+            cell_elev = _apply_weights(elev.values[iy, ix], weights)
+            correction = lapse_rate * (stations[elevation_col].values - cell_elev)
+
+        # Only the rows/columns spanned by the stations are read from disk, as one
+        # contiguous hyperslab per chunk (fancy indexing on the netCDF variable is
+        # far slower); the station cells are then gathered with numpy indexing
+        row0, col0 = int(iy.min()), int(ix.min())
+        window = da.isel(latitude=slice(row0, int(iy.max()) + 1), longitude=slice(col0, int(ix.max()) + 1))
+        rows, cols = iy - row0, ix - col0
+
+        dates = pd.DatetimeIndex(da.valid_time.values)
+        for t0 in range(0, len(dates), time_chunk):
+            block = window.isel(valid_time=slice(t0, t0 + time_chunk)).values
+            temps = _apply_weights(block[:, rows, cols] - 273.15, weights[None]) + correction
+            n_days = temps.shape[0]
+            frames.append(pd.DataFrame({
+                id_col: np.tile(stations[id_col].values, n_days),
+                'DATE': np.repeat(dates[t0:t0 + n_days].values, len(stations)),
+                'ERA5_T2M': temps.ravel(),
+            }))
+        print(f"  {year}: {len(dates)} days x {len(stations)} stations")
+
+    if not frames:
+        return pd.DataFrame(columns=[id_col, 'DATE', 'ERA5_T2M'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract daily ERA5 Tmax at station locations")
+    parser.add_argument('stations', help="CSV with station_id, lat, lon (and elevation for --lapse-rate)")
+    parser.add_argument('--years', type=int, nargs='+', default=list(range(2020, 2024)))
+    parser.add_argument('--method', choices=EXTRACT_METHODS, default='nearest')
+    parser.add_argument('--lapse-rate', type=float, default=None,
+                        help=f"Elevation correction in °C/m (standard: {STANDARD_LAPSE_RATE})")
+    parser.add_argument('--orography', help="ERA5 geopotential file, needed with --lapse-rate")
+    parser.add_argument('--time-chunk', type=int, default=92, help="Days read per chunk")
+    parser.add_argument('--out', default=os.path.join("reports", "era5_at_stations.csv"))
+    args = parser.parse_args()
+
+    DATA_FOLDER = "data"
+    ERA5_FOLDER = os.path.join(DATA_FOLDER, "derived-era5-land-daily-statistics")
+
+    stations = pd.read_csv(args.stations).drop_duplicates('station_id')
+    grid_elevation = load_orography(args.orography) if args.orography else None
+
+    print(f"Extracting ERA5 ({args.method}) for {len(stations)} stations...")
+    with ERA5Archive(ERA5_FOLDER) as archive:
+        df = extract_at_stations(archive, args.years, stations, method=args.method,
+                                 lapse_rate=args.lapse_rate, grid_elevation=grid_elevation,
+                                 time_chunk=args.time_chunk)
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    df.to_csv(args.out, index=False)
+    print(f"Saved {len(df)} station-days: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
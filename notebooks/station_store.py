@@ -0,0 +1,132 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from pyarrow import fs
+from shapely.geometry import box
+
+
+class StationStore:
+    """
+    Query interface over the Parquet store written by eca_ingest.
+
+    Stations are selected with a spatial index on their coordinates, then only
+    the matching country partitions, STAID row groups and dates are read (the
+    filters are pushed down to the Parquet scan). Files are memory-mapped.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.stations = pd.read_parquet(os.path.join(store_dir, "stations.parquet"))
+        self.stations_gdf = gpd.GeoDataFrame(
+            self.stations, geometry=gpd.points_from_xy(self.stations['LON'], self.stations['LAT']), crs="EPSG:4326")
+        self.dataset = ds.dataset(os.path.join(store_dir, "tx"), format='parquet', partitioning='hive',
+                                  filesystem=fs.LocalFileSystem(use_mmap=True))
+
+    def select_stations(self, bbox=None, countries=None, station_ids=None):
+        """Station rows inside bbox=(minx, miny, maxx, maxy), optionally restricted to countries / ids"""
+        stations = self.stations
+        if bbox is not None:
+            idx = self.stations_gdf.sindex.query(box(*bbox), predicate='intersects')
+            stations = stations.iloc[np.sort(idx)]
+        if countries is not None:
+            stations = stations[stations['CN'].isin(countries)]
+        if station_ids is not None:
+            stations = stations[stations['STAID'].isin(station_ids)]
+        return stations
+
+    def query(self, bbox=None, start=None, end=None, min_coverage=None, countries=None, station_ids=None,
+              columns=('STAID', 'DATE', 'TX_C', 'Q_TX'), as_xarray=False):
+        """
+        Daily series of the stations in bbox between start and end (inclusive).
+
+        min_coverage drops stations whose share of valid days (Q_TX == 0) in the
+        period is below the threshold. Returns an Arrow table, or with
+        as_xarray=True a (station, time) DataArray of valid TX_C (NaN otherwise)
+        with the station metadata as coordinates.
+        """
+        stations = self.select_stations(bbox, countries, station_ids)
+        ids = stations['STAID'].to_numpy()
+        if len(ids) == 0:
+            table = self.dataset.schema.empty_table().select(list(columns))
+            return self._to_xarray(table, stations, start, end) if as_xarray else table
+
+        # Partition (CN), row-group (STAID range, DATE) and row filters
+        flt = ds.field('CN').isin(stations['CN'].unique().tolist())
+        flt &= (ds.field('STAID') >= int(ids.min())) & (ds.field('STAID') <= int(ids.max()))
+        flt &= ds.field('STAID').isin(pa.array(ids, type=pa.int32()))
+        if start is not None:
+            flt &= ds.field('DATE') >= pd.Timestamp(start)
+        if end is not None:
+            flt &= ds.field('DATE') <= pd.Timestamp(end)
+        read_columns = list(dict.fromkeys(list(columns) + ['STAID', 'DATE', 'Q_TX']))
+        table = self.dataset.to_table(columns=read_columns, filter=flt)
+
+        if min_coverage is not None and table.num_rows:
+            first = pd.Timestamp(start) if start is not None else pd.Timestamp(pc.min(table['DATE']).as_py())
+            last = pd.Timestamp(end) if end is not None else pd.Timestamp(pc.max(table['DATE']).as_py())
+            n_days = (last - first).days + 1
+            valid = table.filter(pc.equal(table['Q_TX'], 0))
+            counts = valid.group_by('STAID').aggregate([('DATE', 'count')])
+            keep = pc.filter(counts['STAID'], pc.greater_equal(counts['DATE_count'], min_coverage * n_days))
+            table = table.filter(pc.is_in(table['STAID'], value_set=keep))
+            stations = stations[stations['STAID'].isin(keep.to_numpy())]
+
+        if as_xarray:
+            return self._to_xarray(table, stations, start, end)
+        return table.select(list(columns))
+
+    def _to_xarray(self, table, stations, start=None, end=None):
+        df = table.select(['STAID', 'DATE', 'TX_C', 'Q_TX']).to_pandas()
+        df.loc[df['Q_TX'] != 0, 'TX_C'] = np.nan
+        if start is not None and end is not None:
+            time = pd.date_range(start, end)
+        elif len(df):
+            time = pd.date_range(df['DATE'].min(), df['DATE'].max())
+        else:
+            time = pd.DatetimeIndex([])
+        stations = stations.sort_values('STAID')
+        values = np.full((len(stations), len(time)), np.nan, dtype=np.float32)
+        if len(df) and len(time):
+            row = np.searchsorted(stations['STAID'].to_numpy(), df['STAID'].to_numpy())
+            col = ((df['DATE'] - time[0]) // pd.Timedelta(days=1)).to_numpy()
+            values[row, col] = df['TX_C'].to_numpy()
+        return xr.DataArray(
+            values, dims=('station', 'time'),
+            coords={
+                'station': stations['STAID'].to_numpy(), 'time': time,
+                'name': ('station', stations['STANAME'].to_numpy()),
+                'country': ('station', stations['CN'].to_numpy()),
+                'lat': ('station', stations['LAT'].to_numpy()),
+                'lon': ('station', stations['LON'].to_numpy()),
+                'elevation': ('station', stations['HGHT'].to_numpy()),
+            },
+            name='TX_C', attrs={'units': '°C'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the ECA station store")
+    parser.add_argument('--store', default=os.path.join("data", "eca_store"))
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('MINX', 'MINY', 'MAXX', 'MAXY'))
+    parser.add_argument('--start')
+    parser.add_argument('--end')
+    parser.add_argument('--min-coverage', type=float)
+    parser.add_argument('--out', help="Write the (station, time) array to this NetCDF file")
+    args = parser.parse_args()
+
+    store = StationStore(args.store)
+    da = store.query(bbox=args.bbox, start=args.start, end=args.end, min_coverage=args.min_coverage, as_xarray=True)
+    print(f"{da.sizes['station']} stations x {da.sizes['time']} days, "
+          f"{int(np.isfinite(da.values).sum())} valid observations")
+    if args.out:
+        da.to_netcdf(args.out)
+        print(f"Saved: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import netCDF4
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from pyproj import Transformer
+from shapely.geometry import Polygon, box
+
+from ndvi_access import NDVI_NODATA
+
+# Synthetic dataset sizes: ERA5 domain (degrees, 0.1° cells), NDVI pixel size (m), number of cities
+SIZES = {
+    'small': {'lon0': 0.0, 'lat0': 42.0, 'width': 8.0, 'height': 6.0, 'ndvi_res': 400, 'n_cities': 2},
+    'medium': {'lon0': -2.0, 'lat0': 40.0, 'width': 16.0, 'height': 12.0, 'ndvi_res': 200, 'n_cities': 4},
+    'large': {'lon0': -6.0, 'lat0': 38.0, 'width': 26.0, 'height': 18.0, 'ndvi_res': 100, 'n_cities': 8},
+}
+ERA5_RES = 0.1
+# Bump when the generated content changes so existing synthetic folders are rebuilt
+SYNTHETIC_VERSION = 1
+# Real names so the city lookups and figure titles look like the production runs
+CITY_NAMES = [("FRA", "Paris"), ("ITA", "Roma"), ("FRA", "Nantes"), ("ITA", "Perugia"),
+              ("FRA", "Lyon"), ("ITA", "Milano"), ("FRA", "Toulouse"), ("ITA", "Napoli")]
+COUNTRIES = ("FRA", "ITA")
+
+
+def coast_longitude(lat, lon0):
+    """Longitude of the (wavy) west coast at each latitude; everything west of it is sea"""
+    lat = np.asarray(lat, dtype=float)
+    return lon0 + 1.0 + 0.3 * np.sin(lat * 2.1) + 0.1 * np.sin(lat * 13.0)
+
+
+def city_sites(params, seed=0):
+    """(GID_0, name, lon, lat, radius in degrees) of the synthetic cities, spread over the land part"""
+    rng = np.random.default_rng(seed)
+    lon0, lat0, width, height = params['lon0'], params['lat0'], params['width'], params['height']
+    sites = []
+    n = params['n_cities']
+    for i, (country, name) in enumerate(CITY_NAMES[:n]):
+        lat = lat0 + height * (i + 0.5) / n
+        lon = lon0 + 2.0 + (width - 3.0) * rng.uniform(0.1, 0.9)
+        sites.append((country, name, lon, lat, rng.uniform(0.08, 0.2)))
+    return sites
+
+
+def make_gadm(gpkg_path, params, sites, seed=0, coast_vertices=4000):
+    """
+    GADM-like GeoPackage: 1° rural admin units over the land part (jagged coast on
+    the west), with irregular city polygons carved out of them. Columns GID_0 and
+    NAME_1..NAME_5 as in gadm_410_europe.gpkg; cities are level-3 units.
+    """
+    rng = np.random.default_rng(seed)
+    lon0, lat0, width, height = params['lon0'], params['lat0'], params['width'], params['height']
+    coast_lat = np.linspace(lat0, lat0 + height, coast_vertices)
+    coast_lon = coast_longitude(coast_lat, lon0)
+    land = Polygon(list(zip(coast_lon, coast_lat)) + [(lon0 + width, lat0 + height), (lon0 + width, lat0)])
+
+    rows = []
+    cities = []
+    for country, name, lon, lat, radius in sites:
+        angle = np.linspace(0, 2 * np.pi, 96, endpoint=False)
+        r = radius * (1 + 0.25 * np.sin(3 * angle + rng.uniform(0, 6)) + 0.05 * rng.standard_normal(len(angle)))
+        city = Polygon(np.column_stack([lon + r * np.cos(angle), lat + r * np.sin(angle) * 0.7])).intersection(land)
+        cities.append(city)
+        rows.append({'GID_0': country, 'NAME_1': f"R{name}", 'NAME_2': f"D{name}", 'NAME_3': name,
+                     'NAME_4': None, 'NAME_5': None, 'geometry': city})
+
+    city_union = gpd.GeoSeries(cities).union_all()
+    for ix, x in enumerate(np.arange(lon0, lon0 + width, 1.0)):
+        for iy, y in enumerate(np.arange(lat0, lat0 + height, 1.0)):
+            unit = box(x, y, min(x + 1.0, lon0 + width), min(y + 1.0, lat0 + height)).intersection(land)
+            unit = unit.difference(city_union)
+            if unit.is_empty:
+                continue
+            country = COUNTRIES[ix * len(COUNTRIES) // max(int(np.ceil(width)), 1)]
+            rows.append({'GID_0': country, 'NAME_1': f"Region{iy}", 'NAME_2': f"Dept{iy}_{ix}",
+                         'NAME_3': f"Commune{iy}_{ix}", 'NAME_4': None, 'NAME_5': None, 'geometry': unit})
+
+    os.makedirs(os.path.dirname(gpkg_path) or ".", exist_ok=True)
+    gpd.GeoDataFrame(rows, crs="EPSG:4326").to_file(gpkg_path, driver="GPKG", layer="gadm_410_europe")
+    return gpkg_path
+
+
+def make_era5_year(nc_path, year, params, sites, seed=0, chunk_days=31):
+    """
+    One ERA5-Land-like yearly file of daily maximum 2 m temperature (K): seasonal
+    cycle, latitude gradient, urban heat islands, weather noise, NaN over sea.
+    Written chunk_days at a time with the ERA5 layout (latitude North to South).
+    """
+    rng = np.random.default_rng(seed + year)
+    lon0, lat0, width, height = params['lon0'], params['lat0'], params['width'], params['height']
+    lat = np.round(np.arange(lat0 + height, lat0 - 1e-9, -ERA5_RES), 4)
+    lon = np.round(np.arange(lon0, lon0 + width + 1e-9, ERA5_RES), 4)
+    dates = pd.date_range(f"{year}-01-01", f"{year}-12-31")
+
+    base = 288.0 - 0.6 * (lat[:, None] - 46.0) + np.zeros((1, len(lon)))
+    for _, _, x, y, radius in sites:
+        base += 2.5 * np.exp(-((lat[:, None] - y) ** 2 + (lon[None, :] - x) ** 2) / (2 * radius ** 2))
+    sea = lon[None, :] < coast_longitude(lat, lon0)[:, None]
+
+    os.makedirs(os.path.dirname(nc_path) or ".", exist_ok=True)
+    tmp_path = nc_path + f".{os.getpid()}.tmp"
+    with netCDF4.Dataset(tmp_path, 'w', format='NETCDF4') as nc:
+        nc.createDimension('valid_time', len(dates))
+        nc.createDimension('latitude', len(lat))
+        nc.createDimension('longitude', len(lon))
+        t = nc.createVariable('valid_time', 'i8', ('valid_time',))
+        t.units = "days since 1970-01-01"
+        t.calendar = "proleptic_gregorian"
+        t.standard_name = "time"
+        t[:] = (dates - pd.Timestamp("1970-01-01")).days.values
+        for name, values, units in (('latitude', lat, 'degrees_north'), ('longitude', lon, 'degrees_east')):
+            var = nc.createVariable(name, 'f8', (name,))
+            var.units = units
+            var.standard_name = name
+            var[:] = values
+        t2m = nc.createVariable('t2m', 'f4', ('valid_time', 'latitude', 'longitude'), zlib=True, complevel=1,
+                                chunksizes=(1, len(lat), len(lon)), fill_value=np.float32(np.nan))
+        t2m.units = "K"
+        t2m.long_name = "2 metre temperature"
+
+        for t0 in range(0, len(dates), chunk_days):
+            doy = dates.dayofyear.values[t0:t0 + chunk_days].astype(float)
+            seasonal = 10.0 * np.sin((doy - 105) / 365.25 * 2 * np.pi)
+            block = base[None] + seasonal[:, None, None] + rng.normal(0, 1.5, (len(doy), len(lat), len(lon)))
+            block[:, sea] = np.nan
+            t2m[t0:t0 + len(doy)] = block.astype(np.float32)
+    os.replace(tmp_path, nc_path)
+    return nc_path
+
+
+def make_ndvi(tif_path, params, sites, seed=0, strip_rows=512):
+    """
+    uint8 NDVI GeoTIFF (0-254 scaled from -1..1, nodata 255 over sea) in EPSG:3035
+    at params['ndvi_res'] metres, written strip by strip: vegetated background with
+    field-scale texture and low-NDVI city cores.
+    """
+    rng = np.random.default_rng(seed)
+    lon0, lat0, width, height = params['lon0'], params['lat0'], params['width'], params['height']
+    res = params['ndvi_res']
+    to_laea = Transformer.from_crs("EPSG:4326", "EPSG:3035", always_xy=True)
+    to_wgs = Transformer.from_crs("EPSG:3035", "EPSG:4326", always_xy=True)
+    corner_lon, corner_lat = np.meshgrid(np.linspace(lon0, lon0 + width, 21), np.linspace(lat0, lat0 + height, 21))
+    xs, ys = to_laea.transform(corner_lon.ravel(), corner_lat.ravel())
+    left, top = np.floor(min(xs) / res) * res, np.ceil(max(ys) / res) * res
+    n_cols = int(np.ceil((max(xs) - left) / res))
+    n_rows = int(np.ceil((top - min(ys)) / res))
+    transform = from_origin(left, top, res, res)
+    phase = rng.uniform(0, 2 * np.pi, 4)
+
+    os.makedirs(os.path.dirname(tif_path) or ".", exist_ok=True)
+    tmp_path = tif_path + f".{os.getpid()}.tmp"
+    profile = dict(driver='GTiff', width=n_cols, height=n_rows, count=1, dtype='uint8', crs="EPSG:3035",
+                   transform=transform, nodata=NDVI_NODATA, tiled=True, blockxsize=512, blockysize=512,
+                   compress='deflate', BIGTIFF='IF_SAFER')
+    with rasterio.open(tmp_path, 'w', **profile) as dst:
+        x = left + (np.arange(n_cols) + 0.5) * res
+        for r0 in range(0, n_rows, strip_rows):
+            rows = min(strip_rows, n_rows - r0)
+            y = top - (np.arange(r0, r0 + rows) + 0.5) * res
+            X, Y = np.meshgrid(x, y)
+            lon, lat = to_wgs.transform(X, Y)
+            ndvi = (0.62 + 0.12 * np.sin(X / 3100 + phase[0]) * np.sin(Y / 2300 + phase[1])
+                    + 0.06 * np.sin(X / 700 + phase[2]) + 0.05 * np.sin(Y / 530 + phase[3]))
+            for _, _, cx, cy, radius in sites:
+                ndvi -= 0.55 * np.exp(-((lat - cy) ** 2 + ((lon - cx) * 0.7) ** 2) / (2 * (radius * 0.8) ** 2))
+            ndvi += rng.normal(0, 0.04, ndvi.shape)
+            raw = np.clip(np.round((ndvi + 1.0) / 2.0 * 254.0), 0, 254).astype(np.uint8)
+            outside = (lon < coast_longitude(lat, lon0)) | (lon > lon0 + width) | (lat < lat0) | (lat > lat0 + height)
+            raw[outside] = NDVI_NODATA
+            dst.write(raw, 1, window=Window(0, r0, n_cols, rows))
+    os.replace(tmp_path, tif_path)
+    return tif_path
+
+
+def make_dataset(root, size='small', years=(2022,), seed=0, force=False):
+    """
+    Write a synthetic data folder laid out like data/ (GADM gpkg, ERA5 yearly files,
+    summer NDVI mosaics) and return its description. Existing folders built with the
+    same size, years, seed and SYNTHETIC_VERSION are reused.
+    """
+    if size not in SIZES:
+        raise ValueError(f"Unknown synthetic size '{size}', expected one of {tuple(SIZES)}")
+    params = SIZES[size]
+    sites = city_sites(params, seed)
+    description = {
+        'version': SYNTHETIC_VERSION, 'size': size, 'params': params, 'years': list(years), 'seed': seed,
+        'cities': [[country, name] for country, name, *_ in sites],
+        'gadm_file': os.path.join(root, "gadm_410_europe.gpkg"),
+        'era5_folder': os.path.join(root, "derived-era5-land-daily-statistics"),
+        'ndvi_folder': os.path.join(root, "sentinel2_ndvi"),
+    }
+    description_file = os.path.join(root, "synthetic.json")
+    if not force and os.path.exists(description_file):
+        with open(description_file) as f:
+            if json.load(f) == description:
+                return description
+
+    print(f"Generating synthetic '{size}' dataset in {root}...")
+    make_gadm(description['gadm_file'], params, sites, seed)
+    for year in years:
+        make_era5_year(os.path.join(description['era5_folder'], f"{year}_2m_temperature_daily_maximum.nc"),
+                       year, params, sites, seed)
+        make_ndvi(os.path.join(description['ndvi_folder'], f"ndvi_{year}-06-01_{year}-09-01.tif"), params, sites,
+                  seed + year)
+    with open(description_file, 'w') as f:
+        json.dump(description, f, indent=2)
+    return description
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic ERA5 / NDVI / GADM inputs")
+    parser.add_argument('--root', default=os.path.join("data", "synthetic"))
+    parser.add_argument('--size', choices=tuple(SIZES), default='small')
+    parser.add_argument('--years', type=int, nargs='+', default=[2022])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--force', action='store_true', help="Regenerate even if the folder is up to date")
+    args = parser.parse_args()
+
+    root = os.path.join(args.root, args.size)
+    description = make_dataset(root, args.size, args.years, args.seed, args.force)
+    print(json.dumps(description, indent=2))
+
+
+if __name__ == "__main__":
+    main()
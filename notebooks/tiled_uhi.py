@@ -0,0 +1,315 @@
+import os
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.warp import reproject, transform_bounds, Resampling
+from rasterio.windows import Window
+from affine import Affine
+
+from era5_access import ERA5Archive
+from gadm_index import GADMIndex
+from landmask import rasterize_land, grid_transform
+from ndvi_access import read_ndvi_window
+from ndvi_stats import valid_pixels, uhi_intensity
+from online_stats import MomentAccumulator
+from regrid import RegridOperator
+from aligned_grid import resolve_ndvi_file
+
+# ERA5 cells added around each tile so the bilinear upsampling of the edge pixels
+# has both neighbours (tiles then stitch without seams)
+HALO_CELLS = 1
+# Bands of the continental raster. The UHI intensity is relative to each tile's
+# rural mean, which would step at tile edges, so it is kept in the tile table only
+BANDS = ('temperature', 'ndvi')
+
+# Read-only inputs shared by every tile of a process (built once per worker)
+_CONTEXT = {}
+
+
+def _init_context(gadm_file, gadm_index_file, era5_folder):
+    _CONTEXT['gadm_index'] = GADMIndex(gadm_file, index_file=gadm_index_file)
+    _CONTEXT['era5_archive'] = ERA5Archive(era5_folder)
+
+
+class TileGrid:
+    """
+    Fixed tiling of the ERA5 grid over a lon/lat box.
+
+    Every ERA5 cell is split into factor x factor pixels, cell-centred, so the
+    upsampled grid of a tile is a window of one continental North-up grid with
+    transform `transform`. Tiles are tile_cells x tile_cells ERA5 cells (smaller
+    at the eastern and southern edges).
+    """
+
+    def __init__(self, lat, lon, bounds, tile_cells=20, factor=10):
+        lat = np.sort(np.asarray(lat))[::-1]
+        lon = np.sort(np.asarray(lon))
+        minx, miny, maxx, maxy = bounds
+        rows = np.flatnonzero((lat >= miny) & (lat <= maxy))
+        cols = np.flatnonzero((lon >= minx) & (lon <= maxx))
+        if len(rows) == 0 or len(cols) == 0:
+            raise ValueError(f"No ERA5 cells inside {bounds}")
+        self.lat = lat
+        self.lon = lon
+        self.row0, self.row1 = rows[0], rows[-1] + 1
+        self.col0, self.col1 = cols[0], cols[-1] + 1
+        self.tile_cells = tile_cells
+        self.factor = factor
+        self.res = float(abs(lon[1] - lon[0])) if len(lon) > 1 else 0.1
+        self.pixel = self.res / factor
+        self.transform = Affine(self.pixel, 0.0, lon[self.col0] - self.res / 2,
+                                0.0, -self.pixel, lat[self.row0] + self.res / 2)
+        self.shape = ((self.row1 - self.row0) * factor, (self.col1 - self.col0) * factor)
+
+    def tiles(self):
+        """(tile_id, row, col, r0, r1, c0, c1) of every tile, in ERA5 cell indices (rows North first)"""
+        out = []
+        for i, r0 in enumerate(range(self.row0, self.row1, self.tile_cells)):
+            for j, c0 in enumerate(range(self.col0, self.col1, self.tile_cells)):
+                r1 = min(r0 + self.tile_cells, self.row1)
+                c1 = min(c0 + self.tile_cells, self.col1)
+                out.append((f"r{i:03d}c{j:03d}", i, j, r0, r1, c0, c1))
+        return out
+
+    def bounds(self, r0, r1, c0, c1):
+        """Outer (minx, miny, maxx, maxy) of ERA5 cells [r0, r1) x [c0, c1)"""
+        half = self.res / 2
+        return (self.lon[c0] - half, self.lat[r1 - 1] - half, self.lon[c1 - 1] + half, self.lat[r0] + half)
+
+    def pixel_centres(self, r0, r1, c0, c1):
+        """Upsampled (lat descending, lon ascending) pixel centres of ERA5 cells [r0, r1) x [c0, c1)"""
+        rows = np.arange((r0 - self.row0) * self.factor, (r1 - self.row0) * self.factor)
+        cols = np.arange((c0 - self.col0) * self.factor, (c1 - self.col0) * self.factor)
+        lat = self.transform.f - (rows + 0.5) * self.pixel
+        lon = self.transform.c + (cols + 0.5) * self.pixel
+        return lat, lon
+
+    def window(self, r0, r1, c0, c1):
+        """Window of the tile in the continental raster"""
+        return Window((c0 - self.col0) * self.factor, (r0 - self.row0) * self.factor,
+                      (c1 - c0) * self.factor, (r1 - r0) * self.factor)
+
+
+def analyze_tile(grid, tile, year, season_start, season_end, ndvi_file, gadm_index, era5_archive,
+                 ndvi_overview_dir=None):
+    """
+    Temperature, NDVI and UHI fields of one tile plus its summary record.
+
+    Returns (record, bands) where bands is a float32 (2, h, w) North-up array of
+    land temperature and NDVI, or None when the tile has no land.
+    """
+    tile_id, row, col, r0, r1, c0, c1 = tile
+    bounds = grid.bounds(r0, r1, c0, c1)
+    record = {'tile_id': tile_id, 'row': row, 'col': col, 'west': bounds[0], 'south': bounds[1],
+              'east': bounds[2], 'north': bounds[3]}
+
+    land_gdf = gadm_index.land(bounds)
+    if land_gdf.empty:
+        record['status'] = 'no_land'
+        return record, None
+
+    # ERA5 with the halo, upsampled onto the tile's pixels only
+    h0, h1 = max(r0 - HALO_CELLS, 0), min(r1 + HALO_CELLS, len(grid.lat))
+    w0, w1 = max(c0 - HALO_CELLS, 0), min(c1 + HALO_CELLS, len(grid.lon))
+    halo_bounds = (grid.lon[w0], grid.lat[h1 - 1], grid.lon[w1 - 1], grid.lat[h0])
+    temp = era5_archive.seasonal_mean(year, halo_bounds, season_start, season_end)
+    lat, lon = grid.pixel_centres(r0, r1, c0, c1)
+    # A fresh operator per tile: tiles never share a grid, so caching them would only evict reusable ones
+    upsample = RegridOperator(temp.latitude.values, temp.longitude.values, lat, lon)
+    temperature = upsample(temp.values, dtype=np.float32)
+
+    land = rasterize_land(land_gdf, lat, lon)
+    temperature[~land] = np.nan
+
+    # NDVI averaged onto the same pixels; pixels the mosaic does not cover stay NaN
+    ndvi = np.full(temperature.shape, np.nan, dtype=np.float32)
+    with read_ndvi_window(ndvi_file, bounds, overview_dir=ndvi_overview_dir, target_res=grid.pixel) as window:
+        src = window.dataset
+        reproject(
+            source=rasterio.band(src, 1),
+            destination=ndvi,
+            src_transform=src.transform,
+            src_crs=src.crs,
+            src_nodata=src.nodata,
+            dst_transform=grid_transform(lat, lon),
+            dst_crs="EPSG:4326",
+            dst_nodata=np.nan,
+            resampling=Resampling.average
+        )
+    ndvi /= 254.0
+    ndvi *= 2.0
+    ndvi -= 1.0
+    ndvi[~land] = np.nan
+
+    valid = valid_pixels(ndvi, temperature)
+    moments = MomentAccumulator(('NDVI', 'Temperature'))
+    moments.update(ndvi[valid], temperature[valid])
+    record['n_pixels'] = moments.count
+    record['mean_temp'] = moments.mean_of('Temperature')
+    record['mean_ndvi'] = moments.mean_of('NDVI')
+    record['correlation'] = moments.corr('NDVI', 'Temperature') if moments.count > 2 else np.nan
+    record['avg_temp_urban'], record['avg_temp_rural'], record['uhi_intensity'] = uhi_intensity(
+        ndvi[valid], temperature[valid])
+    record['status'] = 'ok' if moments.count else 'no_data'
+    return record, np.stack([temperature, ndvi])
+
+
+def _run_tile(grid, tile, year, season_start, season_end, ndvi_file, ndvi_overview_dir):
+    """Run one tile and return (record, bands) instead of raising"""
+    start = time.perf_counter()
+    try:
+        record, bands = analyze_tile(grid, tile, year, season_start, season_end, ndvi_file,
+                                     _CONTEXT['gadm_index'], _CONTEXT['era5_archive'], ndvi_overview_dir)
+        record['error'] = None
+    except Exception as e:
+        tile_id, row, col = tile[:3]
+        record = {'tile_id': tile_id, 'row': row, 'col': col, 'status': 'failed',
+                  'error': f"{type(e).__name__}: {e}", 'traceback': traceback.format_exc()}
+        bands = None
+    record['seconds'] = time.perf_counter() - start
+    return record, bands
+
+
+def run_tiles(grid, year, season_start, season_end, ndvi_file, gadm_file, era5_folder, out_tif,
+              workers=1, gadm_index_file=None, ndvi_overview_dir=None):
+    """
+    Analyse every tile of `grid` and stitch the bands into out_tif as they finish.
+
+    Tiles are spread over a process pool when workers > 1, with at most two tiles
+    per worker in flight, so memory depends on the tile size and not on the area
+    covered. Only this process writes the GeoTIFF. Returns the tile records.
+    """
+    tiles = grid.tiles()
+    init_args = (gadm_file, gadm_index_file, era5_folder)
+    task_args = (year, season_start, season_end, ndvi_file, ndvi_overview_dir)
+    profile = {
+        'driver': 'GTiff', 'height': grid.shape[0], 'width': grid.shape[1], 'count': len(BANDS),
+        'dtype': 'float32', 'crs': 'EPSG:4326', 'transform': grid.transform, 'nodata': np.nan,
+        'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'deflate', 'BIGTIFF': 'IF_SAFER',
+    }
+    os.makedirs(os.path.dirname(out_tif) or ".", exist_ok=True)
+    tmp_tif = out_tif + f".{os.getpid()}.tmp"
+    records = []
+
+    with rasterio.open(tmp_tif, 'w', **profile) as dst:
+        for band, name in enumerate(BANDS, start=1):
+            dst.set_band_description(band, name)
+
+        def write(tile, result):
+            record, bands = result
+            window = grid.window(*tile[3:])
+            if bands is None:
+                bands = np.full((len(BANDS), int(window.height), int(window.width)), np.nan, dtype=np.float32)
+            dst.write(bands, window=window)
+            records.append(record)
+            print(f"[{record['status']}] tile {record['tile_id']} ({len(records)}/{len(tiles)}, "
+                  f"{record['seconds']:.1f}s)")
+
+        if workers is None or workers <= 1:
+            _init_context(*init_args)
+            try:
+                for tile in tiles:
+                    write(tile, _run_tile(grid, tile, *task_args))
+            finally:
+                _CONTEXT['era5_archive'].close()
+        else:
+            # Build the persisted GADM index once so workers only unpickle it
+            GADMIndex(gadm_file, index_file=gadm_index_file)
+            pending = {}
+            queue = iter(tiles)
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_context, initargs=init_args) as pool:
+                while True:
+                    for tile in queue:
+                        pending[pool.submit(_run_tile, grid, tile, *task_args)] = tile
+                        if len(pending) >= 2 * workers:
+                            break
+                    if not pending:
+                        break
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        write(pending.pop(future), future.result())
+
+    os.replace(tmp_tif, out_tif)
+    return records
+
+
+def domain_bounds(era5_folder, year, ndvi_file, bbox=None):
+    """Overlap of the ERA5 grid, the NDVI mosaic (in lon/lat) and an optional bbox"""
+    with ERA5Archive(era5_folder) as archive:
+        ds = archive.dataset(year)
+        lat, lon = ds.latitude.values, ds.longitude.values
+    with rasterio.open(ndvi_file) as src:
+        ndvi_bounds = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+    boxes = [(lon.min(), lat.min(), lon.max(), lat.max()), ndvi_bounds] + ([bbox] if bbox else [])
+    bounds = (max(b[0] for b in boxes), max(b[1] for b in boxes), min(b[2] for b in boxes), min(b[3] for b in boxes))
+    return lat, lon, bounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tiled NDVI-temperature correlation and UHI intensity over the whole ERA5/NDVI overlap")
+    parser.add_argument('--year', type=int, default=2022)
+    parser.add_argument('--tile-cells', type=int, default=20, help="Tile size in ERA5 cells (20 = 2 degrees)")
+    parser.add_argument('--upsample', type=int, default=10, help="Pixels per ERA5 cell along each axis")
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('MINX', 'MINY', 'MAXX', 'MAXY'),
+                        help="Restrict to this lon/lat box")
+    parser.add_argument('--workers', type=int, default=1, help="Number of tiles analysed in parallel")
+    parser.add_argument('--ndvi-overviews', action='store_true',
+                        help="Resample NDVI from cached decimated overviews instead of full-resolution pixels")
+    args = parser.parse_args()
+
+    print("="*60)
+    print("TILED URBAN HEAT ISLAND MAP")
+    print("="*60)
+
+    DATA_FOLDER = "data"
+    OUTPUT_FOLDER = "reports/tiles"
+    GADM_FILE = os.path.join(DATA_FOLDER, "gadm_410_europe.gpkg")
+    ERA5_FOLDER = os.path.join(DATA_FOLDER, "derived-era5-land-daily-statistics")
+    NDVI_FOLDER = os.path.join(DATA_FOLDER, "sentinel2_ndvi")
+    GADM_INDEX_FILE = os.path.join(DATA_FOLDER, "cache", "gadm_index.pkl")
+    NDVI_OVERVIEW_FOLDER = os.path.join(DATA_FOLDER, "cache", "ndvi_overviews")
+
+    season_start = f"{args.year}-06-01"
+    season_end = f"{args.year}-09-01"
+    ndvi_file = resolve_ndvi_file(NDVI_FOLDER, args.year, season_start, season_end)
+    if ndvi_file is None:
+        print("No NDVI file found.")
+        return
+
+    lat, lon, bounds = domain_bounds(ERA5_FOLDER, args.year, ndvi_file, args.bbox)
+    grid = TileGrid(lat, lon, bounds, tile_cells=args.tile_cells, factor=args.upsample)
+    n_tiles = len(grid.tiles())
+    print(f"Domain: {bounds[0]:.2f}, {bounds[1]:.2f}, {bounds[2]:.2f}, {bounds[3]:.2f}")
+    print(f"Raster: {grid.shape[1]} x {grid.shape[0]} pixels of {grid.pixel:.4f} degrees, {n_tiles} tiles")
+
+    out_tif = os.path.join(OUTPUT_FOLDER, f"uhi_tiles_{args.year}.tif")
+    records = run_tiles(grid, args.year, season_start, season_end, ndvi_file, GADM_FILE, ERA5_FOLDER, out_tif,
+                        workers=args.workers, gadm_index_file=GADM_INDEX_FILE,
+                        ndvi_overview_dir=NDVI_OVERVIEW_FOLDER if args.ndvi_overviews else None)
+
+    table = pd.DataFrame(records).sort_values(['row', 'col'])
+    last = ['status', 'error', 'seconds']
+    table = table[[c for c in table.columns if c not in last + ['traceback']] + last]
+    out_csv = os.path.join(OUTPUT_FOLDER, f"uhi_tiles_{args.year}.csv")
+    table.to_csv(out_csv, index=False)
+
+    ok = table[table['status'] == 'ok']
+    print("\n" + "="*60)
+    print(f"Tiles: {len(ok)} analysed, {(table['status'] == 'no_land').sum()} without land, "
+          f"{(table['status'] == 'failed').sum()} failed")
+    if not ok.empty:
+        print(f"Median UHI intensity: {ok['uhi_intensity'].median():.2f}°C")
+        print(f"Median NDVI-temperature correlation: {ok['correlation'].median():.2f}")
+    for _, r in table[table['status'] == 'failed'].iterrows():
+        print(f"  - tile {r['tile_id']}: {r['error']}")
+    print(f"Raster saved: {out_tif}")
+    print(f"Tile table saved: {out_csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,277 +1,232 @@
 import os
-import xarray as xr
-import pandas as pd
-import rasterio
+import time
+import argparse
 from rasterio.mask import mask
-from rasterio.warp import reproject, Resampling
-import geopandas as gpd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
-from glob import glob
-from scipy.stats import pearsonr
 import rioxarray
+from figures import FigureRenderer, FIGURE_MODES
+from city_runner import run_cities, print_failures
+from run_manifest import RunManifest
+from landmask import mask_multiplier
+from ndvi_stats import binned_stats, uhi_intensity, plot_class_boxplot, valid_pixels, WEEK2_CLASS_LABELS
+from online_stats import MomentAccumulator
+from density_plot import density_plot_data, plot_density
+from ndvi_access import read_ndvi_window
+from aligned_grid import (load_aligned_stack, prefetch_aligned_stack, city_gdf_from_stack, study_area_from_city,
+                          resolve_ndvi_file)
+from instrumentation import Tracer, stage, print_trace_summary
 
-def analyze_city(country_code, city_name, year, gadm_gdf, era5_folder, ndvi_folder, output_folder, vmin=None, vmax=None):
-    print(f"\n" + "-"*40)
-    print(f"Starting Analysis for {city_name}, {country_code} ({year})")
-    print("-"*40)
+# Study area buffer around the city polygon (approx 20km) and season (month-day) analysed
+BUFFER_DEGREE = 0.2
+SEASON = ("06-01", "09-01")
+
+def plot_temperature_map(out_path, temp_smooth, xr_ndvi, city_gdf, city_name, year, vmin=None, vmax=None):
+    fig, ax = plt.subplots(figsize=(12, 10))
     
-    stats = {}
+    # Plot Temperature (Land Only)
+    # Use a colormap that highlights heat (RdYlBu_r is good: Blue=Cool, Red=Hot)
+    # Fixed scale for comparison if vmin/vmax provided
+    temp_plot = temp_smooth.plot(ax=ax, cmap='RdYlBu_r', add_colorbar=True, 
+                                 vmin=vmin, vmax=vmax,
+                                 cbar_kwargs={'label': 'Temperature (°C)'})
+    
+    # Add Contours to show gradients better
+    temp_smooth.plot.contour(ax=ax, levels=8, colors='black', linewidths=0.3, alpha=0.5)
 
-    try:
-        # --- 1. Define Study Area ---
-        # Filter GADM
-        # Search levels 5 down to 1 to find the city/town
-        city_gdf = gpd.GeoDataFrame()
-        for level in [5, 4, 3, 2, 1]:
-            col = f'NAME_{level}'
-            if col in gadm_gdf.columns:
-                temp_gdf = gadm_gdf[(gadm_gdf.GID_0 == country_code) & (gadm_gdf[col] == city_name)]
-                if not temp_gdf.empty:
-                    city_gdf = temp_gdf
-                    print(f"Found {city_name} at Admin Level {level}")
-                    break
-        
-        if city_gdf.empty:
-            print(f"Error: City {city_name} not found in GADM data for {country_code}.")
-            return None
+    # --- Add Vegetation Overlay ---
+    # 1. Add Green Contours for Vegetation (NDVI > 0.4, 0.6, 0.8)
+    # This shows the structure of vegetation on top of temperature
+    # User requested lighter stroke
+    xr_ndvi.plot.contour(ax=ax, levels=[0.4, 0.6, 0.8], colors=['#90EE90', '#32CD32', '#006400'], 
+                         linewidths=0.8, linestyles='--')
 
-        city_gdf = city_gdf.dissolve()
-        
-        # Create Buffer (approx 20km)
-        BUFFER_DEGREE = 0.2
-        study_area_gdf = city_gdf.copy()
-        study_area_gdf.geometry = city_gdf.geometry.buffer(BUFFER_DEGREE)
-        
-        minx, miny, maxx, maxy = study_area_gdf.total_bounds
-        print(f"Study area defined: {minx:.4f}, {miny:.4f}, {maxx:.4f}, {maxy:.4f}")
+    # Mask out low vegetation
+    # ndvi_high_veg = xr_ndvi.where(xr_ndvi > 0.5)
+    # ndvi_high_veg.plot.imshow(ax=ax, cmap='Greens', alpha=0.25, add_colorbar=False)
 
-        # Create Land Mask (Clip GADM to Study Area)
-        # This ensures we only look at land, removing sea/ocean
-        land_gdf = gpd.clip(gadm_gdf, study_area_gdf.envelope)
+    # City Boundary (Thick and Distinct)
+    city_gdf.boundary.plot(ax=ax, color='black', linewidth=2.5, label='City Boundary')
+    
+    # Add a custom legend element for Vegetation
+    from matplotlib.lines import Line2D
+    from matplotlib.patches import Patch
+    legend_elements = [
+        Line2D([0], [0], color='#32CD32', lw=0.8, linestyle='--', label='Vegetation Contours (NDVI)'),
+        # Patch(facecolor='green', alpha=0.25, label='High Vegetation Area') # Removed
+    ]
+    ax.legend(handles=legend_elements, loc='upper right')
 
-        # --- 2. Temperature Analysis (ERA5) ---
-        print("Processing Temperature Data...")
-        temp_file = os.path.join(era5_folder, f"{year}_2m_temperature_daily_maximum.nc")
-        ds_temp = xr.open_dataset(temp_file)
-        
-        season_start = f"{year}-06-01"
-        season_end = f"{year}-09-01"
-        
-        ds_summer = ds_temp.sel(valid_time=slice(season_start, season_end))
-        mean_max_temp = ds_summer['t2m'].mean(dim='valid_time')
-        mean_max_temp_c = mean_max_temp - 273.15
-        
-        # Clip to study area bounding box first
-        temp_clipped = mean_max_temp_c.sel(
-            longitude=slice(minx, maxx),
-            latitude=slice(maxy, miny)
-        )
-        
-        # Interpolate for smoother visualization (10x resolution)
-        new_lat = np.linspace(float(temp_clipped.latitude.min()), float(temp_clipped.latitude.max()), len(temp_clipped.latitude) * 10)
-        new_lon = np.linspace(float(temp_clipped.longitude.min()), float(temp_clipped.longitude.max()), len(temp_clipped.longitude) * 10)
-        temp_smooth = temp_clipped.interp(latitude=new_lat, longitude=new_lon, method='linear')
+    plt.title(f"Temperature & Vegetation Overlay (Summer {year}) - {city_name}")
+    plt.savefig(out_path)
+    plt.close()
+    print(f"Saved Enhanced Temperature Map: {out_path}")
 
-        # Mask Water Bodies using Land Mask
-        try:
-            temp_smooth = temp_smooth.rio.write_crs("EPSG:4326")
-            temp_smooth = temp_smooth.rio.clip(land_gdf.geometry, land_gdf.crs, drop=False)
-        except Exception as e:
-            print(f"Warning: Could not clip temperature to land geometry: {e}")
+def read_ndvi_high_res(ndvi_window, study_area_gdf, city_gdf):
+    """Crop the full-resolution NDVI window to the study area; returns (array, extent, city boundary in raster CRS)"""
+    src = ndvi_window.dataset
+    gdf_crs = study_area_gdf.to_crs(src.crs)
+    out_image, out_transform = mask(src, gdf_crs.geometry, crop=True)
+    out_meta = src.meta.copy()
+    city_gdf_crs = city_gdf.to_crs(src.crs)
+    
+    ndvi_high_res = out_image[0].astype(float)
+    ndvi_high_res[ndvi_high_res == out_meta['nodata']] = np.nan
+    ndvi_high_res = ndvi_high_res / 254.0 * 2.0 - 1.0
+    
+    height, width = ndvi_high_res.shape
+    xmin = out_transform[2]
+    ymax = out_transform[5]
+    xmax = xmin + width * out_transform[0]
+    ymin = ymax + height * out_transform[4]
+    return ndvi_high_res, [xmin, xmax, ymin, ymax], city_gdf_crs
 
-        # --- 3. NDVI Analysis (Pre-load for overlay) ---
-        print("Processing NDVI Data...")
-        ndvi_file = os.path.join(ndvi_folder, f"ndvi_{season_start}_{season_end}.tif")
-        
-        if not os.path.exists(ndvi_file):
-             files = glob(os.path.join(ndvi_folder, f"*{year}*.tif"))
-             if files:
-                 ndvi_file = files[0]
-                 print(f"Using fallback NDVI: {os.path.basename(ndvi_file)}")
-             else:
-                 print("No NDVI file found.")
-                 return None
+def plot_ndvi_map(out_path, ndvi_high_res, extent, city_gdf_crs, city_name, year):
+    plt.figure(figsize=(10, 8))
+    plt.imshow(ndvi_high_res, cmap='RdYlGn', vmin=-0.2, vmax=0.8, extent=extent)
+    plt.colorbar(label='NDVI')
+    city_gdf_crs.boundary.plot(ax=plt.gca(), color='black', linewidth=2, label=f'{city_name} Boundary')
+    plt.title(f"NDVI Vegetation Index (Summer {year}) - {city_name}")
+    plt.legend()
+    plt.savefig(out_path)
+    plt.close()
+    print(f"Saved NDVI Map: {out_path}")
 
-        # Resample NDVI to match Temperature Grid for Overlay & Stats
-        # We do this BEFORE plotting to use it as an overlay
-        with rasterio.open(ndvi_file) as src:
-            # Create destination array (matching temp_smooth shape)
-            dst_shape = temp_smooth.shape
-            # from_bounds creates a North-up transform (row 0 is North)
-            dst_transform = rasterio.transform.from_bounds(
-                new_lon.min(), new_lat.min(), new_lon.max(), new_lat.max(), 
-                dst_shape[1], dst_shape[0]
-            )
-            
-            ndvi_resampled = np.zeros(dst_shape, dtype=np.float32)
-            
-            reproject(
-                source=rasterio.band(src, 1),
-                destination=ndvi_resampled,
-                src_transform=src.transform,
-                src_crs=src.crs,
-                dst_transform=dst_transform,
-                dst_crs="EPSG:4326",
-                resampling=Resampling.average
-            )
-            
-            ndvi_resampled = ndvi_resampled.astype(float)
-            ndvi_resampled = ndvi_resampled / 254.0 * 2.0 - 1.0
+def plot_scatter(out_path, density, regression, corr_coef, city_name):
+    fig, ax = plt.subplots(figsize=(8, 6))
+    plot_density(ax, density, regression=regression)
+    ax.set_title(f"Correlation: NDVI vs Temperature - {city_name}\nR = {corr_coef:.2f} ({density.total:,} pixels)")
+    ax.set_xlabel("Vegetation Index (NDVI)")
+    ax.set_ylabel("Max Temperature (°C)")
+    ax.legend()
+    ax.grid(True, alpha=0.3)
+    plt.savefig(out_path)
+    plt.close()
+    print(f"Saved Scatter Plot: {out_path}")
 
-        # Wrap NDVI in xarray for easy plotting and alignment
-        # Note: ndvi_resampled is North-up (from_bounds default), but temp_smooth is South-up (new_lat is ascending)
-        # So we assign latitude=new_lat[::-1] to the NDVI DataArray to match the data orientation
-        xr_ndvi = xr.DataArray(
-            ndvi_resampled,
-            coords={'latitude': new_lat[::-1], 'longitude': new_lon},
-            dims=('latitude', 'longitude')
-        )
-        # Sort by latitude to match temp_smooth (South-up) for consistency in operations
-        xr_ndvi = xr_ndvi.sortby('latitude')
-        
-        # Update ndvi_resampled to be the aligned numpy array (South-up) for stats later
-        ndvi_resampled = xr_ndvi.values
+def plot_boxplot(out_path, class_table, city_name):
+    colors = dict(zip(class_table.index, sns.color_palette("RdYlGn", len(class_table))))
+    fig, ax = plt.subplots(figsize=(10, 6))
+    plot_class_boxplot(ax, class_table, colors)
+    plt.title(f"Temperature Distribution by Vegetation Density - {city_name}")
+    plt.ylabel("Max Temperature (°C)")
+    plt.xlabel("NDVI Category")
+    plt.xticks(rotation=15)
+    plt.savefig(out_path)
+    plt.close()
+    print(f"Saved Boxplot: {out_path}")
 
-        # --- 4. Plotting Temperature with Context ---
-        print("Generating Enhanced Temperature Map...")
-        fig, ax = plt.subplots(figsize=(12, 10))
-        
-        # Plot Temperature (Land Only)
-        # Use a colormap that highlights heat (RdYlBu_r is good: Blue=Cool, Red=Hot)
-        # Fixed scale for comparison if vmin/vmax provided
-        temp_plot = temp_smooth.plot(ax=ax, cmap='RdYlBu_r', add_colorbar=True, 
-                                     vmin=vmin, vmax=vmax,
-                                     cbar_kwargs={'label': 'Temperature (°C)'})
-        
-        # Add Contours to show gradients better
-        temp_smooth.plot.contour(ax=ax, levels=8, colors='black', linewidths=0.3, alpha=0.5)
+def read_study_area_ndvi(country_code, city_name, year, gadm_index, ndvi_folder):
+    """Full-resolution NDVI window of the study area and the study area, or (None, None)"""
+    ndvi_file = resolve_ndvi_file(ndvi_folder, year, f"{year}-{SEASON[0]}", f"{year}-{SEASON[1]}")
+    city_gdf, _ = gadm_index.find_city(country_code, city_name)
+    if ndvi_file is None or city_gdf.empty:
+        return None, None
+    study_area_gdf = study_area_from_city(city_gdf, BUFFER_DEGREE)
+    return read_ndvi_window(ndvi_file, tuple(study_area_gdf.total_bounds)), study_area_gdf
 
-        # --- Add Vegetation Overlay ---
-        # 1. Add Green Contours for Vegetation (NDVI > 0.4, 0.6, 0.8)
-        # This shows the structure of vegetation on top of temperature
-        # User requested lighter stroke
-        xr_ndvi.plot.contour(ax=ax, levels=[0.4, 0.6, 0.8], colors=['#90EE90', '#32CD32', '#006400'], 
-                             linewidths=0.8, linestyles='--')
+def analyze_city(country_code, city_name, year, gadm_index, era5_folder, ndvi_folder, output_folder, vmin=None, vmax=None,
+                 cache_dir=None, era5_archive=None, raise_errors=False, renderer=None, ndvi_overview_dir=None,
+                 upsample_factor=10, dtype='float64', prefetched=None):
+    print(f"\n" + "-"*40)
+    print(f"Starting Analysis for {city_name}, {country_code} ({year})")
+    print("-"*40)
+    
+    stats = {}
+    # Figures are drawn from plot-ready data by the renderer (inline by default)
+    if renderer is None:
+        renderer = FigureRenderer()
 
-        # Mask out low vegetation
-        # ndvi_high_veg = xr_ndvi.where(xr_ndvi > 0.5)
-        # ndvi_high_veg.plot.imshow(ax=ax, cmap='Greens', alpha=0.25, add_colorbar=False)
+    ndvi_window = None
+    try:
+        # --- 1-3. Study Area, Temperature (ERA5) and NDVI on one aligned grid ---
+        season_start, season_end = f"{year}-{SEASON[0]}", f"{year}-{SEASON[1]}"
 
-        # City Boundary (Thick and Distinct)
-        city_gdf.boundary.plot(ax=ax, color='black', linewidth=2.5, label='City Boundary')
-        
-        # Add a custom legend element for Vegetation
-        from matplotlib.lines import Line2D
-        from matplotlib.patches import Patch
-        legend_elements = [
-            Line2D([0], [0], color='#32CD32', lw=0.8, linestyle='--', label='Vegetation Contours (NDVI)'),
-            # Patch(facecolor='green', alpha=0.25, label='High Vegetation Area') # Removed
-        ]
-        ax.legend(handles=legend_elements, loc='upper right')
+        # The study-area NDVI window is read once when the high-res map is wanted and
+        # also feeds the resampling (unless the stack is resampled from overviews);
+        # prefetch_city may have read it already
+        if prefetched is not None:
+            ndvi_window, study_area_gdf = prefetched['ndvi_window'], prefetched['study_area_gdf']
+        elif renderer.wants():
+            with stage('ndvi_window'):
+                ndvi_window, study_area_gdf = read_study_area_ndvi(country_code, city_name, year, gadm_index,
+                                                                   ndvi_folder)
 
-        plt.title(f"Temperature & Vegetation Overlay (Summer {year}) - {city_name}")
-        out_temp = os.path.join(output_folder, f"week2_temperature_{city_name}.png")
-        plt.savefig(out_temp)
-        plt.close()
-        print(f"Saved Enhanced Temperature Map: {out_temp}")
+        with stage('aligned_stack'):
+            stack = load_aligned_stack(country_code, city_name, year, gadm_index, era5_folder, ndvi_folder,
+                                       season_start, season_end, buffer_degree=BUFFER_DEGREE,
+                                       upsample_factor=upsample_factor, cache_dir=cache_dir,
+                                       era5_archive=era5_archive,
+                                       ndvi_window=None if ndvi_overview_dir else ndvi_window,
+                                       ndvi_overview_dir=ndvi_overview_dir, dtype=dtype,
+                                       prefetched=prefetched['stack'] if prefetched is not None else None)
+        if stack is None:
+            return None
 
-        # --- 5. Plotting NDVI (High Res) ---
-        with rasterio.open(ndvi_file) as src:
-            gdf_crs = study_area_gdf.to_crs(src.crs)
-            out_image, out_transform = mask(src, gdf_crs.geometry, crop=True)
-            out_meta = src.meta.copy()
-            
-            ndvi_high_res = out_image[0].astype(float)
-            ndvi_high_res[ndvi_high_res == out_meta['nodata']] = np.nan
-            ndvi_high_res = ndvi_high_res / 254.0 * 2.0 - 1.0
-            
-            height, width = ndvi_high_res.shape
-            xmin = out_transform[2]
-            ymax = out_transform[5]
-            xmax = xmin + width * out_transform[0]
-            ymin = ymax + height * out_transform[4]
-            
-            plt.figure(figsize=(10, 8))
-            plt.imshow(ndvi_high_res, cmap='RdYlGn', vmin=-0.2, vmax=0.8, extent=[xmin, xmax, ymin, ymax])
-            plt.colorbar(label='NDVI')
-            city_gdf_crs = city_gdf.to_crs(src.crs)
-            city_gdf_crs.boundary.plot(ax=plt.gca(), color='black', linewidth=2, label=f'{city_name} Boundary')
-            plt.title(f"NDVI Vegetation Index (Summer {year}) - {city_name}")
-            plt.legend()
-            out_ndvi = os.path.join(output_folder, f"week2_ndvi_{city_name}.png")
-            plt.savefig(out_ndvi)
-            plt.close()
-            print(f"Saved NDVI Map: {out_ndvi}")
+        city_gdf = city_gdf_from_stack(stack)
+
+        # Mask Water Bodies: the rasterized land mask is NaN over sea, so masking is a multiplication
+        with stage('masking') as s:
+            land = mask_multiplier(stack['land_mask'].values)
+            temp_smooth = stack['temperature'] * land
+            xr_ndvi = stack['ndvi'] * land
+            s.shape('temperature', temp_smooth)
+
+        # --- 4. Temperature with Context (summary figure) ---
+        with stage('temperature_map'):
+            renderer.submit(plot_temperature_map, os.path.join(output_folder, f"week2_temperature_{city_name}.png"),
+                            summary=True, temp_smooth=temp_smooth, xr_ndvi=xr_ndvi, city_gdf=city_gdf,
+                            city_name=city_name, year=year, vmin=vmin, vmax=vmax)
+
+        # --- 5. NDVI (High Res), cropped from the window read above ---
+        if ndvi_window is not None:
+            with stage('ndvi_map') as s:
+                ndvi_high_res, extent, city_gdf_crs = read_ndvi_high_res(ndvi_window, study_area_gdf, city_gdf)
+                s.shape('ndvi_high_res', ndvi_high_res)
+                renderer.submit(plot_ndvi_map, os.path.join(output_folder, f"week2_ndvi_{city_name}.png"),
+                                ndvi_high_res=ndvi_high_res, extent=extent, city_gdf_crs=city_gdf_crs,
+                                city_name=city_name, year=year)
 
         # --- 6. Statistical Analysis & Correlation ---
         print("Calculating Correlation and Insights...")
         
-        # Flatten arrays (Use the masked temp_smooth to avoid water in stats!)
-        # temp_smooth is an xarray, convert to numpy and flatten
-        temp_flat = temp_smooth.values.flatten()
-        ndvi_flat = ndvi_resampled.flatten()
-        
-        # Create DataFrame
-        df = pd.DataFrame({'Temperature': temp_flat, 'NDVI': ndvi_flat})
-        
-        # Clean Data (Remove NaNs and outliers)
-        df_clean = df.dropna()
-        df_clean = df_clean[(df_clean['NDVI'] >= -1) & (df_clean['NDVI'] <= 1)]
+        # Use the masked temp_smooth to avoid water in stats! One validity mask (NaNs and
+        # NDVI outliers removed) selects the pixels once; everything below uses them
+        with stage('statistics'):
+            valid = valid_pixels(xr_ndvi.values, temp_smooth.values)
+            temp_flat = temp_smooth.values[valid]
+            ndvi_flat = xr_ndvi.values[valid]
+            moments = MomentAccumulator(('NDVI', 'Temperature'))
+            moments.update(ndvi_flat, temp_flat)
         
         # Calculate Correlation
-        if len(df_clean) > 0:
-            corr_coef, p_value = pearsonr(df_clean['NDVI'], df_clean['Temperature'])
+        if moments.count > 0:
+            corr_coef, p_value = moments.pearsonr('NDVI', 'Temperature')
             stats['correlation'] = corr_coef
             print(f"Correlation (NDVI vs Temp): {corr_coef:.4f} (p-value: {p_value:.4e})")
 
-            # Scatter Plot with Regression Line
-            plt.figure(figsize=(8, 6))
-            plot_data = df_clean.sample(n=min(5000, len(df_clean)), random_state=42)
-            sns.regplot(x='NDVI', y='Temperature', data=plot_data, 
-                        scatter_kws={'alpha':0.3, 's':10}, line_kws={'color':'red'})
-            plt.title(f"Correlation: NDVI vs Temperature - {city_name}\nR = {corr_coef:.2f}")
-            plt.xlabel("Vegetation Index (NDVI)")
-            plt.ylabel("Max Temperature (°C)")
-            plt.grid(True, alpha=0.3)
-            out_scatter = os.path.join(output_folder, f"week2_scatter_{city_name}.png")
-            plt.savefig(out_scatter)
-            plt.close()
-            print(f"Saved Scatter Plot: {out_scatter}")
+            # Density of every pixel with the exact regression line (only the binned counts are plotted)
+            if renderer.wants():
+                with stage('scatter'):
+                    renderer.submit(plot_scatter, os.path.join(output_folder, f"week2_scatter_{city_name}.png"),
+                                    **density_plot_data(moments, 'NDVI', 'Temperature', ndvi_flat, temp_flat),
+                                    corr_coef=corr_coef, city_name=city_name)
 
-            # Insight: UHI Intensity
-            urban_temps = df_clean[df_clean['NDVI'] < 0.3]['Temperature']
-            rural_temps = df_clean[df_clean['NDVI'] > 0.6]['Temperature']
-            
-            stats['avg_temp_urban'] = urban_temps.mean() if not urban_temps.empty else np.nan
-            stats['avg_temp_rural'] = rural_temps.mean() if not rural_temps.empty else np.nan
-            stats['uhi_intensity'] = stats['avg_temp_urban'] - stats['avg_temp_rural']
+            # Insight: UHI Intensity (urban NDVI < 0.3 vs rural NDVI > 0.6)
+            with stage('uhi_intensity'):
+                stats['avg_temp_urban'], stats['avg_temp_rural'], stats['uhi_intensity'] = uhi_intensity(ndvi_flat, temp_flat)
             
             print(f"Avg Temp Urban (NDVI < 0.3): {stats['avg_temp_urban']:.2f}°C")
             print(f"Avg Temp Rural (NDVI > 0.6): {stats['avg_temp_rural']:.2f}°C")
             print(f"Estimated UHI Intensity: {stats['uhi_intensity']:.2f}°C")
 
-            # Boxplot
-            def classify_ndvi(val):
-                if val < 0.2: return 'Urban/Water (<0.2)'
-                elif val < 0.4: return 'Sparse Veg (0.2-0.4)'
-                elif val < 0.6: return 'Moderate Veg (0.4-0.6)'
-                else: return 'Dense Veg (>0.6)'
-                
-            df_clean['Category'] = df_clean['NDVI'].apply(classify_ndvi)
-            order = ['Urban/Water (<0.2)', 'Sparse Veg (0.2-0.4)', 'Moderate Veg (0.4-0.6)', 'Dense Veg (>0.6)']
-            
-            plt.figure(figsize=(10, 6))
-            sns.boxplot(x='Category', y='Temperature', data=df_clean, order=order, palette="RdYlGn")
-            plt.title(f"Temperature Distribution by Vegetation Density - {city_name}")
-            plt.ylabel("Max Temperature (°C)")
-            plt.xlabel("NDVI Category")
-            plt.xticks(rotation=15)
-            out_box = os.path.join(output_folder, f"week2_boxplot_{city_name}.png")
-            plt.savefig(out_box)
-            plt.close()
-            print(f"Saved Boxplot: {out_box}")
+            # Boxplot from the per-class statistics (no per-pixel classification)
+            if renderer.wants():
+                with stage('boxplot'):
+                    class_table = binned_stats(ndvi_flat, temp_flat, labels=WEEK2_CLASS_LABELS)
+                    renderer.submit(plot_boxplot, os.path.join(output_folder, f"week2_boxplot_{city_name}.png"),
+                                    class_table=class_table, city_name=city_name)
         else:
             print("Not enough valid data for statistics.")
             stats['correlation'] = np.nan
@@ -281,12 +236,56 @@ def analyze_city(country_code, city_name, year, gadm_gdf, era5_folder, ndvi_fold
         return stats
 
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"Error analyzing {city_name}: {e}")
         import traceback
         traceback.print_exc()
         return None
+    finally:
+        if ndvi_window is not None:
+            ndvi_window.close()
+
+def prefetch_city(country_code, city_name, year, gadm_index, era5_folder, ndvi_folder, cache_dir=None,
+                  era5_archive=None, renderer=None, ndvi_overview_dir=None, upsample_factor=10, dtype='float64',
+                  **kwargs):
+    """The reads of analyze_city for one city, done ahead by run_cities"""
+    ndvi_window = study_area_gdf = None
+    if renderer is None or renderer.wants():
+        ndvi_window, study_area_gdf = read_study_area_ndvi(country_code, city_name, year, gadm_index, ndvi_folder)
+    stack = prefetch_aligned_stack(country_code, city_name, year, gadm_index, era5_folder, ndvi_folder,
+                                   f"{year}-{SEASON[0]}", f"{year}-{SEASON[1]}", buffer_degree=BUFFER_DEGREE,
+                                   upsample_factor=upsample_factor, cache_dir=cache_dir, era5_archive=era5_archive,
+                                   ndvi_window=None if ndvi_overview_dir else ndvi_window,
+                                   ndvi_overview_dir=ndvi_overview_dir, dtype=dtype)
+    return {'ndvi_window': ndvi_window, 'study_area_gdf': study_area_gdf, 'stack': stack}
 
 def main():
+    parser = argparse.ArgumentParser(description="Week 2 Urban Heat Island analysis")
+    parser.add_argument('--workers', type=int, default=1, help="Number of cities analysed in parallel")
+    parser.add_argument('--figures', choices=FIGURE_MODES, default='all',
+                        help="Render all figures, only the temperature maps, or none")
+    parser.add_argument('--render-workers', type=int, default=0,
+                        help="Background processes drawing figures (0 = draw inline)")
+    parser.add_argument('--ndvi-overviews', action='store_true',
+                        help="Resample NDVI from cached decimated overviews instead of full-resolution pixels")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="Append per-stage timings and memory of each city run to FILE (JSON lines)")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="Also trace Python/numpy allocation peaks per stage (slower)")
+    parser.add_argument('--upsample', type=int, default=10, help="ERA5 upsampling factor of the aligned grid")
+    parser.add_argument('--float32', action='store_true',
+                        help="Memory-lean mode: keep the aligned grid and pixel fields in float32")
+    parser.add_argument('--prefetch', type=int, default=1,
+                        help="Cities whose reads run ahead on background threads (0 = off; serial runs only)")
+    parser.add_argument('--prefetch-mb', type=int, default=1024,
+                        help="Stop reading ahead while prefetched data holds more than this")
+    parser.add_argument('--manifest', default=os.path.join("reports", "figures", "week2_manifest.jsonl"),
+                        help="Run manifest: finished cities are logged here and not rerun while unchanged")
+    parser.add_argument('--rerun', action='store_true', help="Run every city again, even if unchanged (still logged)")
+    parser.add_argument('--retry-failed', action='store_true', help="Run the cities that failed last time again")
+    args = parser.parse_args()
+
     print("Starting Week 2 Analysis: Urban Heat Island Effect (Enhanced)")
 
     DATA_FOLDER = "data"
@@ -294,10 +293,10 @@ def main():
     GADM_FILE = os.path.join(DATA_FOLDER, "gadm_410_europe.gpkg")
     ERA5_FOLDER = os.path.join(DATA_FOLDER, "derived-era5-land-daily-statistics")
     NDVI_FOLDER = os.path.join(DATA_FOLDER, "sentinel2_ndvi")
+    CACHE_FOLDER = os.path.join(DATA_FOLDER, "cache", "aligned")
+    GADM_INDEX_FILE = os.path.join(DATA_FOLDER, "cache", "gadm_index.pkl")
+    NDVI_OVERVIEW_FOLDER = os.path.join(DATA_FOLDER, "cache", "ndvi_overviews")
     
-    print("Loading GADM data...")
-    gadm_gdf = gpd.read_file(GADM_FILE)
-
     cities = [
         ("FRA", "Paris"),
         ("ITA", "Roma"),
@@ -305,13 +304,30 @@ def main():
         ("ITA", "Perugia") # Smaller town in Italy (Inland)
     ]
     
+    # Cities run in a process pool when --workers > 1; each worker loads the
+    # GADM index and ERA5 handles once. Reverted to dynamic scaling (no vmin/vmax)
+    # per user request to improve local contrast.
+    tasks = [(country, city, 2022) for country, city in cities]
+    renderer = FigureRenderer(args.figures, workers=args.render_workers)
+    tracer = Tracer(args.trace, trace_memory=args.trace_memory)
+    manifest = RunManifest(args.manifest)
+    started = time.time()
+    records = run_cities(analyze_city, tasks, GADM_FILE, ERA5_FOLDER, NDVI_FOLDER, OUTPUT_FOLDER,
+                         workers=args.workers, gadm_index_file=GADM_INDEX_FILE, cache_dir=CACHE_FOLDER,
+                         renderer=renderer, ndvi_overview_dir=NDVI_OVERVIEW_FOLDER if args.ndvi_overviews else None,
+                         upsample_factor=args.upsample, dtype='float32' if args.float32 else 'float64',
+                         tracer=tracer, manifest=manifest, retry_failed=args.retry_failed, rerun=args.rerun,
+                         prefetch_fn=prefetch_city, prefetch_depth=args.prefetch, prefetch_max_bytes=args.prefetch_mb * 1024**2)
+    renderer.close()
+    print_failures(records)
+    if args.trace:
+        print_trace_summary(args.trace, since=started)
+    
     results = []
-
-    for country, city in cities:
-        # Reverted to dynamic scaling per user request to improve local contrast
-        res = analyze_city(country, city, 2022, gadm_gdf, ERA5_FOLDER, NDVI_FOLDER, OUTPUT_FOLDER)
-        if res:
-            res['city'] = city
+    for record in records:
+        if record['status'] == 'ok':
+            res = record['stats']
+            res['city'] = record['city']
             results.append(res)
             
     # Summary
@@ -327,6 +343,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
-if __name__ == "__main__":
-    main()
@@ -1,19 +1,94 @@
 import os
+import time
+import argparse
 import xarray as xr
 import pandas as pd
-import geopandas as gpd
 import matplotlib.pyplot as plt
-import seaborn as sns
 import numpy as np
-from glob import glob
-from scipy.stats import pearsonr
-import rasterio
-from rasterio.warp import reproject, Resampling
 import rioxarray
+from figures import FigureRenderer, FIGURE_MODES
+from city_runner import run_cities, print_failures
+from run_manifest import RunManifest
+from landmask import mask_multiplier
+from ndvi_stats import binned_stats, plot_class_boxplot, valid_pixels, WEEK3_CLASS_LABELS
+from online_stats import MomentAccumulator
+from density_plot import density_plot_data, plot_density
+from aligned_grid import load_aligned_stack, prefetch_aligned_stack, city_gdf_from_stack
+from instrumentation import Tracer, stage, print_trace_summary
 import warnings
 warnings.filterwarnings('ignore')
 
-def analyze_city_week3(country_code, city_name, year, gadm_gdf, era5_folder, ndvi_folder, output_folder):
+# Study area buffer around the city polygon (approx 20km) and season (month-day) analysed
+BUFFER_DEGREE = 0.2
+SEASON = ("06-01", "09-01")
+
+def plot_satellite_vs_ground(out_path, density, regression, rmse, city_name):
+    fig, ax = plt.subplots(figsize=(10, 8))
+    plot_density(ax, density, regression=regression, identity=True, cmap='viridis')
+    
+    ax.set_xlabel('Ground Truth Temperature (°C)', fontsize=12)
+    ax.set_ylabel('Satellite Temperature (°C)', fontsize=12)
+    ax.set_title(f'Satellite vs Ground Truth - {city_name}\nRMSE: {rmse:.2f}°C ({density.total:,} pixels)', 
+                 fontsize=14, fontweight='bold')
+    ax.legend(fontsize=11)
+    ax.grid(True, alpha=0.3)
+    plt.tight_layout()
+    plt.savefig(out_path, dpi=300)
+    plt.close()
+    print(f"Saved scatter plot: {out_path}")
+
+def plot_discrepancy_vs_vegetation(out_path, density, regression, correlation, city_name):
+    fig, ax = plt.subplots(figsize=(10, 8))
+    plot_density(ax, density, regression=regression, cmap='YlOrRd')
+    ax.set_xlabel('NDVI (Vegetation Index)', fontsize=12)
+    ax.set_ylabel('Absolute Temperature Discrepancy (°C)', fontsize=12)
+    ax.set_title(f'Discrepancy vs Vegetation - {city_name}\nCorr: {correlation:.3f}', 
+                 fontsize=14, fontweight='bold')
+    ax.legend(fontsize=11)
+    plt.tight_layout()
+    plt.savefig(out_path, dpi=300)
+    plt.close()
+    print(f"Saved discrepancy vs vegetation plot: {out_path}")
+
+def plot_discrepancy_boxplot(out_path, class_table, city_name):
+    fig, ax = plt.subplots(figsize=(10, 8))
+    colors = {'Urban/Concrete': '#d7191c', 'Sparse Vegetation': '#fdae61', 
+             'Moderate Vegetation': '#a6d96a', 'Dense Vegetation': '#1a9641'}
+    
+    plot_class_boxplot(ax, class_table, colors, width=0.6)
+    plt.ylabel('Absolute Temperature Discrepancy (°C)', fontsize=12)
+    plt.xlabel('Urbanization Level', fontsize=12)
+    plt.title(f'Discrepancy by Urbanization - {city_name}', 
+             fontsize=14, fontweight='bold')
+    plt.xticks(rotation=15, ha='right')
+    plt.grid(True, alpha=0.3, axis='y')
+    plt.tight_layout()
+    plt.savefig(out_path, dpi=300)
+    plt.close()
+    print(f"Saved boxplot: {out_path}")
+
+def plot_discrepancy_map(out_path, temp_smooth, discrepancy_data, city_gdf, city_name):
+    fig, ax = plt.subplots(figsize=(12, 10))
+    
+    # Plot satellite temperature as base
+    temp_smooth.plot(ax=ax, cmap='RdYlBu_r', add_colorbar=True, 
+                    cbar_kwargs={'label': 'Satellite Temperature (°C)'})
+    
+    # Overlay discrepancy as contours
+    discrepancy_data.plot.contour(ax=ax, levels=5, colors='purple', linewidths=1.5, alpha=0.6)
+    
+    city_gdf.boundary.plot(ax=ax, color='blue', linewidth=2.5, label='City Boundary')
+    
+    ax.legend(fontsize=11, loc='upper right')
+    ax.set_title(f'Discrepancy Map (Contours) - {city_name}', fontsize=14, fontweight='bold')
+    plt.tight_layout()
+    plt.savefig(out_path, dpi=300)
+    plt.close()
+    print(f"Saved map: {out_path}")
+
+def analyze_city_week3(country_code, city_name, year, gadm_index, era5_folder, ndvi_folder, output_folder,
+                       cache_dir=None, era5_archive=None, raise_errors=False, renderer=None,
+                       ndvi_overview_dir=None, upsample_factor=10, dtype='float64', prefetched=None):
     """
     Week 3 Analysis: Satellite data quality assessment via vegetation correlation
     
@@ -22,6 +97,10 @@ def analyze_city_week3(country_code, city_name, year, gadm_gdf, era5_folder, ndv
     - We model ground truth as: satellite - vegetation_correction
     - Ground truth correction: cooler where NDVI high, hotter where NDVI low
     - This simulates that satellites struggle in urban/concrete areas
+
+    With dtype='float32' the aligned grid and the per-pixel fields stay in
+    float32 (statistics still accumulate in float64). `prefetched` holds the
+    reads done ahead by prefetch_city_week3.
     """
     print(f"\n" + "-"*50)
     print(f"Week 3 Analysis: {city_name}, {country_code} ({year})")
@@ -29,99 +108,40 @@ def analyze_city_week3(country_code, city_name, year, gadm_gdf, era5_folder, ndv
     print("-"*50)
     
     stats = {}
+    # Figures are drawn from plot-ready data by the renderer (inline by default)
+    if renderer is None:
+        renderer = FigureRenderer()
     
     try:
-        # 1. Define Study Area 
-        city_gdf = gpd.GeoDataFrame()
-        for level in [5, 4, 3, 2, 1]:
-            col = f'NAME_{level}'
-            if col in gadm_gdf.columns:
-                temp_gdf = gadm_gdf[(gadm_gdf.GID_0 == country_code) & (gadm_gdf[col] == city_name)]
-                if not temp_gdf.empty:
-                    city_gdf = temp_gdf
-                    print(f"Found {city_name} at Admin Level {level}")
-                    break
-        
-        if city_gdf.empty:
-            print(f"Error: City {city_name} not found")
+        # 1-3. Study Area, ERA5 Temperature and NDVI on one aligned grid
+        season_start, season_end = f"{year}-{SEASON[0]}", f"{year}-{SEASON[1]}"
+        
+        print("Loading ERA5 satellite temperature and NDVI vegetation data...")
+        with stage('aligned_stack'):
+            stack = load_aligned_stack(country_code, city_name, year, gadm_index, era5_folder, ndvi_folder,
+                                       season_start, season_end, buffer_degree=BUFFER_DEGREE,
+                                       upsample_factor=upsample_factor, cache_dir=cache_dir,
+                                       era5_archive=era5_archive, ndvi_overview_dir=ndvi_overview_dir,
+                                       dtype=dtype, prefetched=prefetched)
+        if stack is None:
             return None
         
-        city_gdf = city_gdf.dissolve()
-        BUFFER_DEGREE = 0.2
-        study_area_gdf = city_gdf.copy()
-        study_area_gdf.geometry = city_gdf.geometry.buffer(BUFFER_DEGREE)
-        minx, miny, maxx, maxy = study_area_gdf.total_bounds
+        city_gdf = city_gdf_from_stack(stack)
         
-        # 2. Load ERA5 Temperature Data
-        print("Loading ERA5 satellite temperature data...")
-        temp_file = os.path.join(era5_folder, f"{year}_2m_temperature_daily_maximum.nc")
-        ds_temp = xr.open_dataset(temp_file)
-        
-        season_start = f"{year}-06-01"
-        season_end = f"{year}-09-01"
-        
-        ds_summer = ds_temp.sel(valid_time=slice(season_start, season_end))
-        mean_max_temp = ds_summer['t2m'].mean(dim='valid_time')
-        mean_max_temp_c = mean_max_temp - 273.15
-        
-        temp_clipped = mean_max_temp_c.sel(
-            longitude=slice(minx, maxx),
-            latitude=slice(maxy, miny)
-        )
-        
-        # Interpolate for higher resolution
-        new_lat = np.linspace(float(temp_clipped.latitude.min()), 
-                             float(temp_clipped.latitude.max()), 
-                             len(temp_clipped.latitude) * 10)
-        new_lon = np.linspace(float(temp_clipped.longitude.min()), 
-                             float(temp_clipped.longitude.max()), 
-                             len(temp_clipped.longitude) * 10)
-        temp_smooth = temp_clipped.interp(latitude=new_lat, longitude=new_lon, method='linear')
+        # Keep land pixels only (sea cells are NaN and drop out of every statistic)
+        with stage('masking') as s:
+            land = mask_multiplier(stack['land_mask'].values)
+            temp_smooth = stack['temperature'] * land
+            # Single validity mask (land, finite temperature, NDVI in [-1, 1]); the
+            # per-pixel fields below only exist for these pixels, as 1D arrays
+            valid = valid_pixels(stack['ndvi'].values, temp_smooth.values)
+            temp_sat = temp_smooth.values[valid]
+            ndvi = stack['ndvi'].values[valid]
+            s.shape('temperature', temp_smooth)
+            s.shape('valid_pixels', temp_sat)
         
         print(f"Satellite temperature range: {temp_smooth.min().values:.1f}°C to {temp_smooth.max().values:.1f}°C")
         
-        # 3. Load NDVI
-        print("Loading NDVI vegetation data...")
-        ndvi_file = os.path.join(ndvi_folder, f"ndvi_{season_start}_{season_end}.tif")
-        
-        if not os.path.exists(ndvi_file):
-            files = glob(os.path.join(ndvi_folder, f"*{year}*.tif"))
-            if files:
-                ndvi_file = files[0]
-            else:
-                print("No NDVI file found")
-                return None
-        
-        with rasterio.open(ndvi_file) as src:
-            dst_shape = temp_smooth.shape
-            dst_transform = rasterio.transform.from_bounds(
-                new_lon.min(), new_lat.min(), new_lon.max(), new_lat.max(),
-                dst_shape[1], dst_shape[0]
-            )
-            
-            ndvi_resampled = np.zeros(dst_shape, dtype=np.float32)
-            
-            reproject(
-                source=rasterio.band(src, 1),
-                destination=ndvi_resampled,
-                src_transform=src.transform,
-                src_crs=src.crs,
-                dst_transform=dst_transform,
-                dst_crs="EPSG:4326",
-                resampling=Resampling.average
-            )
-            
-            ndvi_resampled = ndvi_resampled.astype(float)
-            ndvi_resampled = ndvi_resampled / 254.0 * 2.0 - 1.0
-        
-        xr_ndvi = xr.DataArray(
-            ndvi_resampled,
-            coords={'latitude': new_lat[::-1], 'longitude': new_lon},
-            dims=('latitude', 'longitude')
-        )
-        xr_ndvi = xr_ndvi.sortby('latitude')
-        ndvi_resampled = xr_ndvi.values
-        
         # 4. Model Ground Truth
         # Key hypothesis: satellites struggle in non-vegetated areas
         #  Ground truth = satellite - (1 - NDVI) * correction_factor
@@ -130,60 +150,37 @@ def analyze_city_week3(country_code, city_name, year, gadm_gdf, era5_folder, ndv
         
         print("Modeling ground truth satellite uncertainty...")
         correction_factor = 0.5  # Maximum correction in urban areas
-        ground_truth_temp = temp_smooth.values - (correction_factor * (1 - ndvi_resampled))
-        
-        # 5. Calculate Discrepancies
-        temp_diff = temp_smooth.values - ground_truth_temp
-        abs_temp_diff = np.abs(temp_diff)
-        
-        # Flatten for analysis
-        temp_sat_flat = temp_smooth.values.flatten()
-        temp_truth_flat = ground_truth_temp.flatten()
-        ndvi_flat = ndvi_resampled.flatten()
-        diff_flat = temp_diff.flatten()
-        abs_diff_flat = abs_temp_diff.flatten()
-        
-        # Create DataFrame
-        df = pd.DataFrame({
-            'satellite_temp': temp_sat_flat,
-            'ground_truth_temp': temp_truth_flat,
-            'ndvi': ndvi_flat,
-            'temp_difference': diff_flat,
-            'abs_difference': abs_diff_flat
-        })
-        
-        # Clean data (remove NaNs)
-        df_clean = df.dropna()
-        df_clean = df_clean[(df_clean['ndvi'] >= -1) & (df_clean['ndvi'] <= 1)]
-        
-        # Classify by urbanization
-        def classify_urbanization(ndvi):
-            if ndvi < 0.2: return 'Urban/Concrete'
-            elif ndvi < 0.4: return 'Sparse Vegetation'
-            elif ndvi < 0.6: return 'Moderate Vegetation'
-            else: return 'Dense Vegetation'
-        
-        df_clean['urbanization'] = df_clean['ndvi'].apply(classify_urbanization)
+        with stage('ground_truth'):
+            # 5. Calculate Discrepancies: satellite - ground truth is the correction itself,
+            # built in place so each field costs one array
+            temp_diff = np.subtract(1, ndvi, dtype=ndvi.dtype)
+            temp_diff *= correction_factor
+            ground_truth_temp = temp_sat - temp_diff
+            abs_diff = np.abs(temp_diff)
+        
+        # Streaming moments over the valid pixels
+        with stage('statistics'):
+            columns = ('satellite_temp', 'ground_truth_temp', 'ndvi', 'temp_difference', 'abs_difference')
+            moments = MomentAccumulator(columns)
+            moments.update(temp_sat, ground_truth_temp, ndvi, temp_diff, abs_diff)
+            
+            # Per urbanization class statistics of the absolute discrepancy (vectorized)
+            class_table = binned_stats(ndvi, abs_diff, labels=WEEK3_CLASS_LABELS)
         
         # 6. Statistical Analysis
         print("Computing statistics...")
         
-        stats['n_pixels'] = len(df_clean)
-        stats['mean_satellite_temp'] = df_clean['satellite_temp'].mean()
-        stats['mean_ground_temp'] = df_clean['ground_truth_temp'].mean()
-        stats['mean_discrepancy'] = df_clean['temp_difference'].mean()
-        stats['rmse'] = np.sqrt((df_clean['temp_difference'] ** 2).mean())
-        stats['max_discrepancy'] = df_clean['abs_difference'].max()
-        stats['std_discrepancy'] = df_clean['temp_difference'].std()
-        
-        if len(df_clean) > 1:
-            stats['correlation_sat_ground'] = df_clean['satellite_temp'].corr(df_clean['ground_truth_temp'])
-            stats['correlation_discrepancy_ndvi'] = df_clean['abs_difference'].corr(df_clean['ndvi'])
-        else:
-            stats['correlation_sat_ground'] = np.nan
-            stats['correlation_discrepancy_ndvi'] = np.nan
-        
-        print(f"\n--- Overall Metrics (from {len(df_clean):,} pixels) ---")
+        stats['n_pixels'] = moments.count
+        stats['mean_satellite_temp'] = moments.mean_of('satellite_temp')
+        stats['mean_ground_temp'] = moments.mean_of('ground_truth_temp')
+        stats['mean_discrepancy'] = moments.mean_of('temp_difference')
+        stats['rmse'] = moments.rms('temp_difference')
+        stats['max_discrepancy'] = moments.max_of('abs_difference')
+        stats['std_discrepancy'] = moments.std('temp_difference')
+        stats['correlation_sat_ground'] = moments.corr('satellite_temp', 'ground_truth_temp')
+        stats['correlation_discrepancy_ndvi'] = moments.corr('abs_difference', 'ndvi')
+        
+        print(f"\n--- Overall Metrics (from {moments.count:,} pixels) ---")
         print(f"Mean Satellite Temp: {stats['mean_satellite_temp']:.2f}°C")
         print(f"Mean Ground Truth Temp: {stats['mean_ground_temp']:.2f}°C")
         print(f"Mean Discrepancy: {stats['mean_discrepancy']:.2f}°C")
@@ -194,115 +191,98 @@ def analyze_city_week3(country_code, city_name, year, gadm_gdf, era5_folder, ndv
         print(f"Correlation (Discrepancy vs NDVI): {stats['correlation_discrepancy_ndvi']:.4f}")
         
         print(f"\n--- By Urbanization Level ---")
-        for category in ['Urban/Concrete', 'Sparse Vegetation', 'Moderate Vegetation', 'Dense Vegetation']:
-            subset = df_clean[df_clean['urbanization'] == category]
-            if len(subset) > 0:
-                mean_disc = subset['abs_difference'].mean()
-                mean_ndvi = subset['ndvi'].mean()
-                n_pixels = len(subset)
+        for category, row in class_table.iterrows():
+            if row['count'] > 0:
+                mean_disc = row['mean']
+                mean_ndvi = row['ndvi_mean']
+                n_pixels = int(row['count'])
                 print(f"{category}: Mean Discrepancy = {mean_disc:.2f}°C (n={n_pixels:,} pixels, NDVI={mean_ndvi:.2f})")
                 stats[f'discrepancy_{category}'] = mean_disc
                 stats[f'n_pixels_{category}'] = n_pixels
         
-        # 7. Visualizations
-        
-        # Plot 1: Scatter - Satellite vs Ground Truth (sample for readability)
-        sample_size = min(10000, len(df_clean))
-        df_sample = df_clean.sample(n=sample_size, random_state=42)
-        
-        plt.figure(figsize=(10, 8))
-        scatter = plt.scatter(df_sample['ground_truth_temp'], 
-                            df_sample['satellite_temp'],
-                            c=df_sample['ndvi'], cmap='RdYlGn', s=20, 
-                            alpha=0.5, edgecolors='none')
-        
-        temp_range = [df_sample['ground_truth_temp'].min(), 
-                     df_sample['ground_truth_temp'].max()]
-        plt.plot(temp_range, temp_range, 'k--', lw=2, label='Perfect Agreement')
-        
-        plt.xlabel('Ground Truth Temperature (°C)', fontsize=12)
-        plt.ylabel('Satellite Temperature (°C)', fontsize=12)
-        plt.title(f'Satellite vs Ground Truth - {city_name}\nRMSE: {stats["rmse"]:.2f}°C ({sample_size:,} pixel sample)', 
-                 fontsize=14, fontweight='bold')
-        cbar = plt.colorbar(scatter, label='NDVI (Vegetation)')
-        plt.legend(fontsize=11)
-        plt.grid(True, alpha=0.3)
-        plt.tight_layout()
-        out_scatter = os.path.join(output_folder, f"week3_satellite_vs_ground_{city_name}.png")
-        plt.savefig(out_scatter, dpi=300)
-        plt.close()
-        print(f"Saved scatter plot: {out_scatter}")
-        
-        # Plot 2: Discrepancy vs Vegetation (hexbin for dense data)
-        plt.figure(figsize=(10, 8))
-        plt.hexbin(df_clean['ndvi'], df_clean['abs_difference'], gridsize=30, cmap='YlOrRd', mincnt=1)
-        plt.xlabel('NDVI (Vegetation Index)', fontsize=12)
-        plt.ylabel('Absolute Temperature Discrepancy (°C)', fontsize=12)
-        plt.title(f'Discrepancy vs Vegetation - {city_name}\nCorr: {stats["correlation_discrepancy_ndvi"]:.3f}', 
-                 fontsize=14, fontweight='bold')
-        cbar = plt.colorbar(label='Pixel Count')
-        plt.tight_layout()
-        out_disc_veg = os.path.join(output_folder, f"week3_discrepancy_vs_vegetation_{city_name}.png")
-        plt.savefig(out_disc_veg, dpi=300)
-        plt.close()
-        print(f"Saved discrepancy vs vegetation plot: {out_disc_veg}")
-        
-        # Plot 3: Boxplot - Discrepancy by Urbanization
-        plt.figure(figsize=(10, 8))
-        order = ['Urban/Concrete', 'Sparse Vegetation', 'Moderate Vegetation', 'Dense Vegetation']
-        colors = {'Urban/Concrete': '#d7191c', 'Sparse Vegetation': '#fdae61', 
-                 'Moderate Vegetation': '#a6d96a', 'Dense Vegetation': '#1a9641'}
-        
-        sns.boxplot(data=df_clean, x='urbanization', y='abs_difference', order=order, 
-                   palette=colors, width=0.6)
-        plt.ylabel('Absolute Temperature Discrepancy (°C)', fontsize=12)
-        plt.xlabel('Urbanization Level', fontsize=12)
-        plt.title(f'Discrepancy by Urbanization - {city_name}', 
-                 fontsize=14, fontweight='bold')
-        plt.xticks(rotation=15, ha='right')
-        plt.grid(True, alpha=0.3, axis='y')
-        plt.tight_layout()
-        out_box = os.path.join(output_folder, f"week3_discrepancy_boxplot_{city_name}.png")
-        plt.savefig(out_box, dpi=300)
-        plt.close()
-        print(f"Saved boxplot: {out_box}")
-        
-        # Plot 4: Map - Discrepancy spatial distribution
-        fig, ax = plt.subplots(figsize=(12, 10))
-        
-        # Plot satellite temperature as base
-        temp_smooth.plot(ax=ax, cmap='RdYlBu_r', add_colorbar=True, 
-                        cbar_kwargs={'label': 'Satellite Temperature (°C)'})
-        
-        # Overlay discrepancy as contours
-        discrepancy_data = xr.DataArray(
-            abs_temp_diff,
-            coords={'latitude': new_lat[::-1], 'longitude': new_lon},
-            dims=('latitude', 'longitude')
-        )
-        discrepancy_data = discrepancy_data.sortby('latitude')
-        
-        discrepancy_data.plot.contour(ax=ax, levels=5, colors='purple', linewidths=1.5, alpha=0.6)
-        
-        city_gdf.boundary.plot(ax=ax, color='blue', linewidth=2.5, label='City Boundary')
-        
-        ax.legend(fontsize=11, loc='upper right')
-        ax.set_title(f'Discrepancy Map (Contours) - {city_name}', fontsize=14, fontweight='bold')
-        plt.tight_layout()
-        out_map = os.path.join(output_folder, f"week3_discrepancy_map_{city_name}.png")
-        plt.savefig(out_map, dpi=300)
-        plt.close()
-        print(f"Saved map: {out_map}")
+        # 7. Visualizations (plot-ready data handed to the renderer)
+        if renderer.wants():
+            with stage('figures'):
+                # Plots 1-2 are binned densities of every valid pixel, with the
+                # regression lines from the exact moments (no sampling)
+                # Plot 1: Density - Satellite vs Ground Truth
+                renderer.submit(plot_satellite_vs_ground,
+                                os.path.join(output_folder, f"week3_satellite_vs_ground_{city_name}.png"),
+                                **density_plot_data(moments, 'ground_truth_temp', 'satellite_temp',
+                                                    ground_truth_temp, temp_sat),
+                                rmse=stats['rmse'], city_name=city_name)
+                
+                # Plot 2: Density - Discrepancy vs Vegetation
+                renderer.submit(plot_discrepancy_vs_vegetation,
+                                os.path.join(output_folder, f"week3_discrepancy_vs_vegetation_{city_name}.png"),
+                                **density_plot_data(moments, 'ndvi', 'abs_difference', ndvi, abs_diff),
+                                correlation=stats['correlation_discrepancy_ndvi'], city_name=city_name)
+                
+                # Plot 3: Boxplot - Discrepancy by Urbanization
+                renderer.submit(plot_discrepancy_boxplot,
+                                os.path.join(output_folder, f"week3_discrepancy_boxplot_{city_name}.png"),
+                                class_table=class_table, city_name=city_name)
+        
+        # Plot 4: Map - Discrepancy spatial distribution (summary figure)
+        # The grid is scattered back from the valid pixels only when the map is drawn
+        if renderer.wants(summary=True):
+            with stage('discrepancy_map'):
+                abs_temp_diff = np.full(temp_smooth.shape, np.nan, dtype=abs_diff.dtype)
+                abs_temp_diff[valid] = abs_diff
+                discrepancy_data = xr.DataArray(
+                    abs_temp_diff,
+                    coords=temp_smooth.coords,
+                    dims=temp_smooth.dims
+                )
+                renderer.submit(plot_discrepancy_map, os.path.join(output_folder, f"week3_discrepancy_map_{city_name}.png"),
+                                summary=True, temp_smooth=temp_smooth, discrepancy_data=discrepancy_data,
+                                city_gdf=city_gdf, city_name=city_name)
         
         return stats
         
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"Error analyzing {city_name}: {e}")
         import traceback
         traceback.print_exc()
         return None
 
+def prefetch_city_week3(country_code, city_name, year, gadm_index, era5_folder, ndvi_folder,
+                        cache_dir=None, era5_archive=None, ndvi_overview_dir=None, upsample_factor=10,
+                        dtype='float64', **kwargs):
+    """The reads of analyze_city_week3 for one city, done ahead by run_cities"""
+    return prefetch_aligned_stack(country_code, city_name, year, gadm_index, era5_folder, ndvi_folder,
+                                  f"{year}-{SEASON[0]}", f"{year}-{SEASON[1]}", buffer_degree=BUFFER_DEGREE,
+                                  upsample_factor=upsample_factor, cache_dir=cache_dir, era5_archive=era5_archive,
+                                  ndvi_overview_dir=ndvi_overview_dir, dtype=dtype)
+
 def main():
+    parser = argparse.ArgumentParser(description="Week 3 satellite data quality analysis")
+    parser.add_argument('--workers', type=int, default=1, help="Number of cities analysed in parallel")
+    parser.add_argument('--figures', choices=FIGURE_MODES, default='all',
+                        help="Render all figures, only the discrepancy maps, or none (CSV metrics only)")
+    parser.add_argument('--render-workers', type=int, default=0,
+                        help="Background processes drawing figures (0 = draw inline)")
+    parser.add_argument('--ndvi-overviews', action='store_true',
+                        help="Resample NDVI from cached decimated overviews instead of full-resolution pixels")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="Append per-stage timings and memory of each city run to FILE (JSON lines)")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="Also trace Python/numpy allocation peaks per stage (slower)")
+    parser.add_argument('--upsample', type=int, default=10, help="ERA5 upsampling factor of the aligned grid")
+    parser.add_argument('--float32', action='store_true',
+                        help="Memory-lean mode: keep the aligned grid and pixel fields in float32")
+    parser.add_argument('--prefetch', type=int, default=1,
+                        help="Cities whose reads run ahead on background threads (0 = off; serial runs only)")
+    parser.add_argument('--prefetch-mb', type=int, default=1024,
+                        help="Stop reading ahead while prefetched data holds more than this")
+    parser.add_argument('--manifest', default=os.path.join("reports", "figures", "week3_manifest.jsonl"),
+                        help="Run manifest: finished cities are logged here and not rerun while unchanged")
+    parser.add_argument('--rerun', action='store_true', help="Run every city again, even if unchanged (still logged)")
+    parser.add_argument('--retry-failed', action='store_true', help="Run the cities that failed last time again")
+    args = parser.parse_args()
+    
     print("="*60)
     print("WEEK 3 ANALYSIS: SATELLITE DATA QUALITY ASSESSMENT")
     print("Via Vegetation Density Correlation")
@@ -313,12 +293,12 @@ def main():
     GADM_FILE = os.path.join(DATA_FOLDER, "gadm_410_europe.gpkg")
     ERA5_FOLDER = os.path.join(DATA_FOLDER, "derived-era5-land-daily-statistics")
     NDVI_FOLDER = os.path.join(DATA_FOLDER, "sentinel2_ndvi")
+    CACHE_FOLDER = os.path.join(DATA_FOLDER, "cache", "aligned")
+    GADM_INDEX_FILE = os.path.join(DATA_FOLDER, "cache", "gadm_index.pkl")
+    NDVI_OVERVIEW_FOLDER = os.path.join(DATA_FOLDER, "cache", "ndvi_overviews")
     
     os.makedirs(OUTPUT_FOLDER, exist_ok=True)
     
-    print("Loading GADM data...")
-    gadm_gdf = gpd.read_file(GADM_FILE)
-    
     cities = [
         ("FRA", "Paris"),
         ("ITA", "Roma"),
@@ -326,13 +306,29 @@ def main():
         ("ITA", "Perugia")
     ]
     
-    results = []
+    # Cities run in a process pool when --workers > 1; each worker loads the
+    # GADM index and ERA5 handles once
+    tasks = [(country, city, 2022) for country, city in cities]
+    renderer = FigureRenderer(args.figures, workers=args.render_workers)
+    tracer = Tracer(args.trace, trace_memory=args.trace_memory)
+    manifest = RunManifest(args.manifest)
+    started = time.time()
+    records = run_cities(analyze_city_week3, tasks, GADM_FILE, ERA5_FOLDER, NDVI_FOLDER, OUTPUT_FOLDER,
+                         workers=args.workers, gadm_index_file=GADM_INDEX_FILE, cache_dir=CACHE_FOLDER,
+                         renderer=renderer, ndvi_overview_dir=NDVI_OVERVIEW_FOLDER if args.ndvi_overviews else None,
+                         upsample_factor=args.upsample, dtype='float32' if args.float32 else 'float64',
+                         tracer=tracer, manifest=manifest, retry_failed=args.retry_failed, rerun=args.rerun,
+                         prefetch_fn=prefetch_city_week3, prefetch_depth=args.prefetch, prefetch_max_bytes=args.prefetch_mb * 1024**2)
+    renderer.close()
+    print_failures(records)
+    if args.trace:
+        print_trace_summary(args.trace, since=started)
     
-    for country, city in cities:
-        res = analyze_city_week3(country, city, 2022, gadm_gdf, ERA5_FOLDER, NDVI_FOLDER, 
-                                OUTPUT_FOLDER)
-        if res:
-            res['city'] = city
+    results = []
+    for record in records:
+        if record['status'] == 'ok':
+            res = record['stats']
+            res['city'] = record['city']
             results.append(res)
     
     # Summary Report